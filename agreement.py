@@ -0,0 +1,291 @@
+""" agreement.py: Inter-coder agreement between the `tenpc.py` files
+
+After a second coder fills in the to-be-coded file (`tbcoded.csv`), we join it
+with the already-coded file (`arcoded.csv`) on conversation number and position
+within the conversation, and we measure how well the two coders agree on the
+`Authentic?` and `Rich?` fields.  We code authenticity on every comment but
+richness only on the first comment of a conversation, so we compare richness
+once per conversation.
+
+For each field, we report percent agreement, Cohen's weighted kappa, and
+Krippendorff's alpha with the ordinal metric, along with bootstrap confidence
+intervals.  The bootstrap resamples whole conversations, since the comments in
+a conversation are not independent.  Every statistic depends only on the table
+of paired codes, so we reduce each conversation to its own small table of
+counts.  A replicate is then a vector of how many times each conversation was
+drawn, and a chunk of replicates becomes a single matrix product.  We spread the
+chunks across a pool of processes.
+
+Author: Mike Smith
+Date:   20261017
+"""
+
+import os
+import sys
+import csv
+from multiprocessing import Pool
+import numpy as np
+
+"""Format of the `tbcoded` and `arcoded` CSV files
+0: Conversation ID
+1: Authentic? -- coding field
+2: Rich discussion? -- coding field
+3: Comment -- the actual text of the student's comment
+"""
+
+###
+### Global variables
+###
+
+FNAME_TBNEW = 'annotations/tbcoded.csv'
+FNAME_ARNEW = 'annotations/arcoded.csv'
+
+# The ordinal coding scale for both fields
+CATEGORIES = [0, 1, 2]
+K = len(CATEGORIES)
+
+# The fields we compare, and their columns in the `tenpc.py` files
+FIELDS = [('Authentic?', 1), ('Rich?', 2)]
+
+# The statistics we report, in order
+STATISTICS = ['Percent agreement', "Cohen's weighted kappa",
+              "Krippendorff's alpha"]
+
+# Bootstrap defaults
+REPLICATES = 10000
+CONFIDENCE = 95
+CHUNK_SIZE = 1000      # replicates per matrix product
+PARALLEL_THRESHOLD = 2000
+
+###
+### Reading and joining the files
+###
+
+def read_coded(fname):
+    """Returns a dictionary mapping `(conversation, position)` to the row of
+       `tenpc.py` file fname, where position counts from 0 within each
+       conversation"""
+    coded = {}
+    with open(fname) as fin:
+        reader = csv.reader(fin, delimiter=',')
+        next(reader, None)    # skip the header
+        last_c = None
+        for row in reader:
+            c = int(row[0])
+            position = position + 1 if c == last_c else 0
+            last_c = c
+            coded[(c, position)] = row
+    return coded
+
+def category(field):
+    """Returns the index of coding field in CATEGORIES, or None if it isn't a
+       code on our scale (e.g., the coder left it blank)"""
+    try:
+        return CATEGORIES.index(int(field))
+    except ValueError:
+        return None
+
+def join(fname_tb, fname_ar):
+    """Join the to-be-coded file with the already-coded file and return a
+       dictionary mapping each field name to the pair `(groups, codes)`, where
+       groups holds the 0-based conversation of each paired code and codes is
+       an (n, 2) array of category indices (tbcoded first).  Also returns the
+       number of conversations."""
+    tb = read_coded(fname_tb)
+    ar = read_coded(fname_ar)
+
+    conversations = {}
+    pairs = {name: ([], []) for name, _ in FIELDS}
+    for (c, position), tb_row in sorted(tb.items()):
+        ar_row = ar.get((c, position))
+        if ar_row is None or ar_row[3] != tb_row[3]:
+            raise RuntimeError(f'Conversation #{c} in {fname_tb} does not '
+                               f'match {fname_ar}')
+        g = conversations.setdefault(c, len(conversations))
+        for name, col in FIELDS:
+            if col == 2 and position > 0:
+                continue    # we code richness on the first comment only
+            a, b = category(tb_row[col]), category(ar_row[col])
+            if a is None or b is None:
+                continue
+            pairs[name][0].append(g)
+            pairs[name][1].append((a, b))
+
+    joined = {name: (np.array(groups, dtype=np.int64),
+                     np.array(codes, dtype=np.int64).reshape(-1, 2))
+              for name, (groups, codes) in pairs.items()}
+    return joined, len(conversations)
+
+def group_tables(groups, codes, num_groups):
+    """Returns a (num_groups, K*K) array giving each conversation's table of
+       paired codes, flattened"""
+    cells = codes[:, 0] * K + codes[:, 1]
+    tables = np.zeros((num_groups, K * K), dtype=np.int64)
+    np.add.at(tables, (groups, cells), 1)
+    return tables
+
+###
+### Agreement statistics
+###
+### Each takes an array of shape (..., K, K) of paired-code tables, rows for
+### the first coder and columns for the second, and returns an array of shape
+### (...).  Undefined statistics (e.g., no variation in the codes) are NaN.
+
+def percent_agreement(tables):
+    """Returns the percentage of pairs on which the coders agree"""
+    n = tables.sum(axis=(-2, -1))
+    agree = np.trace(tables, axis1=-2, axis2=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 100 * agree / n
+
+def weighted_kappa(tables, weights='quadratic'):
+    """Returns Cohen's weighted kappa with linear or quadratic weights"""
+    i, j = np.indices((K, K))
+    power = 2 if weights == 'quadratic' else 1
+    w = 1 - (np.abs(i - j) / (K - 1)) ** power
+
+    n = tables.sum(axis=(-2, -1))[..., None, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        p = tables / n
+        rows = p.sum(axis=-1)
+        cols = p.sum(axis=-2)
+        expected = rows[..., :, None] * cols[..., None, :]
+        p_o = (w * p).sum(axis=(-2, -1))
+        p_e = (w * expected).sum(axis=(-2, -1))
+        return (p_o - p_e) / (1 - p_e)
+
+def ordinal_alpha(tables):
+    """Returns Krippendorff's alpha with the ordinal metric, for two coders
+       and no missing values"""
+    # Each pair of codes contributes both orderings to the coincidence matrix
+    o = tables + np.swapaxes(tables, -1, -2)
+    n_c = o.sum(axis=-1)
+    n = n_c.sum(axis=-1)[..., None, None]
+
+    # The ordinal distance between categories c <= k counts the values ranked
+    # between them: (n_c/2 + n_(c+1) + ... + n_(k-1) + n_k/2)^2
+    cum = np.cumsum(n_c, axis=-1)
+    cum_c = cum[..., :, None] - n_c[..., :, None] / 2
+    cum_k = cum[..., None, :] - n_c[..., None, :] / 2
+    delta = (cum_k - cum_c) ** 2
+
+    observed = (o * delta).sum(axis=(-2, -1))
+    expected = (n_c[..., :, None] * n_c[..., None, :] * delta).sum(axis=(-2, -1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 1 - (n[..., 0, 0] - 1) * observed / expected
+
+def statistics(tables, weights='quadratic'):
+    """Returns an array of shape (..., len(STATISTICS)) holding every statistic
+       for the flattened tables of shape (..., K*K)"""
+    tables = tables.reshape(tables.shape[:-1] + (K, K)).astype(np.float64)
+    return np.stack([percent_agreement(tables),
+                     weighted_kappa(tables, weights),
+                     ordinal_alpha(tables)], axis=-1)
+
+###
+### Bootstrap
+###
+
+def bootstrap_chunk(task):
+    """Returns an array of shape (replicates, len(FIELDS), len(STATISTICS))
+       for the task `(tables, replicates, seed, weights)`, where tables is the
+       list of per-conversation table arrays, one for each field"""
+    tables, replicates, seed, weights = task
+    rng = np.random.default_rng(seed)
+    num_groups = tables[0].shape[0]
+    draws = rng.multinomial(num_groups, np.full(num_groups, 1 / num_groups),
+                            size=replicates)
+    return np.stack([statistics(draws @ t, weights) for t in tables], axis=1)
+
+def bootstrap(tables, replicates=REPLICATES, seed=None, weights='quadratic',
+              processes=None):
+    """Returns an array of shape (replicates, len(FIELDS), len(STATISTICS))
+       of bootstrap replicates that resample conversations.  If processes is
+       None, we use a pool with one process per CPU for big runs and no pool
+       otherwise; processes=1 never uses a pool."""
+    if processes is None:
+        processes = os.cpu_count() if replicates >= PARALLEL_THRESHOLD else 1
+
+    # Give every chunk its own independent stream of random numbers
+    sizes = [min(CHUNK_SIZE, replicates - i)
+             for i in range(0, replicates, CHUNK_SIZE)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(tables, size, s, weights) for size, s in zip(sizes, seeds)]
+    if processes > 1 and len(tasks) > 1:
+        with Pool(processes) as pool:
+            results = pool.map(bootstrap_chunk, tasks)
+    else:
+        results = [bootstrap_chunk(task) for task in tasks]
+    return np.concatenate(results, axis=0)
+
+def confidence_interval(replicates, confidence=CONFIDENCE):
+    """Returns the percentile bootstrap interval for each statistic, as a pair
+       of arrays shaped like one replicate"""
+    tail = (100 - confidence) / 2
+    with np.errstate(invalid='ignore'):
+        lo, hi = np.nanpercentile(replicates, [tail, 100 - tail], axis=0)
+    return lo, hi
+
+###
+### Main routines
+###
+
+def agreement(fname_tb=FNAME_TBNEW, fname_ar=FNAME_ARNEW,
+              replicates=REPLICATES, seed=None, weights='quadratic',
+              confidence=CONFIDENCE, processes=None):
+    """Returns a dictionary mapping each field name to a dictionary that maps
+       each statistic to the tuple `(estimate, low, high, pairs)`"""
+    joined, num_groups = join(fname_tb, fname_ar)
+    if num_groups == 0:
+        raise RuntimeError(f'No conversations in {fname_tb}')
+    tables = [group_tables(*joined[name], num_groups) for name, _ in FIELDS]
+
+    estimates = np.stack([statistics(t.sum(axis=0), weights) for t in tables])
+    if replicates > 0:
+        lo, hi = confidence_interval(bootstrap(tables, replicates, seed,
+                                               weights, processes), confidence)
+    else:
+        lo = hi = np.full(estimates.shape, np.nan)
+
+    results = {}
+    for f, (name, _) in enumerate(FIELDS):
+        pairs = len(joined[name][1])
+        results[name] = {stat: (estimates[f, s], lo[f, s], hi[f, s], pairs)
+                         for s, stat in enumerate(STATISTICS)}
+    return results
+
+def print_results(results, confidence=CONFIDENCE):
+    for name, stats in results.items():
+        pairs = next(iter(stats.values()))[3]
+        print(f'{name} ({pairs} pairs)')
+        for stat, (estimate, lo, hi, _) in stats.items():
+            print(f'  {stat}: {estimate:.3f} '
+                  f'[{confidence}% CI {lo:.3f}, {hi:.3f}]')
+
+def main():
+    usage = ("Usage: python3 agreement.py [-reps N] [-seed N] "
+             "[-weights linear|quadratic]")
+    replicates = REPLICATES
+    seed = None
+    weights = 'quadratic'
+    args = sys.argv[1:]
+    try:
+        while args:
+            opt = args.pop(0)
+            if opt == '-reps':
+                replicates = int(args.pop(0))
+            elif opt == '-seed':
+                seed = int(args.pop(0))
+            elif opt == '-weights':
+                weights = args.pop(0)
+                if weights not in ('linear', 'quadratic'):
+                    sys.exit(usage)
+            else:
+                sys.exit(usage)
+    except (IndexError, ValueError):
+        sys.exit(usage)
+
+    print_results(agreement(replicates=replicates, seed=seed, weights=weights))
+
+if __name__ == '__main__':
+    main()
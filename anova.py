@@ -0,0 +1,155 @@
+""" anova.py: Analysis of variance of year, controlling for document
+
+This replaces `aov(authentic ~ year + document)` and `aov(upvotes ~ year +
+document)` in `gendata.Rmd`, fit to every comment in `all-years.key.csv`.  We
+report the sequential (type I) table in R's order, year and then document, and
+the test of year after document (type II), which is what controls for the
+documents read.
+
+We never build the one-hot design matrix, which has a column per document.
+The residual sum of squares of a one-way model is the sum of the squared
+deviations from the group means, which a `bincount` gives us in one pass.  For
+the additive model, we demean the outcome and the year indicators within each
+document, which sweeps the document effects out, and solve the small least
+squares problem that's left, with a column per year.  Everything scales
+linearly in the number of comments, however many documents there are.
+
+Author: Mike Smith
+Date:   20261017
+"""
+
+import sys
+import numpy as np
+import columnar
+from metrics import coded_comments
+from significance import f_pvalue
+
+###
+### Global variables
+###
+
+FNAME_KEY = 'annotations/all-years.key.csv'
+
+# The outcomes we model: the name we print, the key column, and whether only
+# the coded records count
+OUTCOMES = [('authentic', 'authentic', True), ('upvotes', 'upvotes', False)]
+
+###
+### Some helper functions
+###
+
+def factor(values):
+    """Returns the pair `(levels, codes)` for the values of a categorical
+       variable, where codes gives the index of each value in levels"""
+    levels, codes = np.unique(values, return_inverse=True)
+    return levels, codes.ravel()
+
+def group_means(values, codes, num_groups):
+    """Returns the mean of values, a 1-D or 2-D (n, k) array, within each group,
+       as an array with a row per group"""
+    counts = np.bincount(codes, minlength=num_groups).astype(np.float64)
+    counts[counts == 0] = 1
+    if values.ndim == 1:
+        return np.bincount(codes, weights=values, minlength=num_groups) / counts
+    return np.stack([np.bincount(codes, weights=values[:, j],
+                                 minlength=num_groups) / counts
+                     for j in range(values.shape[1])], axis=1)
+
+def demean(values, codes, num_groups):
+    """Returns values with the mean of its group subtracted from each row"""
+    return values - group_means(values, codes, num_groups)[codes]
+
+def one_way_rss(y, codes, num_groups):
+    """Returns the residual sum of squares of the model with a mean per
+       group"""
+    r = demean(y, codes, num_groups)
+    return float(r @ r)
+
+def indicators(codes, num_levels):
+    """Returns the (n, num_levels - 1) indicator columns of a factor, treating
+       level 0 as the baseline"""
+    x = np.zeros((len(codes), num_levels - 1))
+    rows = np.flatnonzero(codes > 0)
+    x[rows, codes[rows] - 1] = 1
+    return x
+
+###
+### Main routines
+###
+
+def anova(y, year, document):
+    """Fit `y ~ year + document` and return a dictionary of rows, each the
+       tuple `(df, ss, ms, f, p)`: `year` and `document` of the type I table,
+       `year | document` (type II), and `residuals` (whose f and p are NaN)"""
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    years, year_codes = factor(year)
+    documents, doc_codes = factor(document)
+    num_years, num_docs = len(years), len(documents)
+
+    # The residual sums of squares of the nested models
+    centered = y - y.mean()
+    ss_total = float(centered @ centered)
+    rss_year = one_way_rss(y, year_codes, num_years)
+    rss_doc = one_way_rss(y, doc_codes, num_docs)
+
+    # Sweep the documents out of the outcome and the year indicators, and fit
+    # what's left
+    r = demean(y, doc_codes, num_docs)
+    if num_years > 1:
+        x = demean(indicators(year_codes, num_years), doc_codes, num_docs)
+        beta, _, rank, _ = np.linalg.lstsq(x, r, rcond=None)
+        rank = int(rank)
+        r = r - x @ beta
+    else:
+        rank = 0
+    rss_full = float(r @ r)
+
+    # Degrees of freedom, where rank is the number of year columns that
+    # aren't aliased with the documents
+    df_resid = n - num_docs - rank
+    df_year = num_years - 1
+    df_doc = num_docs + rank - num_years
+
+    ms_resid = rss_full / df_resid if df_resid > 0 else np.nan
+    def row(df, ss):
+        ss = max(ss, 0.0)    # rounding can leave a tiny negative difference
+        if df <= 0:
+            return df, ss, np.nan, np.nan, np.nan
+        ms = ss / df
+        f = ms / ms_resid if ms_resid > 0 else np.nan
+        return df, ss, ms, f, f_pvalue(f, df, df_resid)
+
+    return {'year': row(df_year, ss_total - rss_year),
+            'document': row(df_doc, rss_year - rss_full),
+            'year | document': row(rank, rss_doc - rss_full),
+            'residuals': (df_resid, rss_full, ms_resid, np.nan, np.nan)}
+
+def print_table(name, table):
+    print(f'*** {name} ~ year + document ***')
+    print(f"  {'':16}{'Df':>8}{'Sum Sq':>14}{'Mean Sq':>14}"
+          f"{'F value':>10}{'Pr(>F)':>12}")
+    for label in ('year', 'document', 'residuals'):
+        df, ss, ms, f, p = table[label]
+        print(f'  {label:16}{df:>8}{ss:>14.6g}{ms:>14.6g}{f:>10.4g}{p:>12.4g}')
+    df, ss, ms, f, p = table['year | document']
+    print(f'  Year after document (type II): Df = {df}, Sum Sq = {ss:.6g}, '
+          f'F = {f:.4g}, p = {p:.4g}')
+    print('')
+
+def main():
+    if len(sys.argv) != 1:
+        sys.exit('Usage: python3 anova.py')
+
+    key = columnar.load_key(FNAME_KEY)
+    coded = coded_comments(key)
+    for name, column, only_coded in OUTCOMES:
+        records = coded if only_coded else slice(None)
+        if len(key[column][records]) == 0:
+            print(f'No coded records for {name}\n')
+            continue
+        print_table(name, anova(key[column][records], key['year'][records],
+                                key['document'][records]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+""" bench.py: Times and memory-profiles each stage of the pipeline
+
+For each size, we use `synth.py` to write a synthetic export of that many
+annotations into a scratch directory, and then we run every stage there as its
+own process, just as you would by hand:
+
+    overlap.py, build.py, fixup.py, analyze.py, tenpc.py
+
+`code.py` is interactive, so instead of timing it, we fill in random codes for
+every record between `fixup.py` and `analyze.py`, which gives the later stages
+a fully coded dataset to work on.  For each stage, we record the wall-clock
+time, the user and system CPU time, the peak resident memory of the process,
+and the annotations processed per second.
+
+The results go to a JSON file (`-out`), along with when and where they ran.
+Pass an earlier results file with `-baseline`, and we print the ratio of each
+measurement to the baseline and flag the ones that got more than
+`THRESHOLD` times worse.
+
+Author: Mike Smith
+Date:   20261017
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import datetime
+import subprocess
+import columnar
+import journal
+import synth
+
+###
+### Global variables
+###
+
+# Where the pipeline scripts live
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The default sizes, in annotations.  Pass -sizes to go up to 10^7.
+SIZES = [1000, 10000, 100000]
+
+# The years we synthesize; build.py knows the instructors for both
+YEARS = ['2020', '2021']
+
+# The stages we time, as the script and its arguments
+STAGES = [
+    ('overlap', ['overlap.py'] + [f'{yr}.csv' for yr in YEARS]),
+    ('build', ['build.py'] + [f'{yr}.csv' for yr in YEARS] + ['-seed', '1']),
+    ('fixup', ['fixup.py']),
+    ('analyze', ['analyze.py'] + YEARS),
+    ('tenpc', ['tenpc.py', '-seed', '1']),
+]
+
+# Flag a measurement when it is this many times its baseline
+THRESHOLD = 1.25
+
+# The measurements we compare against a baseline
+MEASUREMENTS = ['wall', 'cpu', 'maxrss_kb']
+
+FNAME_KEY = 'annotations/all-years.key.csv'
+FNAME_DATA = 'annotations/all-years.csv'
+
+###
+### Some helper functions
+###
+
+def git_commit():
+    """Returns the commit we're benchmarking, or None outside a repository"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=SRC_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_stage(args, workdir):
+    """Run the pipeline script with args in workdir and return a dictionary of
+       its wall-clock time, CPU time, and peak resident memory"""
+    with tempfile.TemporaryFile() as errors:
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            [sys.executable, os.path.join(SRC_DIR, args[0])] + args[1:],
+            cwd=workdir, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=errors)
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        if proc.returncode != 0:
+            errors.seek(0)
+            raise RuntimeError(f'{args[0]} failed:\n'
+                               + errors.read().decode(errors='replace'))
+
+    # Linux reports ru_maxrss in kilobytes, but macOS reports bytes
+    maxrss = usage.ru_maxrss
+    if platform.system() == 'Darwin':
+        maxrss //= 1024
+    return {'wall': wall, 'cpu': usage.ru_utime + usage.ru_stime,
+            'user': usage.ru_utime, 'sys': usage.ru_stime,
+            'maxrss_kb': maxrss}
+
+def fill_codes(workdir, rng):
+    """Stand in for `code.py` by giving every record in workdir a random
+       authenticity code, and every conversation head a richness code"""
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        heads = [row[0] == '0' for row in columnar.read_data(FNAME_DATA)]
+        key_rows = list(columnar.read_key(FNAME_KEY))
+        for head, row in zip(heads[1:], key_rows[1:]):
+            row[5] = str(rng.randrange(3))
+            row[6] = str(rng.randrange(3)) if head else '0'
+        journal.write_key(FNAME_KEY, key_rows)
+    finally:
+        os.chdir(cwd)
+
+###
+### Main routines
+###
+
+def bench_size(size, seed, keep=False):
+    """Synthesize size annotations, run every stage on them, and return a
+       dictionary mapping each stage to its measurements"""
+    workdir = tempfile.mkdtemp(prefix=f'bench-{size}-')
+    try:
+        os.mkdir(os.path.join(workdir, 'annotations'))
+        synth.synthesize(os.path.join(workdir, 'annotations'),
+                         annotations=size, years=','.join(YEARS), seed=seed)
+
+        results = {}
+        for name, args in STAGES:
+            if name == 'analyze':
+                fill_codes(workdir, random.Random(seed))
+            r = run_stage(args, workdir)
+            r['rows_per_sec'] = size / r['wall'] if r['wall'] > 0 else None
+            results[name] = r
+            print(f"{size:>10} {name:10}{r['wall']:>10.3f}s{r['cpu']:>10.3f}s"
+                  f"{r['maxrss_kb'] / 1024:>10.1f} MB"
+                  f"{r['rows_per_sec']:>14,.0f} rows/s")
+        return results
+    finally:
+        if keep:
+            print(f'Kept {workdir}')
+        else:
+            shutil.rmtree(workdir)
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """Print the ratio of every measurement in results to the same one in
+       baseline, and return the list of regressions as `(size, stage,
+       measurement, ratio)` tuples"""
+    regressions = []
+    print(f"\n{'size':>10} {'stage':10}" +
+          ''.join(f'{m:>12}' for m in MEASUREMENTS))
+    for size, stages in results['sizes'].items():
+        for name, r in stages.items():
+            base = baseline['sizes'].get(size, {}).get(name)
+            if base is None:
+                continue
+            line = f'{size:>10} {name:10}'
+            for m in MEASUREMENTS:
+                if not base.get(m):
+                    line += f"{'-':>12}"
+                    continue
+                ratio = r[m] / base[m]
+                flag = '!' if ratio > threshold else ' '
+                line += f'{ratio:>11.2f}{flag}'
+                if ratio > threshold:
+                    regressions.append((size, name, m, ratio))
+            print(line)
+    return regressions
+
+def main():
+    usage = ('Usage: python3 bench.py [-sizes N1,N2,...] [-seed N] '
+             '[-out FILE] [-baseline FILE] [-keep]')
+    sizes = SIZES
+    seed = 1
+    fname_out = None
+    fname_baseline = None
+    keep = False
+    args = sys.argv[1:]
+    try:
+        while args:
+            opt = args.pop(0)
+            if opt == '-sizes':
+                sizes = [int(float(s)) for s in args.pop(0).split(',')]
+            elif opt == '-seed':
+                seed = int(args.pop(0))
+            elif opt == '-out':
+                fname_out = args.pop(0)
+            elif opt == '-baseline':
+                fname_baseline = args.pop(0)
+            elif opt == '-keep':
+                keep = True
+            else:
+                sys.exit(usage)
+    except (IndexError, ValueError):
+        sys.exit(usage)
+
+    results = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+               'commit': git_commit(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'seed': seed,
+               'sizes': {}}
+    print(f"{'size':>10} {'stage':10}{'wall':>11}{'cpu':>11}{'peak RSS':>13}"
+          f"{'throughput':>21}")
+    for size in sizes:
+        results['sizes'][str(size)] = bench_size(size, seed, keep)
+
+    if fname_out != None:
+        with open(fname_out, mode='w') as fout:
+            json.dump(results, fout, indent=2)
+        print(f'Wrote {fname_out}')
+
+    if fname_baseline != None:
+        with open(fname_baseline) as fin:
+            baseline = json.load(fin)
+        regressions = compare(results, baseline)
+        if regressions:
+            print(f'\n{len(regressions)} measurement(s) more than '
+                  f'{THRESHOLD}x the baseline ({fname_baseline})')
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
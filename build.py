@@ -1,13 +1,34 @@
 """build.py: Builds a randomized database of Perusall annotations.
 
-This script expects two input CSV files on the command line, corresponding to
-two different years of Perusall annotations.  It builds and outputs two CSV
-files.  The first output file (`all-years.csv`) randomizes the conversations
-from the documents that were read in both years.  It also removes the instructor
-comments from all conversations; you must hardcode the instructors for each year
-into the `instructors` dictionary.  The second output file (`all-years.key.csv`)
-maps the conversations in the first output file back to their original years and
-keeps the data fields necessary for the statistics we want to calculate.
+This script expects two or more input CSV files on the command line, each
+corresponding to a different year of Perusall annotations.  It builds and
+outputs two CSV files.  The first output file (`all-years.csv`) randomizes the
+conversations from the documents that were read in every year.  The `-years`
+option restricts the output to a subset of the input years, in which case only
+the documents common to that subset matter; every input file is still read
+exactly once.  It also removes the instructor comments from all conversations;
+you must hardcode the instructors for each year into the `instructors`
+dictionary.  The second output file (`all-years.key.csv`) maps the conversations
+in the first output file back to their original years and keeps the data fields
+necessary for the statistics we want to calculate.  Alongside them, we write
+an index (`all-years.index`) of where each conversation starts in both files.
+Each student's name becomes a pseudonymous id that we keep in a persistent
+store (`annotations/students.sqlite`), so a student's id is the same in every
+build.
+
+Every build also writes a manifest (`all-years.manifest.json`) recording a hash
+of each input file, the documents kept, and the conversations emitted.  With
+the `-add` option, the script uses this manifest to add the conversations from
+one new year's input file to the existing output files: it parses only the new
+file, inserts its conversations at seeded random positions among the existing
+ones, and carries forward any coding already done.  In this incremental mode,
+we keep the documents recorded in the manifest rather than recomputing which
+documents every year read, since dropping a document would throw away coded
+conversations.
+
+With the `-memory` option, the script builds the same files without holding
+every comment in memory, sorting and shuffling on disk instead (see
+`external.py`).
 
 NOTE: The script expects to find the input files in a subdirectory called
 `annotations`.
@@ -16,10 +37,24 @@ Author: Mike Smith
 Date:   20210901
 """
 
+import io
+import os
 import sys
 import csv
+import locale
+import operator
+import itertools
+import json
 import random
-from overlap import overlap
+import hashlib
+import columnar
+import convindex
+import external
+import instrument
+import students
+from chunked import read_rows
+from ingest import ingest, split, catalog, stream_rows
+from overlap import years_mask, common_to
 
 """Format of the input and output CSV files
 
@@ -60,6 +95,12 @@ two field lists, not including the any fields filled in during coding.
 4: Document
 5: Authentic? -- coding field
 6: Rich discussion? -- coding field
+
+--- Fields in `all-years.manifest` JSON file ---
+inputs: a dictionary from input filename to the SHA-256 hash of its contents
+documents: the list of documents whose conversations we kept
+conversations: the list, in output order, of the anchor of each conversation,
+    which is [year, document, page number, range]
 """
 
 ###
@@ -84,27 +125,34 @@ fields = [2, 3, 6, 8, 9, 11, 13]
 ### Global variables
 ###
 
-# Filenames of the input annotation CSV files
-files = []
+FNAME_DATA = 'annotations/all-years.csv'
+FNAME_KEY = 'annotations/all-years.key.csv'
+FNAME_MANIFEST = 'annotations/all-years.manifest.json'
+FNAME_INDEX = 'annotations/all-years.index'
 
-# Header and records for all-years dataset
-header = []
-all_years = []
+# Headers of the `all-years` and `all-years.key` CSV files
+DATA_HEADER = ['Reply', 'Submission']
+KEY_HEADER = ['Year', 'Student ID', 'Replies', 'Upvotes', 'Document',
+              'Authentic?', 'Rich discussion?']
 
-# Keeps track of where each input file starts and ends in all_years
-start = {}
+# The fields of a comment in the all_years list that go into each file, and
+# the empty coding fields at the end of a key row
+DATA_FIELDS = operator.itemgetter(0, 2)
+KEY_FIELDS = operator.itemgetter(1, 3, 4, 5)
+UNCODED = ('', '')
 
-# Use a fixed random sequence when testing
-testing_seed = None
+# With `-memory`, the number of comments we strip and serialize at once
+BATCH = 10000
 
 ###
 ### Some helper functions
 ###
 
-def no_overlap(docs):
-    """Returns True if no overlapping documents were found"""
+def no_overlap(docs, years):
+    """Returns True if no document was found in every year in the bitmask
+       years"""
     for d in docs:
-        if docs[d] == 'both':
+        if common_to(docs[d], years):
             return False
     return True
 
@@ -128,212 +176,747 @@ def print_conversation(all_years, i):
     """Given a list of comments grouped into conversations and the index of
        the start of a conversation to print, print it.
     """
-    print(f'{i}: {all_years[i]}')
-    i += 1
-    while i < len(all_years) and all_years[i][0] == 1:
+    end = i + 1
+    while end < len(all_years) and all_years[end][0] == 1:
+        end += 1
+    print_comments(all_years[i:end], i)
+
+def print_comments(comments, i):
+    """Given the list of comments in a conversation and the index in all_years
+       of its first comment, print the conversation.
+    """
+    print(f'{i}: {comments[0]}')
+    for k, comment in enumerate(comments[1:], i + 1):
         # Print replies in conversation
-        print(f'    {i}: {all_years[i]}')
-        i += 1
-
-def write_conversation(all_years, i, data_writer, key_writer):
-    """Given a list of comments grouped into conversations and the index of the
-       start of a conversation to write, write it to both the data and key CSV
-       files.  In each file, write just the all-years fields specified in this
-       script's opening format comment.
+        print(f'    {k}: {comment}')
+
+def conversation_spans(starts, end, year):
+    """Given the indices at which each conversation starts in a list of
+       comments grouped into conversations, the length of that list, and the
+       year of its comments, return the span of each conversation, which is
+       the tuple `(begin, end, year)` giving its comments' slice of the list.
+    """
+    return [(s, e, year) for s, e in zip(starts, starts[1:] + [end])]
+
+def conversation_rows(all_years, span):
+    """Given a list of comments grouped into conversations and the span of a
+       conversation, return the list of `(d_row, k_row)` pairs we write for
+       that conversation to the data and key CSV files.  In each file, we write
+       just the all-years fields specified in this script's opening format
+       comment, plus any coding fields used in code.py.
+    """
+    begin, end, year = span
+    return [([comment[0], comment[2]],
+             [year, comment[1], comment[3], comment[4], comment[5], '', ''])
+            for comment in all_years[begin:end]]
+
+def serialize(conversations):
+    """Returns the pair `(buf, offsets)` for an iterable of conversations,
+       each an iterable of rows.  buf holds the rows written as CSV and encoded
+       just as `open()` would, and conversation k is `buf[offsets[k]:
+       offsets[k+1]]`.
+    """
+    text = io.StringIO(newline='')
+    csv_writer = csv.writer(text, delimiter=',', quotechar='"',
+                            quoting=csv.QUOTE_MINIMAL)
+    offsets = [0]
+    for rows in conversations:
+        csv_writer.writerows(rows)
+        offsets.append(text.tell())
+    text = text.getvalue()
+
+    # Offsets count characters, which are bytes only for ASCII text and when
+    # `open()` wouldn't translate newlines
+    encoding = locale.getpreferredencoding(False)
+    if text.isascii() and os.linesep == '\n':
+        return memoryview(text.encode(encoding)), offsets
+    blocks = [text[offsets[k]:offsets[k+1]].replace('\n', os.linesep)
+                  .encode(encoding) for k in range(len(offsets) - 1)]
+    offsets = [0] + list(itertools.accumulate(len(b) for b in blocks))
+    return memoryview(b''.join(blocks)), offsets
+
+def parse_range(s, parsed):
+    """Returns a canonical form of the Range field s, which describes a
+       comment's anchor in JSON.  Two Range strings describing the same anchor
+       have the same canonical form.  The dictionary parsed remembers the
+       answer for every Range string we've seen, since every reply repeats its
+       conversation's Range.
+    """
+    anchor = parsed.get(s)
+    if anchor == None:
+        try:
+            anchor = json.dumps(json.loads(s), sort_keys=True)
+        except ValueError:
+            anchor = s    # not JSON, so just use the string
+        parsed[s] = anchor
+    return anchor
+
+def by_created(e):
+    """Defines the sorting criteria for ordering the comments within a
+       conversation. The element is a record that follows the fields in
+       Perusall's original annotation file.  The Created field is a string that
+       sorts in time order.
+    """
+    return e[6]
+
+def group_conversations(rows):
+    """Given a list of records that follow the fields in Perusall's original
+       annotation file, pull the comments in each conversation together.  A
+       conversation is the set of comments sharing an anchor: the tuple of
+       Document, Page number, and parsed Range.  We hash each comment into the
+       bucket for its anchor in one pass, and then sort just within each bucket
+       by Created.  Conversations appear in the order in which their first
+       comment appears in rows.
+
+       Returns the tuple `(grouped, starts)`, where grouped is the list of
+       records in conversation order and starts is the list of indices into
+       grouped at which each conversation starts.
+    """
+    buckets = {}
+    parsed = {}
+    for row in rows:
+        anchor = (row[11], row[12], parse_range(row[13], parsed))
+        bucket = buckets.get(anchor)
+        if bucket == None:
+            buckets[anchor] = bucket = []
+        bucket.append(row)
+
+    grouped = []
+    starts = []
+    for bucket in buckets.values():
+        bucket.sort(key=by_created)
+        starts.append(len(grouped))
+        grouped += bucket
+    return grouped, starts
+
+def strip_fields(all_years, indices, store):
+    """Strip out unneeded fields from each comment in all_years, replace each
+       student with their id in the `students.StudentStore` store, and mark
+       those comments that are replies, given the list of indices of the
+       comments that start a conversation.
     """
-    # Grab the comment and its year
-    comment = all_years[i]
-    year = find_year(i)
-
-    # Write comment at index i across the two CSV files, plus any coding fields
-    # used in coding.py 
-    data_writer.writerow([comment[0], comment[2]])
-    key_writer.writerow([year, comment[1], comment[3], comment[4], comment[5],
-                         '', ''])
-
-    # Write out the replies, if any
-    i += 1
-    while i < len(all_years) and all_years[i][0] == 1:
-        comment = all_years[i]
-        data_writer.writerow([comment[0], comment[2]])
-        key_writer.writerow([year, comment[1], comment[3], comment[4], comment[5],
-                            '', ''])
-        i += 1
-
-def find_year(i):
-    """Given an index of a comment in all_years, return its filename (i.e.,
-       this comment's year, if we named our input files appropriately).
+    # Look up (or create) every student's id in one batch.  Our student ids
+    # are of the form `YYYYnnnnnn`, where `'YYYY'` is the year the student
+    # took the class (see `students.py`).
+    names = [(comment[0], comment[1], comment[6].split('-')[0])
+             for comment in all_years]
+    student_ids = store.ids(names)
+
+    conversation_starts = set(indices)
+    for i, comment in enumerate(all_years):
+        student_id = student_ids[names[i]]
+
+        # Delete fields not needed in our all-years files
+        del comment[12:]
+        del comment[10]
+        del comment[4:8]
+        del comment[0:3]
+
+        # Prepend our `Student ID` field
+        comment.insert(0, student_id)
+
+        # Then prepend `Reply` field
+        if i in conversation_starts:
+            # Current comment starts a new conversation
+            comment.insert(0, 0)
+        else:
+            # Current comment is a reply
+            comment.insert(0, 1)
+
+def write_all_years(conversations):
+    """Create the `all-years` and `all-years.key` CSV files with appropriate
+       headers, and cache both in columnar form for the scripts that follow.
+       The input is an iterable of conversations in output order, each a list
+       of `(d_row, k_row)` pairs.
     """
-    for fin in start:
-        index_start, index_end = start[fin]
-        if i >= index_start and i <= index_end:
-            return fin.split('.')[0]
-    raise ValueError('Index out of range')
-
-def by_conversation(e):
-    """Defines the sorting criteria for pulling comments into conversations. The
-       element is a record that follows the fields in Perusall's original
-       annotation file.  To build conversations, we sort by the following fields
-       in priority order: Document, Page number, Range, and Created, which are
-       all strings.
+    data_rows = []
+    key_rows = []
+    with open(FNAME_DATA, mode='w') as fout, \
+         open(FNAME_KEY, mode='w') as kout:
+        data_writer = csv.writer(fout, delimiter=',', quotechar='"',
+                                 quoting=csv.QUOTE_MINIMAL)
+        key_writer = csv.writer(kout, delimiter=',', quotechar='"',
+                                quoting=csv.QUOTE_MINIMAL)
+
+        # Write each file's header
+        data_writer.writerow(DATA_HEADER)
+        key_writer.writerow(KEY_HEADER)
+
+        # This phase includes producing the conversations when the caller
+        # passes a generator
+        with instrument.phase('write csv') as p:
+            for conversation in conversations:
+                for d_row, k_row in conversation:
+                    data_writer.writerow(d_row)
+                    key_writer.writerow(k_row)
+                    data_rows.append(d_row)
+                    key_rows.append(k_row)
+            p.rows = len(data_rows)
+
+    print(f'Wrote {FNAME_DATA} and {FNAME_KEY}')
+
+    with instrument.phase('save columnar', rows=len(data_rows)):
+        columnar.save_data(FNAME_DATA, DATA_HEADER, data_rows)
+        columnar.save_key(FNAME_KEY, KEY_HEADER, key_rows)
+
+    # Index where each conversation starts, so `code.py` can jump to it
+    with instrument.phase('build index', rows=len(data_rows)):
+        convindex.build_index(FNAME_DATA, FNAME_KEY, FNAME_INDEX)
+    print(f'Wrote {FNAME_INDEX}')
+
+def emit_all_years(all_years, spans):
+    """Create the same files as `write_all_years()`, given the list of comments
+       grouped into conversations and the list of the spans of the
+       conversations in output order.  We write each conversation's rows as
+       CSV just once, in the order of all_years, and then copy the byte range
+       of each conversation to the output files in the shuffled order.  Since
+       we know where every conversation lands, we also write the index without
+       rescanning the files.
     """
-    return e[11] + e[12] + e[13] + e[6]
+    # Write the fields each file keeps for every conversation, in all_years
+    # order, where block b holds the conversation in source[b]
+    with instrument.phase('serialize', rows=len(all_years)):
+        source = sorted(spans)
+        d_buf, d_offsets = serialize(map(DATA_FIELDS, all_years[b:e])
+                                     for b, e, year in source)
+        k_buf, k_offsets = serialize(((year,) + KEY_FIELDS(c) + UNCODED
+                                      for c in all_years[b:e])
+                                     for b, e, year in source)
+        d_header, _ = serialize([[DATA_HEADER]])
+        k_header, _ = serialize([[KEY_HEADER]])
+        block = {span[0]: b for b, span in enumerate(source)}
+        order = [block[span[0]] for span in spans]
+
+    with instrument.phase('write csv', rows=len(all_years)):
+        with open(FNAME_DATA, mode='wb') as fout:
+            fout.write(d_header)
+            fout.writelines(d_buf[d_offsets[b]:d_offsets[b+1]] for b in order)
+        with open(FNAME_KEY, mode='wb') as kout:
+            kout.write(k_header)
+            kout.writelines(k_buf[k_offsets[b]:k_offsets[b+1]] for b in order)
+    print(f'Wrote {FNAME_DATA} and {FNAME_KEY}')
+
+    with instrument.phase('save columnar', rows=len(all_years)):
+        columnar.save_data(FNAME_DATA, DATA_HEADER,
+                           [DATA_FIELDS(c) for b, e, year in spans
+                            for c in all_years[b:e]])
+        columnar.save_key(FNAME_KEY, KEY_HEADER,
+                          [(year,) + KEY_FIELDS(c) + UNCODED
+                           for b, e, year in spans for c in all_years[b:e]])
+
+    # Index where each conversation starts, so `code.py` can jump to it
+    with instrument.phase('build index', rows=len(all_years)):
+        comments = [end - begin for begin, end, year in spans]
+        entries = zip(
+            itertools.accumulate((d_offsets[b+1] - d_offsets[b] for b in order),
+                                 initial=len(d_header)),
+            itertools.accumulate((k_offsets[b+1] - k_offsets[b] for b in order),
+                                 initial=len(k_header)),
+            itertools.accumulate(comments, initial=1),
+            comments)
+        convindex.write_index(FNAME_DATA, FNAME_KEY, FNAME_INDEX, entries)
+    print(f'Wrote {FNAME_INDEX}')
+
+    d_buf.release()
+    k_buf.release()
+
+def spill_file(fname, f, docs, years, sorter):
+    """Stream the student comments on the documents in docs common to every
+       year in the bitmask years from input file fname, the f-th of those we
+       combine, into the `external.Sorter` sorter.  Each record is the pair
+       `(key, row)`, where the key puts the comments in the order that
+       `split()` followed by `group_conversations()` does: by file, by
+       document in the order each first appears, by conversation in the
+       order each first appears, by Created, and then by line.
+
+       Returns the pair `(comments, conversations)` of the number of each
+       that we added.
+    """
+    doc_rank = {}
+    anchors = {}
+    parsed = {}
+    comments = 0
+    for line, row in enumerate(stream_rows(f'annotations/{fname}')):
+        if line == 0:
+            continue
+        rank = doc_rank.setdefault(row[11], len(doc_rank))
+        if not common_to(docs[row[11]], years) or \
+           f'{row[0]}{row[1]}' in instructors[fname]:
+            continue
+        anchor = (row[11], row[12], parse_range(row[13], parsed))
+        seq = anchors.setdefault(anchor, len(anchors))
+        sorter.add(((f, rank, seq, row[6], line), row))
+        comments += 1
+    return comments, len(anchors)
+
+def sorted_conversations(sorter):
+    """Yield the pair `(f, comments)` for each conversation in the sorted
+       records of sorter (see `spill_file()`), where f is the number of the
+       conversation's input file"""
+    for key, records in itertools.groupby(sorter.sorted(),
+                                          key=lambda record: record[0][:3]):
+        yield key[0], [row for _, row in records]
+
+def batches(conversations, size):
+    """Yield lists of consecutive pairs from the iterable conversations (see
+       `sorted_conversations()`) holding about size comments each"""
+    batch = []
+    comments = 0
+    for conversation in conversations:
+        batch.append(conversation)
+        comments += len(conversation[1])
+        if comments >= size:
+            yield batch
+            batch = []
+            comments = 0
+    if batch:
+        yield batch
+
+def file_hash(fname):
+    """Returns the SHA-256 hash of the contents of file fname"""
+    h = hashlib.sha256()
+    with open(fname, mode='rb') as fin:
+        for block in iter(lambda: fin.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def write_manifest(manifest):
+    """Write the manifest describing the current all-years files"""
+    with open(FNAME_MANIFEST, mode='w') as fout:
+        json.dump(manifest, fout, indent=1)
+    print(f'Wrote {FNAME_MANIFEST}')
 
 ###
-### main
+### Main routines
 ###
 
-# Grab the input files -- FIXME: no input validation!
-if len(sys.argv) == 1:
-    # Prompt user for file and seed information
-    print('Enter 1st CSV file: ', end='')
-    files.append(input())
-    print('Enter 2nd CSV file: ', end='')
-    files.append(input())
-    print('Enter seed (0 uses current time): ', end='')
-    s = int(input())
-    testing_seed = s if s > 0 else None
-elif len(sys.argv) == 3:
-    files.append(sys.argv[1])
-    files.append(sys.argv[2])
-elif len(sys.argv) == 5:
-    files.append(sys.argv[1])
-    files.append(sys.argv[2])
-    testing_seed = int(sys.argv[4])
-else:
-    sys.exit('Usage: python3 build.py yr1.csv yr2.csv [-seed N]')
-
-# Figure out what documents the two years have in common
-print('--- Computing overlap')
-docs = overlap(files)
-if no_overlap(docs):
-    raise RuntimeError('No overlapping documents in input files')
-print('--- Building all-years')
-
-# Split each input csv file into ds-overlap and ds-unique while discarding
-# instructor records.
-for fname in files:
-    # Remember starting location of this input file in all_years
-    index_begin = len(all_years)
-
-    # Lists used for splitting one CSV file into the overlapping and
-    # non-overlapping documents across all CSV files.
-    ds_overlap = []
-    ds_unique = []
-
-    # Distribute student records into ds_overlap and ds_unique
-    with open(f'annotations/{fname}') as fin:
-        csv_reader = csv.reader(fin, delimiter=',')
-        line = 0
-
-        for row in csv_reader:
-            if line == 0:
-                header = process_header(row, header)
+def assemble(files, selected, testing_seed):
+    """Assemble the all-years dataset in memory
+
+    Input:   The list of input filenames, the list of those whose years we
+             combine, and the seed for the random shuffle (None uses the
+             current time)
+    Output:  A tuple `(all_years, spans, manifest)`.  all_years is the list
+             of comments, grouped into conversations and stripped of the
+             fields we don't keep, spans is the list of the span of each
+             conversation (see `conversation_spans()`) in output order, and
+             manifest is the dictionary we write to the manifest.
+    """
+    # Read each input file once, building the catalog of the years in which
+    # each document appears while buffering each file's rows by document
+    print('--- Computing overlap')
+    with instrument.phase('ingest') as p:
+        docs, headers, rows = ingest(files)
+        p.rows = sum(len(doc_rows) for by_doc in rows.values()
+                     for doc_rows in by_doc.values())
+    years = years_mask(files.index(fname) for fname in selected)
+    if no_overlap(docs, years):
+        raise RuntimeError('No overlapping documents in input files')
+    print('--- Building all-years')
+
+    # Header and records for all-years dataset
+    header = []
+    all_years = []
+
+    # Keeps track of where each input file starts and ends in all_years
+    start = {}
+
+    # The indices of those comments in all_years that begin a conversation,
+    # which is the list we'll randomize, and the anchor and span of each
+    # conversation
+    indices = []
+    anchors = {}
+    spans = {}
+
+    # Split each selected input file's rows into ds-overlap and ds-unique while
+    # discarding instructor records.
+    for fname in selected:
+        # Remember starting location of this input file in all_years
+        index_begin = len(all_years)
+
+        header = process_header(headers[fname], header)
+
+        # Lists used for splitting one CSV file into the overlapping and
+        # non-overlapping documents across all CSV files.
+        with instrument.phase(f'split {fname}') as p:
+            ds_overlap, ds_unique = split(rows[fname], docs, years,
+                                          files.index(fname))
+
+            # Make sure to skip any instructor comments
+            ds_overlap = [row for row in ds_overlap
+                          if f'{row[0]}{row[1]}' not in instructors[fname]]
+            ds_unique = [row for row in ds_unique
+                         if f'{row[0]}{row[1]}' not in instructors[fname]]
+            p.rows = len(ds_overlap) + len(ds_unique)
+
+        # Pull the comments in a converstion together
+        with instrument.phase(f'group {fname}', rows=len(ds_overlap)):
+            ds_overlap, starts = group_conversations(ds_overlap)
+
+        # Append ds-overlap to all-years, remembering where its conversations
+        # start, what they annotate, and their year
+        year = fname.split('.')[0]
+        for s in starts:
+            row = ds_overlap[s]
+            indices.append(index_begin + s)
+            anchors[index_begin + s] = [year, row[11], row[12], row[13]]
+        for span in conversation_spans(starts, len(ds_overlap), year):
+            spans[index_begin + span[0]] = (index_begin + span[0],
+                                            index_begin + span[1], year)
+        all_years += ds_overlap
+
+        # Record beginning and ending location of input file in all_years
+        start[fname] = [index_begin, len(all_years)-1]
+
+        # Currently, we do nothing with ds_unique.  It exists at this point in
+        # the script in case we decide later to analyze this data.
+
+    # Report out the count of comments in all_years
+    num_comments = len(all_years)
+    print(f'{num_comments} student annotations in all-years')
+    print(f'Layout: {start}')
+
+    with instrument.phase('strip fields', rows=num_comments):
+        store = students.StudentStore()
+        strip_fields(all_years, indices, store)
+        store.close()
+    num_conversations = len(indices)
+    print(f'{num_conversations} conversations in all-years')
+
+    print('Head of CONCATENATED dataset:')
+    for c in range(3):  # print 3 conversations
+        print(f'  {c}/', end='')
+        print_conversation(all_years, indices[c])
+
+    # Randomize the order of the conversations in all_years by
+    # randomizing the list of conversation indices.
+    with instrument.phase('shuffle', rows=len(indices)):
+        random.seed(testing_seed)
+        random.shuffle(indices)
+
+    print('Head of RANDOMIZED dataset')
+    for c in range(3):  # print the first 3 conversations
+        print(f'  {c}/', end='')
+        print_conversation(all_years, indices[c])
+
+    # Both files use the same randomized order
+    spans = [spans[i] for i in indices]
+
+    with instrument.phase('manifest', rows=len(indices)):
+        manifest = {
+            'inputs': {fname: file_hash(f'annotations/{fname}')
+                       for fname in selected},
+            'documents': [doc for doc in docs if common_to(docs[doc], years)],
+            'conversations': [anchors[i] for i in indices],
+        }
+    return all_years, spans, manifest
+
+def build(files, selected, testing_seed):
+    """Build the all-years files from scratch
+
+    Input:   The list of input filenames, the list of those whose years we
+             combine, and the seed for the random shuffle (None uses the
+             current time)
+    """
+    all_years, spans, manifest = assemble(files, selected, testing_seed)
+    emit_all_years(all_years, spans)
+    write_manifest(manifest)
+
+def build_external(files, selected, testing_seed, budget):
+    """Build the same all-years files as `build()`, holding at most about
+       budget bytes of comments in memory
+
+    We stream each input file twice: once to catalog its documents and once to
+    feed an external merge sort that puts its comments into conversations.
+    As the sorted conversations stream past, we strip and serialize them and
+    scatter them into buckets by their shuffled position, and then we gather
+    the buckets in order to write the files.  We shuffle the conversation
+    numbers just as `assemble()` shuffles its indices, so both produce the
+    same files for the same seed.  We keep a few numbers and the manifest
+    entry for each conversation in memory, but never its comments.  We don't
+    write columnar caches, since they need every row at once, so the scripts
+    that follow read the CSV files.
+    """
+    print('--- Computing overlap')
+    with instrument.phase('catalog'):
+        docs, headers = catalog(files)
+    years = years_mask(files.index(fname) for fname in selected)
+    if no_overlap(docs, years):
+        raise RuntimeError('No overlapping documents in input files')
+    print('--- Building all-years')
+
+    header = []
+    start = {}
+    num_comments = 0
+    num_conversations = 0
+    with external.spill_dir() as tmpdir:
+        # Sort the comments of every selected file into conversations
+        sorter = external.Sorter(operator.itemgetter(0), budget, tmpdir)
+        for f, fname in enumerate(selected):
+            header = process_header(headers[fname], header)
+            with instrument.phase(f'sort {fname}') as p:
+                comments, conversations = spill_file(fname, f, docs, years,
+                                                     sorter)
+                p.rows = comments
+            start[fname] = [num_comments, num_comments + comments - 1]
+            num_comments += comments
+            num_conversations += conversations
+        print(f'{num_comments} student annotations in all-years')
+        print(f'Layout: {start}')
+        print(f'{num_conversations} conversations in all-years')
+        print(f'Sorted in {max(1, len(sorter.runs))} runs')
+
+        # Shuffle the conversation numbers as `assemble()` shuffles indices
+        with instrument.phase('shuffle', rows=num_conversations):
+            order = list(range(num_conversations))
+            random.seed(testing_seed)
+            random.shuffle(order)
+            position = [0] * num_conversations
+            for k, c in enumerate(order):
+                position[c] = k
+            del order
+
+        # Strip and serialize each conversation, and scatter it to the bucket
+        # for its position.  We hold on to the first few conversations in
+        # each order to print them.
+        shuffler = external.Shuffler(num_conversations, sorter.total, budget,
+                                     tmpdir)
+        concatenated = []
+        randomized = {}
+        store = students.StudentStore()
+        with instrument.phase('scatter', rows=num_comments):
+            c = 0    # conversation number
+            i = 0    # index of its first comment in all-years
+            for batch in batches(sorted_conversations(sorter), BATCH):
+                rows = []
+                spans = []
+                anchors = []
+                for f, comments in batch:
+                    year = selected[f].split('.')[0]
+                    head = comments[0]
+                    anchors.append([year, head[11], head[12], head[13]])
+                    spans.append((len(rows), len(rows) + len(comments), year))
+                    rows += comments
+                strip_fields(rows, [b for b, e, year in spans], store)
+                d_buf, d_offsets = serialize(map(DATA_FIELDS, rows[b:e])
+                                             for b, e, year in spans)
+                k_buf, k_offsets = serialize(((year,) + KEY_FIELDS(comment)
+                                              + UNCODED
+                                              for comment in rows[b:e])
+                                             for b, e, year in spans)
+                for j, (b, e, year) in enumerate(spans):
+                    shuffler.add(position[c], (
+                        d_buf[d_offsets[j]:d_offsets[j+1]].tobytes(),
+                        k_buf[k_offsets[j]:k_offsets[j+1]].tobytes(),
+                        e - b, anchors[j]))
+                    if c < 3:
+                        concatenated.append((i, rows[b:e]))
+                    if position[c] < 3:
+                        randomized[position[c]] = (i, rows[b:e])
+                    c += 1
+                    i += e - b
+        store.close()
+        del position
+
+        print('Head of CONCATENATED dataset:')
+        for c, (i, comments) in enumerate(concatenated):
+            print(f'  {c}/', end='')
+            print_comments(comments, i)
+        print('Head of RANDOMIZED dataset')
+        for c in sorted(randomized):
+            print(f'  {c}/', end='')
+            print_comments(randomized[c][1], randomized[c][0])
+
+        # Gather the conversations in their shuffled order, noting where each
+        # lands for the index
+        d_header, _ = serialize([[DATA_HEADER]])
+        k_header, _ = serialize([[KEY_HEADER]])
+        entries = []
+        conversations = []
+        with instrument.phase('gather', rows=num_comments), \
+             open(FNAME_DATA, mode='wb') as fout, \
+             open(FNAME_KEY, mode='wb') as kout:
+            fout.write(d_header)
+            kout.write(k_header)
+            d_offset = len(d_header)
+            k_offset = len(k_header)
+            record = 1
+            for _, (d_bytes, k_bytes, comments, anchor) in shuffler.gathered():
+                entries.append((d_offset, k_offset, record, comments))
+                conversations.append(anchor)
+                fout.write(d_bytes)
+                kout.write(k_bytes)
+                d_offset += len(d_bytes)
+                k_offset += len(k_bytes)
+                record += comments
+    print(f'Wrote {FNAME_DATA} and {FNAME_KEY}')
+
+    # Any caches left from an earlier build no longer match the CSV files
+    columnar.discard(FNAME_DATA)
+    columnar.discard(FNAME_KEY)
+
+    with instrument.phase('build index', rows=num_comments):
+        convindex.write_index(FNAME_DATA, FNAME_KEY, FNAME_INDEX, entries)
+    print(f'Wrote {FNAME_INDEX}')
+
+    with instrument.phase('manifest', rows=num_conversations):
+        write_manifest({
+            'inputs': {fname: file_hash(f'annotations/{fname}')
+                       for fname in selected},
+            'documents': [doc for doc in docs if common_to(docs[doc], years)],
+            'conversations': conversations,
+        })
+
+def read_conversations():
+    """Returns the list of conversations in the existing all-years files, each
+       a list of `(d_row, k_row)` pairs, including any coding"""
+    conversations = []
+    data_reader = columnar.read_data(FNAME_DATA)
+    key_reader = columnar.read_key(FNAME_KEY)
+    next(data_reader)    # skip over headers
+    next(key_reader)
+    for d_row, k_row in zip(data_reader, key_reader):
+        if d_row[0] == '0':
+            conversations.append([])
+        conversations[-1].append((d_row, k_row))
+    return conversations
+
+def add(fname, testing_seed):
+    """Add the conversations from one new input file to the all-years files
+
+    Input:   The new input filename and the seed for choosing where its
+             conversations go (None uses the current time)
+    Assumes: The all-years files and their manifest exist, we haven't
+             already added a file for this year, and none of the inputs
+             still in `annotations` changed since we built from them.
+    """
+    with open(FNAME_MANIFEST) as fin:
+        manifest = json.load(fin)
+    year = fname.split('.')[0]
+    if any(f.split('.')[0] == year for f in manifest['inputs']):
+        sys.exit(f'Already built all-years with a file for {year}')
+
+    # The existing conversations came from the inputs as the manifest hashed
+    # them, so an input edited since then needs a full rebuild.  We don't
+    # parse the old inputs, so we needn't have them all on hand.
+    for f, h in manifest['inputs'].items():
+        if os.path.exists(f'annotations/{f}') and \
+           file_hash(f'annotations/{f}') != h:
+            sys.exit(f'{f} changed since all-years was built from it; '
+                     'rebuild needed')
+    documents = set(manifest['documents'])
+    emitted = set(tuple(anchor) for anchor in manifest['conversations'])
+
+    # Parse just the new file, keeping student comments on the documents
+    # already in all-years
+    print(f'--- Adding {fname} to all-years')
+    with instrument.phase(f'read {fname}') as p:
+        rows = read_rows(f'annotations/{fname}')
+        process_header(rows[0], [])
+        new_rows = [row for row in rows[1:] if row[11] in documents
+                    and f'{row[0]}{row[1]}' not in instructors[fname]]
+        p.rows = len(rows)
+    print(f'Processed {len(rows)} lines in {fname}')
+
+    # Pull its comments into conversations, skipping any already emitted
+    with instrument.phase(f'group {fname}', rows=len(new_rows)):
+        new_years, starts = group_conversations(new_rows)
+    anchors = [[year, new_years[s][11], new_years[s][12], new_years[s][13]]
+               for s in starts]
+    store = students.StudentStore()
+    strip_fields(new_years, starts, store)
+    store.close()
+    new = [(anchor, conversation_rows(new_years, span))
+           for anchor, span in zip(anchors, conversation_spans(
+               starts, len(new_years), year))
+           if tuple(anchor) not in emitted]
+    print(f'{len(new)} new conversations')
+
+    # Choose the positions of the new conversations in the combined order, and
+    # then merge them with the existing conversations
+    with instrument.phase('read all-years') as p:
+        conversations = read_conversations()
+        p.rows = sum(len(conversation) for conversation in conversations)
+    if len(conversations) != len(manifest['conversations']):
+        raise RuntimeError(f'{FNAME_DATA} does not match {FNAME_MANIFEST}')
+    old = iter(zip(manifest['conversations'], conversations))
+    total = len(conversations) + len(new)
+    random.seed(testing_seed)
+    random.shuffle(new)
+    slots = set(random.sample(range(total), len(new)))
+    new = iter(new)
+    merged = [next(new) if k in slots else next(old) for k in range(total)]
+    print(f'{len(merged)} conversations in all-years')
+
+    write_all_years(conversation for anchor, conversation in merged)
+
+    manifest['inputs'][fname] = file_hash(f'annotations/{fname}')
+    manifest['conversations'] = [anchor for anchor, conversation in merged]
+    write_manifest(manifest)
+
+
+def main():
+    # Filenames of the input annotation CSV files
+    files = []
+
+    # Filenames of the input files whose years we combine into all_years. By
+    # default, this is every input file.
+    selected = []
+
+    # The new input file to add incrementally, if any
+    added = None
+
+    # Use a fixed random sequence when testing
+    testing_seed = None
+
+    # The memory budget in bytes for building out of core, if any
+    budget = None
+
+    # Grab the input files -- FIXME: no input validation!
+    usage = ('Usage: python3 build.py yr1.csv yr2.csv ... [-seed N] '
+             '[-years Y1,Y2,...] [-memory MB]\n'
+             '       python3 build.py -add yr.csv [-seed N]')
+    if len(sys.argv) == 1:
+        # Prompt user for file and seed information
+        print('Enter CSV files separated by spaces: ', end='')
+        files += input().split()
+        print('Enter seed (0 uses current time): ', end='')
+        s = int(input())
+        testing_seed = s if s > 0 else None
+    else:
+        args = sys.argv[1:]
+        while args:
+            arg = args.pop(0)
+            if arg == '-seed' and args:
+                testing_seed = int(args.pop(0))
+            elif arg == '-years' and args:
+                for yr in args.pop(0).split(','):
+                    selected.append(f'{yr}.csv')
+            elif arg == '-add' and args:
+                added = args.pop(0)
+            elif arg == '-memory' and args:
+                budget = int(args.pop(0)) * 1024 * 1024
+            elif arg.startswith('-'):
+                sys.exit(usage)
             else:
-                # Make sure to skip any instructor comments
-                if f'{row[0]}{row[1]}' not in instructors[fname]:
-                    if docs[row[11]] == 'both':
-                        ds_overlap.append(row)
-                    else:
-                        ds_unique.append(row)
-            line += 1
-
-    print(f'Processed {line} lines in {fname}')
-
-    # Pull the comments in a converstion together
-    ds_overlap.sort(key=by_conversation)
-
-    # Append ds-overlap to all-years
-    all_years += ds_overlap
-
-    # Record beginning and ending location of input file in all_years
-    start[fname] = [index_begin, len(all_years)-1]
-
-    # Currently, we do nothing with ds_unique.  It exists at this point in the
-    # script in case we decide later to analyze this data.
-
-# Report out the count of comments in all_years
-num_comments = len(all_years)
-print(f'{num_comments} student annotations in all-years')
-print(f'Layout: {start}')
-
-# Strip out unneeded fields from each comment in all_years, compute a unique
-# student-id for our own uses, mark those comments that are replies, and
-# remember the indices of those comments that begin a conversation, which is the
-# list we'll randomize.
-prev_range = None
-students = {}
-next_student_suffix = 0
-num_conversations = 0
-indices = []
-for i, comment in enumerate(all_years):
-    # Remember the Range-in-Document before we delete it
-    cur_range = comment[13] + comment[11] + comment[12]
-
-    # Compute a unique student-id for our use.  Our student ids are of the form
-    # `YYYYssss` where `'YYYY'` is the year the student took the class and
-    # `'ssss'` is the 4-digit unique suffix for this student.  This approach
-    # assumes that we will never have more than 1000 students combined in any
-    # two years.
-    year = comment[6].split('-')[0]
-    student = comment[0] + comment[1] + year
-    student_id = students.get(student)
-    if student_id == None:
-        student_id = int(year) * 1000 + next_student_suffix
-        students[student] = student_id
-        next_student_suffix += 1
-
-    # Delete fields not needed in our all-years files
-    del comment[12:]
-    del comment[10]
-    del comment[4:8]
-    del comment[0:3]
-
-    # Prepend our `Student ID` field
-    comment.insert(0, student_id)
-
-    # Then prepend `Reply` field
-    if cur_range == prev_range:
-        # Current comment is a reply
-        comment.insert(0, 1)
+                files.append(arg)
+
+    if added != None:
+        if files != [] or selected != [] or budget != None:
+            sys.exit(usage)
+        add(added, testing_seed)
+        return
+
+    if len(files) < 2:
+        sys.exit(usage)
+    if selected == []:
+        selected = files
+    elif len(selected) < 2 or any(fname not in files for fname in selected):
+        sys.exit(usage)
+    if budget != None:
+        build_external(files, selected, testing_seed, budget)
     else:
-        # Current comment starts a new conversation
-        comment.insert(0, 0)
-        num_conversations += 1
-        indices.append(i)
-    prev_range = cur_range
-print(f'{num_conversations} conversations in all-years')
-
-print('Head of CONCATENATED dataset:')
-for c in range(3):  # print 3 conversations
-    print(f'  {c}/', end='')
-    print_conversation(all_years, indices[c])
-
-# Randomize the order of the conversations in all_years by
-# randomizing the list of conversation indices.
-random.seed(testing_seed)
-random.shuffle(indices)
-
-print('Head of RANDOMIZED dataset')
-for c in range(3):  # print the first 3 conversations
-    print(f'  {c}/', end='')
-    print_conversation(all_years, indices[c])
-
-# Create the `all-years` and `all-years.key` CSV files with
-# appropriate headers.  Both files use the same randomized order.
-with open('annotations/all-years.csv', mode='w') as fout, \
-     open('annotations/all-years.key.csv', mode='w') as kout:
-    data_writer = csv.writer(fout, delimiter=',', quotechar='"',
-                             quoting=csv.QUOTE_MINIMAL)
-    key_writer = csv.writer(kout, delimiter=',', quotechar='"',
-                            quoting=csv.QUOTE_MINIMAL)
-
-    # Write each file's header
-    data_writer.writerow(['Reply', 'Submission'])
-    key_writer.writerow(['Year', 'Student ID', 'Replies', 'Upvotes', 'Document',
-                         'Authentic?', 'Rich discussion?'])
-
-    for c in range(num_conversations):
-        write_conversation(all_years, indices[c], data_writer, key_writer)
+        build(files, selected, testing_seed)
 
-print('Wrote annotations/all-years.csv and annotations/all-years.key.csv')
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+""" chunked.py: Parse a large Perusall-annotation CSV file in parallel
+
+We split the file into byte ranges that each begin and end on a record
+boundary, parse each range in a pool of processes, and merge the rows back
+together in their original order.  Finding a safe boundary takes care, since
+the Submission and Range fields contain quoted newlines and commas.  A newline
+ends a record only if it follows an even number of double quotes: every quoted
+field contributes an opening and a closing quote, and every escaped quote
+inside a field is doubled.
+
+Author: Mike Smith
+Date:   20261017
+"""
+
+import io
+import os
+import csv
+import multiprocessing
+
+###
+### Global variables
+###
+
+# Files smaller than this many bytes aren't worth splitting
+PARALLEL_THRESHOLD = 64 * 1024 * 1024
+
+# How many bytes we read at a time while scanning for boundaries
+BLOCK_SIZE = 1024 * 1024
+
+###
+### Some helper functions
+###
+
+def count_quotes(fin, n):
+    """Returns the number of double quotes in the next n bytes of fin"""
+    quotes = 0
+    while n > 0:
+        block = fin.read(min(n, BLOCK_SIZE))
+        if not block:
+            break
+        quotes += block.count(b'"')
+        n -= len(block)
+    return quotes
+
+def next_boundary(fin, pos, quotes, size):
+    """Returns the offset just past the first newline at or after pos that ends
+       a record, given that there are quotes double quotes before pos"""
+    fin.seek(pos)
+    while True:
+        block = fin.read(BLOCK_SIZE)
+        if not block:
+            return size
+        i = 0
+        while True:
+            nl = block.find(b'\n', i)
+            if nl < 0:
+                break
+            quotes += block.count(b'"', i, nl)
+            if quotes % 2 == 0:
+                return pos + nl + 1
+            i = nl + 1
+        quotes += block.count(b'"', i)
+        pos += len(block)
+
+def find_boundaries(fname, num_ranges):
+    """Returns the list of offsets that split file fname into at most
+       num_ranges byte ranges on record boundaries.  The list starts with 0
+       and ends with the size of the file."""
+    size = os.path.getsize(fname)
+    bounds = [0]
+    with open(fname, mode='rb') as fin:
+        pos = 0       # where we've counted quotes up to
+        quotes = 0    # double quotes in the file before pos
+        for k in range(1, num_ranges):
+            target = size * k // num_ranges
+            if target <= bounds[-1]:
+                continue
+            fin.seek(pos)
+            quotes += count_quotes(fin, target - pos)
+            pos = target
+            boundary = next_boundary(fin, pos, quotes, size)
+            if boundary >= size:
+                break
+            bounds.append(boundary)
+    bounds.append(size)
+    return bounds
+
+def record_starts(fname):
+    """Returns the list of byte offsets at which each record of CSV file fname
+       starts, header included"""
+    starts = [0]
+    pos = 0       # offset of the current block in the file
+    quotes = 0    # double quotes in the file before the current newline
+    with open(fname, mode='rb') as fin:
+        while True:
+            block = fin.read(BLOCK_SIZE)
+            if not block:
+                break
+            i = 0
+            while True:
+                nl = block.find(b'\n', i)
+                if nl < 0:
+                    break
+                quotes += block.count(b'"', i, nl)
+                if quotes % 2 == 0:
+                    starts.append(pos + nl + 1)
+                i = nl + 1
+            quotes += block.count(b'"', i)
+            pos += len(block)
+    if starts[-1] == pos:
+        starts.pop()    # the file ends with a newline
+    return starts
+
+def parse_range(task):
+    """Returns the list of rows in the byte range `(fname, begin, end)`.  We
+       decode the bytes just as `open()` would, universal newlines and all."""
+    fname, begin, end = task
+    with open(fname, mode='rb') as fin:
+        fin.seek(begin)
+        data = fin.read(end - begin)
+    text = io.TextIOWrapper(io.BytesIO(data))
+    return list(csv.reader(text, delimiter=','))
+
+###
+### Main routine
+###
+
+def read_rows(fname, processes=None):
+    """Returns the list of every row in the CSV file fname, header included, in
+       file order
+
+    If processes is None, we use one process per CPU for files of at least
+    `PARALLEL_THRESHOLD` bytes and parse smaller files serially.  We need the
+    `fork` start method, since the scripts calling us don't guard their main
+    code from being rerun when a spawned worker imports them; without it, we
+    also parse serially.
+    """
+    if processes is None:
+        big = os.path.getsize(fname) >= PARALLEL_THRESHOLD
+        processes = os.cpu_count() if big else 1
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        processes = 1
+
+    if processes <= 1:
+        with open(fname) as fin:
+            return list(csv.reader(fin, delimiter=','))
+
+    bounds = find_boundaries(fname, processes)
+    tasks = [(fname, bounds[k], bounds[k+1]) for k in range(len(bounds) - 1)]
+    with multiprocessing.get_context('fork').Pool(processes) as pool:
+        chunks = pool.map(parse_range, tasks)
+    return [row for chunk in chunks for row in chunk]
@@ -3,13 +3,22 @@
 The script allows the coder to stop and restart, but they must always
 finish coding a conversation before being given the option to stop.
 
+Each coding decision is appended to a journal as soon as the coder makes it.
+When the session ends, we write back the key rows of just the conversations
+coded, using the conversation index that `build.py` writes.  If the session
+ends any other way (a crash or a Ctrl-C), the next session folds in the journal
+before it starts, so no coding is lost.
+
 Author: Mike Smith
 Date:   20210902
 """
 
+import os
 import sys
-import csv
 import textwrap
+import convindex
+import instrument
+import journal
 
 """Format of the randomized Perusall-annotation CSV files
 --- Fields in `all-years` CSV file ---
@@ -32,14 +41,18 @@ import textwrap
 
 FNAME_DATA = 'annotations/all-years.csv'
 FNAME_KEY = 'annotations/all-years.key.csv'
-
-# By default, we discard any existing coding in the key file. If
-# you set this variable to False, coding will begin wherever we
-# left off. Coding always starts from the top of the file down.
+FNAME_JOURNAL = 'annotations/all-years.journal.csv'
+FNAME_INDEX = 'annotations/all-years.index'
+
+# By default, we discard any existing coding in the key file and code
+# every conversation from the top.  With `-keep`, coding begins wherever
+# we left off: we start at the resume point saved in the index and skip
+# over any conversations that are already coded, which is what we find
+# after `build.py -add` inserts a new year.  With `-conv N` or `-conv N-M`,
+# we recode just conversation N, or conversations N through M.
 overwrite = True
-
-# Where we collect the updated key data
-new_key_data = []
+first_conv = 1
+last_conv = None
 
 ###
 ### Some helper functions
@@ -49,6 +62,17 @@ def starts_conversation(comment):
     """Returns True if this comment starts a conversation"""
     return comment[0] == '0'
 
+def is_coded(k_rows):
+    """Returns True if every comment in a conversation's key rows is coded"""
+    return all(k_row[5] != '' and k_row[6] != '' for k_row in k_rows)
+
+def ask(prompt):
+    """Returns the coder's answer to prompt, asking again if it's empty"""
+    while True:
+        ans = input(prompt)
+        if ans != '':
+            return ans
+
 def my_pprint(comment, wrapper):
     """Print a comment using the line wrapper provided"""
     wrapped = wrapper.wrap(comment)
@@ -62,118 +86,107 @@ def my_pprint(comment, wrapper):
 # Grab any options on command line
 if len(sys.argv) == 2 and sys.argv[1] == '-keep':
     overwrite = False
-elif len(sys.argv) > 2:
-    sys.exit("Usage: python3 code.py [-keep]")
-
-# Perform coding
-with open(FNAME_DATA) as fdata, \
-     open(FNAME_KEY) as fkey:
-    data_reader = csv.reader(fdata, delimiter=',')
-    key_reader = csv.reader(fkey, delimiter=',')
-    wrapper = textwrap.TextWrapper(width=60, initial_indent='  ',
-                                subsequent_indent='  ')
-
-    # Note: record count is 0-based and conversation count is not
-    record = 0    # an index into a CSV file
-    c = 0         # conversation number (starts at 1)
-
-    # Handle header record
+elif len(sys.argv) == 3 and sys.argv[1] == '-conv':
     try:
-        d_row = next(data_reader)
-        k_row = next(key_reader)
-        new_key_data.append(k_row)
-        record += 1
-    except StopIteration:
-        raise RuntimeError('Unexpected empty CSV file')
-
-    if not overwrite:
-        # Skip forward until we find uncoded records
-        while True:
-            try:
-                d_row = next(data_reader)
-                k_row = next(key_reader)
-            except StopIteration:
-                raise RuntimeError('Dataset is fully coded')
-
-            if k_row[5] == '':
-                # Break out of infinite loop so we can code this comment,
-                # which should start a conversation.
-                assert(starts_conversation(d_row))
-                break
-            else:
-                new_key_data.append(k_row)
-                if starts_conversation(d_row):
-                    c += 1
-                record += 1
-    else:
-        # Prepare to begin coding
-        try:
-            d_row = next(data_reader)
-            k_row = next(key_reader)
-            assert(starts_conversation(d_row))
-        except StopIteration:
-            raise RuntimeError('Nothing but a header in CSV file')
-
-    # Avoid prompting unnecessarily as we start coding
-    last_k_row = None
-
-    # Code remaining comments
+        bounds = [int(n) for n in sys.argv[2].split('-')]
+    except ValueError:
+        sys.exit("Usage: python3 code.py [-keep | -conv N[-M]]")
+    first_conv, last_conv = bounds[0], bounds[-1]
+elif len(sys.argv) > 1:
+    sys.exit("Usage: python3 code.py [-keep | -conv N[-M]]")
+
+# Fold in any coding from a session that didn't end cleanly
+with instrument.phase('compact journal'):
+    recovered = journal.compact(FNAME_JOURNAL, FNAME_KEY)
+if recovered > 0:
+    print(f'Recovered {recovered} coding decisions from {FNAME_JOURNAL}')
+
+with instrument.phase('open index'):
+    index = convindex.ConversationIndex(FNAME_DATA, FNAME_KEY, FNAME_INDEX)
+if index.num_conversations == 0:
+    raise RuntimeError('Nothing but a header in CSV file')
+if last_conv == None:
+    last_conv = index.num_conversations
+if first_conv < 1 or first_conv > last_conv or \
+   last_conv > index.num_conversations:
+    sys.exit(f'Conversations run from 1 to {index.num_conversations}')
+
+if not overwrite:
+    # Skip forward from the resume point until we find an uncoded conversation
+    first_conv = index.resume
     while True:
-        if starts_conversation(d_row):
-            if last_k_row != None:
-                # Grab the `rich` coding for the last conversation
-                ans = input('Rich discussion? ')
-                last_k_row[6] = ans
-
-            # Stuff we do at the start of a conversation
-            c += 1
-            last_k_row = k_row
-            print('')
-        else:
+        if first_conv > last_conv:
+            raise RuntimeError('Dataset is fully coded')
+        _, _, k_rows = index.conversation(first_conv)
+        if not is_coded(k_rows):
+            break
+        first_conv += 1
+
+log = journal.Journal(FNAME_JOURNAL)
+wrapper = textwrap.TextWrapper(width=60, initial_indent='  ',
+                               subsequent_indent='  ')
+
+# Where we collect the updated key rows of conversations first_conv to c - 1
+new_key_data = []
+
+# Perform coding
+c = first_conv    # conversation number (starts at 1)
+stopped = False
+while c <= last_conv and not stopped:
+    record, d_rows, k_rows = index.conversation(c)
+
+    if not overwrite and is_coded(k_rows):
+        # This conversation was coded before `build.py -add` inserted new
+        # conversations around it, so keep its coding
+        new_key_data.extend(k_rows)
+        c += 1
+        continue
+
+    print('')
+    for i, (d_row, k_row) in enumerate(zip(d_rows, k_rows)):
+        if not starts_conversation(d_row):
             print('REPLY in ', end='')
 
         # Prompt user to code this comment
-        print(f'Conversation #{c}, comment #{record}:')
+        print(f'Conversation #{c}, comment #{record + i}:')
         my_pprint(d_row[1], wrapper)
 
         # Grab the authenticity coding, or quit if at start of a conversation
         if starts_conversation(d_row):
-            ans = input('Authentic [type `q` to stop]? ')
+            ans = ask('Authentic [type `q` to stop]? ')
             if ans == 'q':
-                # Move this and any subsequent key rows
-                new_key_data.append(k_row)
-                while True:
-                    try:
-                        k_row = next(key_reader)
-                        new_key_data.append(k_row)
-                    except StopIteration:
-                        break  # out of the inner infinite loop
-                break          # out of the outer infinite loop
+                stopped = True
+                break
         else:
-            ans = input('Authentic? ')
+            ans = ask('Authentic? ')
         k_row[5] = ans
         k_row[6] = 0    # always fill every field
-
-        # Done with coding this comment
-        new_key_data.append(k_row)
-        record += 1
-
-        # Try to grab the next record and loop back
-        try:
-            d_row = next(data_reader)
-            k_row = next(key_reader)
-        except StopIteration:
-            # Code and record the quality of the last discussion
-            ans = input('Rich discussion? ')
-            last_k_row[6] = ans
-            print('')
-            break    # all records have been coded
-
-# Write out the updated key data
-with open(FNAME_KEY, mode='w') as kout:
-    csv_writer = csv.writer(kout, delimiter=',', quotechar='"',
-                            quoting=csv.QUOTE_MINIMAL)
-    for k_row in new_key_data:
-        csv_writer.writerow(k_row)
+        log.record(c, record + i, ans)
+
+    if not stopped:
+        # Code and record the quality of the discussion
+        ans = ask('Rich discussion? ')
+        k_rows[0][6] = ans
+        log.close_conversation(c, record, ans)
+        new_key_data.extend(k_rows)
+        c += 1
+
+if not stopped:
+    print('')
+
+# Write back the key rows of just the conversations we handled, which now hold
+# everything in the journal
+if new_key_data:
+    with instrument.phase('write back', rows=len(new_key_data)):
+        index.write_back(first_conv, c - 1, new_key_data)
+log.close()
+os.remove(FNAME_JOURNAL)
+
+# Every conversation before c is now coded, unless we recoded a later range.
+# With `-keep`, we started at the resume point and skipped over only coded
+# conversations.
+if not overwrite or first_conv <= index.resume:
+    index.set_resume(max(c, index.resume))
+index.close()
 
 print(f'Wrote {FNAME_KEY}')
@@ -0,0 +1,302 @@
+""" columnar.py: Typed, columnar caches of the `all-years` CSV files
+
+Every script after `build.py` reads `all-years.csv` and `all-years.key.csv` in
+lockstep and converts fields one row at a time.  Whenever a script writes one of
+these CSV files, it also writes a NumPy `.npz` cache next to it (e.g.,
+`all-years.key.npz`) holding the same records as typed columns.  Readers use
+the cache instead of parsing the CSV whenever the cache is at least as new as
+the CSV, so a hand edit of a CSV file is never ignored.
+
+The caches are an optimization only.  If NumPy isn't installed, we neither
+write nor read them, and everything falls back to the CSV files.
+
+Author: Mike Smith
+Date:   20261017
+"""
+
+import io
+import os
+import csv
+import shutil
+import zipfile
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""Format of the columnar caches
+--- Columns in `all-years` cache ---
+reply: int8 -- 1 if the comment is a reply, else 0
+submission_offsets, submission_bytes: the UTF-8 text of each comment, where
+    comment i is `submission_bytes[submission_offsets[i]:submission_offsets[i+1]]`
+header: the CSV header row
+
+--- Columns in `all-years.key` cache ---
+year: int32, student: int64, replies: int32, upvotes: int32
+document: int32 -- index into the document vocabulary
+document_offsets, document_bytes: the vocabulary, encoded like submissions
+authentic: int8, rich: int8 -- coding fields, where UNCODED means not yet coded
+header: the CSV header row
+"""
+
+# Value stored in a coding column for a comment that is not yet coded
+UNCODED = -1
+
+# How many values of a column we patch at a time in `patch_column()`
+PATCH_BLOCK = 1 << 16
+
+###
+### Some helper functions
+###
+
+def cache_name(fname):
+    """Returns the name of the cache file for the CSV file fname"""
+    return os.path.splitext(fname)[0] + '.npz'
+
+def is_fresh(fname):
+    """Returns True if we can read the cache for the CSV file fname in place of
+       the CSV file itself"""
+    if np is None:
+        return False
+    cname = cache_name(fname)
+    if not os.path.exists(cname):
+        return False
+    return (not os.path.exists(fname)
+            or os.path.getmtime(cname) >= os.path.getmtime(fname))
+
+def encode_strings(strings):
+    """Encode a list of strings as an offsets array and a bytes array"""
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return offsets, blob
+
+def decode_strings(offsets, blob, rows=None):
+    """Decode an offsets array and a bytes array back into a list of strings,
+       or just the strings at the array of indices rows"""
+    buf = blob.tobytes()
+    bounds = offsets.tolist()
+    if rows is None:
+        rows = range(len(bounds) - 1)
+    else:
+        rows = rows.tolist()
+    return [buf[bounds[i]:bounds[i+1]].decode('utf-8') for i in rows]
+
+def encode_code(field):
+    """Encode a coding field, which is empty until the comment is coded"""
+    return UNCODED if field == '' else int(field)
+
+def decode_code(value):
+    """Decode a coding field back into its CSV form"""
+    return '' if value == UNCODED else str(value)
+
+def discard(fname):
+    """Remove the cache for CSV file fname, if any, so readers use the CSV"""
+    cname = cache_name(fname)
+    if os.path.exists(cname):
+        os.remove(cname)
+
+###
+### Building columns
+###
+
+def data_columns(header, rows):
+    """Returns the columns of the `all-years` CSV file, given its header and
+       its records (without the header)"""
+    offsets, blob = encode_strings([row[1] for row in rows])
+    return {'header': np.array(header),
+            'reply': np.array([int(row[0]) for row in rows], dtype=np.int8),
+            'submission_offsets': offsets, 'submission_bytes': blob}
+
+def key_columns(header, rows):
+    """Returns the columns of the `all-years.key` CSV file, given its header
+       and its records (without the header).  Raises ValueError if a coding
+       field holds something other than an integer."""
+    # Dictionary-encode the document titles
+    vocab = {}
+    document = np.array([vocab.setdefault(row[4], len(vocab)) for row in rows],
+                        dtype=np.int32)
+    doc_offsets, doc_blob = encode_strings(list(vocab))
+
+    return {'header': np.array(header),
+            'year': np.array([int(row[0]) for row in rows], dtype=np.int32),
+            'student': np.array([int(row[1]) for row in rows], dtype=np.int64),
+            'replies': np.array([int(row[2]) for row in rows], dtype=np.int32),
+            'upvotes': np.array([int(row[3]) for row in rows], dtype=np.int32),
+            'document': document, 'document_offsets': doc_offsets,
+            'document_bytes': doc_blob,
+            'authentic': np.array([encode_code(row[5]) for row in rows],
+                                  dtype=np.int8),
+            'rich': np.array([encode_code(row[6]) for row in rows],
+                             dtype=np.int8)}
+
+###
+### Writing caches
+###
+
+def save_data(fname, header, rows):
+    """Write the cache for the `all-years` CSV file fname, given its header and
+       its records (without the header)"""
+    if np is None:
+        return
+    with open(cache_name(fname), mode='wb') as fout:
+        np.savez(fout, **data_columns(header, rows))
+
+def save_key(fname, header, rows):
+    """Write the cache for the `all-years.key` CSV file fname, given its header
+       and its records (without the header).  If a coding field holds something
+       other than an integer, we discard the cache instead."""
+    if np is None:
+        return
+    try:
+        cols = key_columns(header, rows)
+    except ValueError:
+        print(f'Non-integer coding in {fname}; not caching it')
+        discard(fname)
+        return
+    with open(cache_name(fname), mode='wb') as fout:
+        np.savez(fout, **cols)
+
+def save_columns(fname, cols):
+    """Write the cache for CSV file fname from columns cols, which a script
+       loaded from a fresh cache and updated in step with the CSV file"""
+    with open(cache_name(fname), mode='wb') as fout:
+        np.savez(fout, **cols)
+
+def patch_codes(fname, cols, first, rows):
+    """Rewrite the cache for the `all-years.key` CSV file fname from its
+       columns cols, with the coding fields of key rows replaced starting at
+       record first (the header is record 0).  If a coding field holds
+       something other than an integer, we discard the cache instead."""
+    try:
+        authentic = [encode_code(row[5]) for row in rows]
+        rich = [encode_code(row[6]) for row in rows]
+    except ValueError:
+        print(f'Non-integer coding in {fname}; not caching it')
+        discard(fname)
+        return
+    cols['authentic'][first-1:first-1+len(rows)] = authentic
+    cols['rich'][first-1:first-1+len(rows)] = rich
+    save_columns(fname, cols)
+
+def patch_array(src, dst, fixes):
+    """Copy the `.npy` array in file src to file dst, a block at a time, with
+       the value at each index replaced, given the iterator fixes over
+       `(index, value)` pairs in increasing order of index"""
+    # Copy the header, which tells us the type of the values
+    prefix = src.read(8)    # magic string and version
+    major = prefix[6]
+    length = src.read(2 if major == 1 else 4)
+    header = src.read(int.from_bytes(length, 'little'))
+    dst.write(prefix + length + header)
+    read_header = (np.lib.format.read_array_header_1_0 if major == 1
+                   else np.lib.format.read_array_header_2_0)
+    _, _, dtype = read_header(io.BytesIO(length + header))
+
+    fix = next(fixes, None)
+    first = 0    # index of the first value in the block
+    while True:
+        block = bytearray(src.read(PATCH_BLOCK * dtype.itemsize))
+        if not block:
+            break
+        end = first + len(block) // dtype.itemsize
+        while fix != None and fix[0] < end:
+            at = (fix[0] - first) * dtype.itemsize
+            block[at:at + dtype.itemsize] = \
+                np.array(fix[1], dtype=dtype).tobytes()
+            fix = next(fixes, None)
+        dst.write(block)
+        first = end
+
+def patch_column(fname, name, fixes):
+    """Rewrite the fresh cache for CSV file fname with the values of column
+       name replaced, given an iterable of `(index, value)` pairs in increasing
+       order of index.  We copy the cache a block at a time rather than loading
+       it, so memory doesn't grow with the size of the cache."""
+    cname = cache_name(fname)
+    tmp = cname + '.tmp'
+    with zipfile.ZipFile(cname) as zin, \
+         zipfile.ZipFile(tmp, mode='w') as zout:
+        for info in zin.infolist():
+            with zin.open(info) as src, \
+                 zout.open(info.filename, mode='w', force_zip64=True) as dst:
+                if info.filename == name + '.npy':
+                    patch_array(src, dst, iter(fixes))
+                else:
+                    shutil.copyfileobj(src, dst)
+    os.replace(tmp, cname)
+
+###
+### Reading caches
+###
+
+def load(fname):
+    """Returns a dictionary of the columns cached for CSV file fname, or None
+       if the cache isn't fresh"""
+    if not is_fresh(fname):
+        return None
+    with np.load(cache_name(fname)) as cache:
+        return {name: cache[name] for name in cache.files}
+
+def stream(fname):
+    """Yield the rows of CSV file fname, header first, just as `read_data()`
+       and `read_key()` do, but always from the CSV file itself.  A reader
+       from a cache holds every column in memory; this holds only a row."""
+    with open(fname) as fin:
+        yield from csv.reader(fin, delimiter=',')
+
+def read_data(fname):
+    """Yield the rows of the `all-years` CSV file fname, header first, just as
+       `csv.reader` would, but from its cache when that is fresh"""
+    cols = load(fname)
+    if cols is None:
+        with open(fname) as fin:
+            yield from csv.reader(fin, delimiter=',')
+        return
+
+    yield cols['header'].tolist()
+    submissions = decode_strings(cols['submission_offsets'],
+                                 cols['submission_bytes'])
+    for reply, submission in zip(cols['reply'].tolist(), submissions):
+        yield [str(reply), submission]
+
+def read_key(fname):
+    """Yield the rows of the `all-years.key` CSV file fname, header first, just
+       as `csv.reader` would, but from its cache when that is fresh"""
+    cols = load(fname)
+    if cols is None:
+        with open(fname) as fin:
+            yield from csv.reader(fin, delimiter=',')
+        return
+
+    yield cols['header'].tolist()
+    vocab = decode_strings(cols['document_offsets'], cols['document_bytes'])
+    for year, student, replies, upvotes, doc, authentic, rich in zip(
+            cols['year'].tolist(), cols['student'].tolist(),
+            cols['replies'].tolist(), cols['upvotes'].tolist(),
+            cols['document'].tolist(), cols['authentic'].tolist(),
+            cols['rich'].tolist()):
+        yield [str(year), str(student), str(replies), str(upvotes), vocab[doc],
+               decode_code(authentic), decode_code(rich)]
+
+def load_data(fname):
+    """Returns the columns of the `all-years` CSV file fname, from its cache
+       when that is fresh and otherwise by parsing the CSV file.  Unlike the
+       other readers, this one requires NumPy."""
+    cols = load(fname)
+    if cols is None:
+        rows = list(read_data(fname))
+        cols = data_columns(rows[0], rows[1:])
+    return cols
+
+def load_key(fname):
+    """Returns the columns of the `all-years.key` CSV file fname, from its
+       cache when that is fresh and otherwise by parsing the CSV file.  Unlike
+       the other readers, this one requires NumPy."""
+    cols = load(fname)
+    if cols is None:
+        rows = list(read_key(fname))
+        cols = key_columns(rows[0], rows[1:])
+    return cols
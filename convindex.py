@@ -0,0 +1,255 @@
+""" convindex.py: A random-access index of the conversations in the all-years
+    files
+
+For each conversation, the index records where it starts in both the
+`all-years` and `all-years.key` CSV files, the record number of its first
+comment, and its number of comments.  Entries have a fixed size, so finding
+conversation #N is a single seek.  With the index, `code.py` can resume coding
+without rereading the files from the top, open any range of conversations for
+recoding, and write back just the key rows of those conversations.
+
+The index also records the size and modification time of both CSV files.  If
+either file changes behind the index's back (e.g., `fixup.py` rewrites the key
+file), opening the index rebuilds it with a quick scan of both files.  When
+only the key file changed, the conversations are where they were, so the
+rebuilt index keeps the old resume point.
+
+Author: Mike Smith
+Date:   20261017
+"""
+
+import io
+import os
+import csv
+import struct
+import columnar
+from chunked import BLOCK_SIZE, record_starts
+
+"""Format of the index file
+--- Header ---
+magic, version
+number of conversations
+resume -- the conversation at which `code.py -keep` should start looking
+data file size, data file modification time (ns)
+key file size, key file modification time (ns)
+
+--- One entry per conversation, in file order ---
+data offset, key offset -- where the conversation starts in each CSV file
+first record -- index of its first comment's record (header is 0)
+comments -- number of comments in the conversation
+"""
+
+###
+### Global variables
+###
+
+MAGIC = b'AYCI'
+VERSION = 1
+HEADER = struct.Struct('<4sIQQQQQQ')
+ENTRY = struct.Struct('<QQQI')
+
+###
+### Some helper functions
+###
+
+def stamp(fname):
+    """Returns the size and modification time of file fname"""
+    st = os.stat(fname)
+    return st.st_size, st.st_mtime_ns
+
+def build_index(fname_data, fname_key, fname_index, resume=1):
+    """Scan both CSV files and write a fresh index for them"""
+    data_starts = record_starts(fname_data)
+    key_starts = record_starts(fname_key)
+    if len(data_starts) != len(key_starts):
+        raise RuntimeError(f'{fname_data} and {fname_key} differ in length')
+
+    # A conversation starts at each record whose `Reply` field is 0
+    entries = []
+    with open(fname_data, mode='rb') as fdata:
+        for record in range(1, len(data_starts)):
+            fdata.seek(data_starts[record])
+            if fdata.read(1) == b'0':
+                entries.append([data_starts[record], key_starts[record],
+                                record, 0])
+            entries[-1][3] += 1
+
+    write_index(fname_data, fname_key, fname_index, entries, resume)
+
+def write_index(fname_data, fname_key, fname_index, entries, resume=1):
+    """Write an index for both CSV files, given the list of its entries, each
+       `[data offset, key offset, first record, comments]`.  Use this instead
+       of `build_index()` when you already know where the conversations
+       start."""
+    packed = b''.join(ENTRY.pack(*entry) for entry in entries)
+    tmp = fname_index + '.tmp'
+    with open(tmp, mode='wb') as fout:
+        fout.write(HEADER.pack(MAGIC, VERSION, len(packed) // ENTRY.size,
+                               resume, *stamp(fname_data), *stamp(fname_key)))
+        fout.write(packed)
+    os.replace(tmp, fname_index)
+
+def parse(data):
+    """Returns the list of CSV rows in data, which is a bytes object, decoded
+       just as `open()` would"""
+    return list(csv.reader(io.TextIOWrapper(io.BytesIO(data)), delimiter=','))
+
+def unparse(rows):
+    """Returns rows written as CSV and encoded just as `open()` would"""
+    buf = io.BytesIO()
+    text = io.TextIOWrapper(buf)
+    csv_writer = csv.writer(text, delimiter=',', quotechar='"',
+                            quoting=csv.QUOTE_MINIMAL)
+    csv_writer.writerows(rows)
+    text.flush()
+    return buf.getvalue()
+
+###
+### The index
+###
+
+class ConversationIndex:
+    """An open index of the conversations in a pair of all-years files.
+       Conversations are numbered from 1, as in `code.py`."""
+
+    def __init__(self, fname_data, fname_key, fname_index):
+        self.fname_data = fname_data
+        self.fname_key = fname_key
+        self.fname_index = fname_index
+        if not self.is_fresh():
+            print(f'Rebuilding {fname_index}')
+            build_index(fname_data, fname_key, fname_index,
+                        self.stale_resume())
+        self.fidx = open(fname_index, mode='r+b')
+        header = HEADER.unpack(self.fidx.read(HEADER.size))
+        self.num_conversations = header[2]
+        self.resume = header[3]
+
+    def read_header(self):
+        """Returns the unpacked header of the index file, or None if there's
+           no index file of this version"""
+        if not os.path.exists(self.fname_index):
+            return None
+        with open(self.fname_index, mode='rb') as fin:
+            header = fin.read(HEADER.size)
+        if len(header) != HEADER.size:
+            return None
+        header = HEADER.unpack(header)
+        if header[0] != MAGIC or header[1] != VERSION:
+            return None
+        return header
+
+    def is_fresh(self):
+        """Returns True if the index file matches both CSV files"""
+        header = self.read_header()
+        return (header != None and header[4:6] == stamp(self.fname_data)
+                and header[6:8] == stamp(self.fname_key))
+
+    def stale_resume(self):
+        """Returns the resume point for a rebuilt index: the old one if only
+           the key file changed (e.g., `journal.compact()` or `fixup.py`
+           rewrote it), and otherwise the first conversation"""
+        header = self.read_header()
+        if header != None and header[4:6] == stamp(self.fname_data):
+            return header[3]
+        return 1
+
+    def entry(self, n):
+        """Returns the tuple `(data offset, key offset, first record,
+           comments)` for conversation n"""
+        if n < 1 or n > self.num_conversations:
+            raise IndexError(f'No conversation #{n}')
+        self.fidx.seek(HEADER.size + (n - 1) * ENTRY.size)
+        return ENTRY.unpack(self.fidx.read(ENTRY.size))
+
+    def end(self, n):
+        """Returns the pair of offsets just past conversation n in the data
+           and key files"""
+        if n < self.num_conversations:
+            return self.entry(n + 1)[0:2]
+        return os.path.getsize(self.fname_data), os.path.getsize(self.fname_key)
+
+    def conversation(self, n):
+        """Returns the tuple `(first record, d_rows, k_rows)` for conversation
+           n, reading only its rows from the CSV files"""
+        data_begin, key_begin, first, comments = self.entry(n)
+        data_end, key_end = self.end(n)
+        with open(self.fname_data, mode='rb') as fdata, \
+             open(self.fname_key, mode='rb') as fkey:
+            fdata.seek(data_begin)
+            d_rows = parse(fdata.read(data_end - data_begin))
+            fkey.seek(key_begin)
+            k_rows = parse(fkey.read(key_end - key_begin))
+        assert(len(d_rows) == comments and len(k_rows) == comments)
+        return first, d_rows, k_rows
+
+    def write_back(self, first, last, k_rows):
+        """Replace the key rows of conversations first through last with
+           k_rows.  Only the coding fields may differ from the current rows.
+           We copy the rest of the key file byte for byte, replace the file
+           atomically, and then fix the key offsets of the conversations from
+           first + 1 on."""
+        begin = self.entry(first)[1]
+        end = self.end(last)[1]
+
+        # Encode each conversation separately to learn where it now starts
+        entries = [list(self.entry(n)) for n in range(first, last + 1)]
+        chunks = []
+        pos = begin
+        i = 0
+        for e in entries:
+            e[1] = pos
+            chunks.append(unparse(k_rows[i:i + e[3]]))
+            pos += len(chunks[-1])
+            i += e[3]
+        assert(i == len(k_rows))
+        delta = pos - end
+
+        # Patch the columnar cache too, if it's fresh before we write
+        cols = columnar.load(self.fname_key)
+
+        tmp = self.fname_key + '.tmp'
+        with open(self.fname_key, mode='rb') as fin, \
+             open(tmp, mode='wb') as fout:
+            remaining = begin
+            while remaining > 0:
+                block = fin.read(min(remaining, BLOCK_SIZE))
+                fout.write(block)
+                remaining -= len(block)
+            for chunk in chunks:
+                fout.write(chunk)
+            fin.seek(end)
+            for block in iter(lambda: fin.read(BLOCK_SIZE), b''):
+                fout.write(block)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmp, self.fname_key)
+
+        # Shift the key offsets of every later conversation
+        if delta != 0 and last < self.num_conversations:
+            self.fidx.seek(HEADER.size + last * ENTRY.size)
+            entries += [list(e) for e in ENTRY.iter_unpack(self.fidx.read())]
+            for e in entries[last - first + 1:]:
+                e[1] += delta
+        self.fidx.seek(HEADER.size + (first - 1) * ENTRY.size)
+        self.fidx.write(b''.join(ENTRY.pack(*e) for e in entries))
+        self.write_header()
+
+        if cols != None:
+            columnar.patch_codes(self.fname_key, cols, entries[0][2], k_rows)
+
+    def set_resume(self, n):
+        """Remember that `code.py -keep` should start looking at conversation
+           n"""
+        self.resume = n
+        self.write_header()
+
+    def write_header(self):
+        self.fidx.seek(0)
+        self.fidx.write(HEADER.pack(MAGIC, VERSION, self.num_conversations,
+                                    self.resume, *stamp(self.fname_data),
+                                    *stamp(self.fname_key)))
+        self.fidx.flush()
+
+    def close(self):
+        self.fidx.close()
@@ -0,0 +1,239 @@
+""" export.py: Exports the coded dataset as typed tables for the R notebook
+
+`gendata.Rmd` used to read its data from sheets of a hand-built spreadsheet.
+This script writes the same data straight from the `all-years` files as two
+typed tables, which `arrow::read_parquet()` loads far faster than
+`read_xlsx()` loads a sheet:
+
+- `all-years.comments.parquet` has a row per comment, and
+- `all-years.conversations.parquet` has a row per conversation, with the
+  metrics that `analyze.py` writes to the `<year>-conversations.csv` files.
+
+With `-format arrow`, we write Arrow IPC files (`.arrow`) instead, which
+`arrow::read_ipc_file()` loads without decompressing anything.
+
+Each table covers the whole dataset.  A coding column is null wherever the
+coding isn't done yet, so a partially coded dataset exports cleanly, and the
+notebook decides what to drop.  Documents are dictionary-encoded, so they
+arrive in R as factors.
+
+With `-check`, we read both tables back and compare them with the columns of
+the `all-years` files, which is a quick way to see that a PyArrow install
+writes what the notebook expects.
+
+We need PyArrow for this script, but nothing else in the repo does.
+
+Author: Mike Smith
+Date:   20261017
+"""
+
+import sys
+import numpy as np
+import columnar
+import instrument
+from textfeatures import extract
+from metrics import (C_AUTHENTIC, C_RICH, C_END, conversation_ids,
+                     conversation_metrics, conversation_starts)
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+"""Format of the exported tables
+--- Columns in `all-years.comments` table ---
+year: int32
+conversation_no: int32 -- numbered from 1 in file order, as in `code.py`
+student: int64 -- our student ID
+replies: int32, upvotes: int32
+document: dictionary<int32, string>
+authentic: int8 -- coding field, null if uncoded
+quality: int8 -- coding field (Rich discussion?), null if uncoded
+
+--- Columns in `all-years.conversations` table ---
+year: int32 -- the year of the conversation's first comment
+conversation_no: int32
+document: dictionary<int32, string>
+comments, students, upvotes, words: int64
+authentic, quality: int64 -- coding fields, null unless every comment in the
+    conversation is coded
+sentences, characters: int64, ttr: double
+questions, urls, code: int64
+"""
+
+###
+### Global variables
+###
+
+FNAME_DATA = 'annotations/all-years.csv'
+FNAME_KEY = 'annotations/all-years.key.csv'
+
+# The file names of the exported tables, without an extension
+FNAME_COMMENTS = 'annotations/all-years.comments'
+FNAME_CONVERSATIONS = 'annotations/all-years.conversations'
+
+# The extension of each format
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+# Column names of the metrics, indexed by the `C_*` constants in `metrics.py`
+METRICS = ['comments', 'students', 'upvotes', 'words', 'authentic', 'quality',
+           'sentences', 'characters', 'ttr', 'questions', 'urls', 'code']
+
+###
+### Some helper functions
+###
+
+def documents(key, rows):
+    """Returns the dictionary array of the documents in key at the indices
+       rows"""
+    vocab = columnar.decode_strings(key['document_offsets'],
+                                    key['document_bytes'])
+    return pa.DictionaryArray.from_arrays(
+        pa.array(key['document'][rows], type=pa.int32()),
+        pa.array(vocab, type=pa.string()))
+
+def coding(values):
+    """Returns the array of a coding column, with UNCODED as null"""
+    return pa.array(values, type=pa.int8(), mask=values == columnar.UNCODED)
+
+def comment_table(data, key):
+    """Returns the comment-level table, given the columns of the `all-years`
+       and `all-years.key` files"""
+    conv = conversation_ids(data['reply'])
+    return pa.table({
+        'year': pa.array(key['year'], type=pa.int32()),
+        'conversation_no': pa.array(conv + 1, type=pa.int32()),
+        'student': pa.array(key['student'], type=pa.int64()),
+        'replies': pa.array(key['replies'], type=pa.int32()),
+        'upvotes': pa.array(key['upvotes'], type=pa.int32()),
+        'document': documents(key, slice(None)),
+        'authentic': coding(key['authentic']),
+        'quality': coding(key['rich']),
+    })
+
+def conversation_table(data, key):
+    """Returns the conversation-level table, given the columns of the
+       `all-years` and `all-years.key` files"""
+    reply = data['reply']
+    starts = conversation_starts(reply)
+    features = extract(columnar.decode_strings(data['submission_offsets'],
+                                               data['submission_bytes']))
+
+    # Count uncoded comments as 0, and then null out every conversation with
+    # one
+    uncoded = key['authentic'] == columnar.UNCODED
+    m = conversation_metrics(reply, key['student'], key['upvotes'], features,
+                             np.where(uncoded, 0, key['authentic']),
+                             np.where(uncoded, 0, key['rich']))
+    partial = np.zeros(len(starts), dtype=bool)
+    if len(starts) > 0:
+        partial = np.add.reduceat(uncoded.astype(np.int64), starts) > 0
+
+    columns = {
+        'year': pa.array(key['year'][starts], type=pa.int32()),
+        'conversation_no': pa.array(np.arange(1, len(starts) + 1),
+                                    type=pa.int32()),
+        'document': documents(key, starts),
+    }
+    for k in range(C_END):
+        if k in (C_AUTHENTIC, C_RICH):
+            columns[METRICS[k]] = pa.array(m[k], mask=partial)
+        else:
+            columns[METRICS[k]] = pa.array(m[k])
+    return pa.table(columns)
+
+def write_table(table, fname, fmt):
+    """Write table to file fname in the format fmt"""
+    if fmt == 'parquet':
+        pq.write_table(table, fname)
+    else:
+        with pa.OSFile(fname, mode='wb') as sink, \
+             pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+def read_table(fname, fmt):
+    """Returns the table in file fname, written in the format fmt"""
+    if fmt == 'parquet':
+        return pq.read_table(fname)
+    with pa.memory_map(fname) as source:
+        return pa.ipc.open_file(source).read_all()
+
+def check(data, key, fnames, fmt):
+    """Read back the tables in the list of files fnames, written in the format
+       fmt, and raise RuntimeError unless they match the columns of the
+       `all-years` and `all-years.key` files"""
+    comments = read_table(fnames[0], fmt)
+    vocab = columnar.decode_strings(key['document_offsets'],
+                                    key['document_bytes'])
+    same = (comments.num_rows == len(data['reply'])
+            and comments['document'].to_pylist()
+                == [vocab[d] for d in key['document'].tolist()]
+            and np.array_equal(comments['conversation_no'].to_numpy(),
+                               conversation_ids(data['reply']) + 1))
+    for name, column in [('year', 'year'), ('student', 'student'),
+                         ('replies', 'replies'), ('upvotes', 'upvotes'),
+                         ('authentic', 'authentic'), ('quality', 'rich')]:
+        values = comments[name].fill_null(columnar.UNCODED).to_numpy()
+        same = same and np.array_equal(values, key[column])
+    if not same:
+        raise RuntimeError(f'{fnames[0]} does not match {FNAME_KEY}')
+
+    conversations = read_table(fnames[1], fmt)
+    starts = conversation_starts(data['reply'])
+    if conversations.num_rows != len(starts) or \
+       conversations['comments'].to_numpy().sum() != len(data['reply']) or \
+       not np.array_equal(conversations['year'].to_numpy(),
+                          key['year'][starts]):
+        raise RuntimeError(f'{fnames[1]} does not match {FNAME_DATA}')
+
+###
+### Main routines
+###
+
+def export(data, key, fmt='parquet'):
+    """Write both tables in the format fmt, given the columns of the
+       `all-years` and `all-years.key` files.  Returns the list of the files
+       written."""
+    fnames = [FNAME_COMMENTS + FORMATS[fmt], FNAME_CONVERSATIONS + FORMATS[fmt]]
+    with instrument.phase('comments', rows=len(data['reply'])):
+        write_table(comment_table(data, key), fnames[0], fmt)
+    with instrument.phase('conversations', rows=len(data['reply'])):
+        write_table(conversation_table(data, key), fnames[1], fmt)
+    return fnames
+
+def export_all_years(fmt='parquet', checking=False):
+    """Export the `all-years` files on disk in the format fmt, and then read
+       the tables back to check them if checking"""
+    with instrument.phase('load') as p:
+        data = columnar.load_data(FNAME_DATA)
+        key = columnar.load_key(FNAME_KEY)
+        p.rows = len(data['reply'])
+    fnames = export(data, key, fmt)
+    for fname in fnames:
+        print(f'Wrote {fname}')
+    if checking:
+        with instrument.phase('check', rows=len(data['reply'])):
+            check(data, key, fnames, fmt)
+        print(f'Checked {" and ".join(fnames)}')
+
+
+def main():
+    usage = 'Usage: python3 export.py [-format parquet|arrow] [-check]'
+    fmt = 'parquet'
+    checking = False
+    args = sys.argv[1:]
+    while args:
+        opt = args.pop(0)
+        if opt == '-format' and args and args[0] in FORMATS:
+            fmt = args.pop(0)
+        elif opt == '-check':
+            checking = True
+        else:
+            sys.exit(usage)
+    if pa is None:
+        sys.exit('export.py needs PyArrow (pip install pyarrow)')
+    export_all_years(fmt, checking)
+
+if __name__ == '__main__':
+    main()
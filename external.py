@@ -0,0 +1,204 @@
+""" external.py: Sort and shuffle more records than fit in memory
+
+`build.py -memory MB` uses these routines when the combined exports are too
+big to hold in memory.  Both spill records to temporary files on disk and keep
+no more than a budget of bytes in memory at once.
+
+A `Sorter` collects records into memory until it reaches its budget, sorts
+them, and writes them out as a run.  Reading the sorted records back merges
+the runs, a bounded number of runs at a time.  A `Shuffler` puts records into
+a given order: it scatters each record into the bucket holding its range of
+output positions, and then gathers the buckets one at a time, sorting each in
+memory.  The order itself comes from the caller, so a shuffle seeded the same
+way as the in-memory path produces the same output.  Neither keeps more than
+`FAN_IN` files open at once, however many runs or buckets there are.
+
+Records go to disk as pickled batches, so a record may be anything that
+pickles.  We estimate a record's size in memory with `record_size()`, which
+need only be roughly right.
+
+Author: Mike Smith
+Date:   20261017
+"""
+
+import os
+import sys
+import heapq
+import pickle
+import tempfile
+
+###
+### Global variables
+###
+
+# The default memory budget, in bytes
+DEFAULT_BUDGET = 256 * 1024 * 1024
+
+# The most runs we merge at once, which bounds the number of open files
+FAN_IN = 64
+
+# The number of records we pickle together in a spill file
+BATCH = 1000
+
+###
+### Some helper functions
+###
+
+def record_size(record):
+    """Returns a rough estimate of the memory a record takes, where a record is
+       a string, a bytes object, a number, or a tuple or list of them"""
+    if isinstance(record, (tuple, list)):
+        return sys.getsizeof(record) + sum(record_size(r) for r in record)
+    return sys.getsizeof(record)
+
+def spill_dir(parent='annotations'):
+    """Returns a temporary directory for spill files, which the caller should
+       use in a `with` statement so it's removed when we're done.  We put it
+       next to the data, since the system's temporary directory may be too
+       small."""
+    return tempfile.TemporaryDirectory(prefix='spill-', dir=parent)
+
+def write_spill(fname, records):
+    """Write the iterable records to the spill file fname"""
+    with open(fname, mode='wb') as fout:
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) == BATCH:
+                pickle.dump(batch, fout, protocol=pickle.HIGHEST_PROTOCOL)
+                batch = []
+        if batch:
+            pickle.dump(batch, fout, protocol=pickle.HIGHEST_PROTOCOL)
+
+def read_spill(fname):
+    """Yield the records in the spill file fname, in the order written"""
+    with open(fname, mode='rb') as fin:
+        while True:
+            try:
+                batch = pickle.load(fin)
+            except EOFError:
+                return
+            yield from batch
+
+###
+### External merge sort
+###
+
+class Sorter:
+    """Sorts the records added to it by key, a function of a record, keeping
+       at most budget bytes of records in memory and spilling the rest to
+       files in directory tmpdir"""
+
+    def __init__(self, key, budget, tmpdir):
+        self.key = key
+        self.budget = budget
+        self.tmpdir = tmpdir
+        self.records = []    # records not yet spilled
+        self.size = 0        # estimated bytes in records
+        self.total = 0       # estimated bytes of every record added
+        self.runs = []       # spill files, each holding a sorted run
+
+    def add(self, record):
+        """Add record to those we're sorting"""
+        size = record_size(record)
+        self.records.append(record)
+        self.size += size
+        self.total += size
+        if self.size >= self.budget:
+            self.spill()
+
+    def spill(self):
+        """Write the records in memory out as a sorted run"""
+        self.records.sort(key=self.key)
+        fname = os.path.join(self.tmpdir, f'run-{len(self.runs)}')
+        write_spill(fname, self.records)
+        self.runs.append(fname)
+        self.records = []
+        self.size = 0
+
+    def merge(self, runs):
+        """Returns an iterator over the records in the list of runs, in key
+           order.  For equal keys, records come out in the order of their
+           runs, so the sort is stable."""
+        return heapq.merge(*[read_spill(fname) for fname in runs],
+                           key=self.key)
+
+    def sorted(self):
+        """Yield every record added, in key order.  We sort in memory if we
+           never spilled."""
+        if not self.runs:
+            self.records.sort(key=self.key)
+            yield from self.records
+            self.records = []
+            return
+        if self.records:
+            self.spill()
+
+        # Merge runs FAN_IN at a time until few enough remain
+        runs = self.runs
+        level = 0
+        while len(runs) > FAN_IN:
+            level += 1
+            merged = []
+            for i in range(0, len(runs), FAN_IN):
+                fname = os.path.join(self.tmpdir,
+                                     f'merge-{level}-{len(merged)}')
+                write_spill(fname, self.merge(runs[i:i + FAN_IN]))
+                for run in runs[i:i + FAN_IN]:
+                    os.remove(run)
+                merged.append(fname)
+            runs = merged
+        yield from self.merge(runs)
+
+###
+### External shuffle
+###
+
+class Shuffler:
+    """Puts records into output positions chosen by the caller, given the
+       number of records n and an estimate of their total size in bytes.  We
+       keep about budget bytes in memory, spilling to files in directory
+       tmpdir."""
+
+    def __init__(self, n, total, budget, tmpdir):
+        self.n = n
+        self.budget = budget
+
+        # Gathering a bucket holds all of it in memory, so every bucket must
+        # fit in half of the budget
+        self.num_buckets = max(1, min(n, -(-2 * total // budget)))
+        self.fnames = [os.path.join(tmpdir, f'bucket-{b}')
+                       for b in range(self.num_buckets)]
+        self.buffers = [[] for b in range(self.num_buckets)]
+        self.size = 0
+
+    def add(self, position, record):
+        """Scatter record, which goes at position in the output"""
+        b = position * self.num_buckets // self.n
+        self.buffers[b].append((position, record))
+        self.size += record_size(record)
+        if self.size >= self.budget // 2:
+            self.flush()
+
+    def flush(self):
+        """Append every buffered record to its bucket's file.  We open each
+           file only while we append to it, since there may be more buckets
+           than we may have files open."""
+        for buffer, fname in zip(self.buffers, self.fnames):
+            if buffer:
+                with open(fname, mode='ab') as fout:
+                    pickle.dump(buffer, fout,
+                                protocol=pickle.HIGHEST_PROTOCOL)
+                buffer.clear()
+        self.size = 0
+
+    def gathered(self):
+        """Yield the pair `(position, record)` for every record added, in
+           position order"""
+        self.flush()
+        for fname in self.fnames:
+            if not os.path.exists(fname):
+                continue    # a bucket no record went to
+            bucket = sorted(read_spill(fname), key=lambda pr: pr[0])
+            os.remove(fname)
+            yield from bucket
@@ -9,7 +9,11 @@ Author: Mike Smith
 Date:   20210905
 """
 
+import os
 import csv
+from contextlib import closing
+import columnar
+import instrument
 
 """Format of the randomized Perusall-annotation CSV files
 --- Fields in `all-years` CSV file ---
@@ -32,9 +36,10 @@ import csv
 
 FNAME_DATA = 'annotations/all-years.csv'
 FNAME_KEY = 'annotations/all-years.key.csv'
+FNAME_REPORT = 'annotations/all-years.fixup.csv'
 
-# Where we collect the updated key data
-new_key_data = []
+# Header of the report of corrections
+REPORT_HEADER = ['Conversation', 'Record', 'Field', 'Old', 'New', 'Reason']
 
 ###
 ### Some helper functions
@@ -44,6 +49,61 @@ def starts_conversation(comment):
     """Returns True if this comment starts a conversation"""
     return comment[0] == '0'
 
+def fix_conversation(c, first, conversation, report_writer):
+    """Fix the `Replies` count at the head of conversation c, a list of key
+       rows whose first is record first, and report each correction.  Returns
+       the list of `(record, replies)` corrections."""
+    corrections = []
+    if not conversation:
+        return corrections
+
+    # Fix recorded replies count in this conversation
+    head = conversation[0]
+    replies = len(conversation) - 1
+    if int(head[2]) != replies:
+        print(f'Conversation #{c}: replies {head[2]} => {replies}')
+        report_writer.writerow([c, first, 'Replies', head[2], replies,
+                                'recount'])
+        corrections.append((first, replies))
+        head[2] = replies
+
+    for i, k_row in enumerate(conversation[1:], start=first + 1):
+        if int(k_row[2]) != 0:
+            # Perusall bug: no replies should have replies
+            report_writer.writerow([c, i, 'Replies', k_row[2], 0,
+                                    'reply with replies'])
+            corrections.append((i, 0))
+            k_row[2] = 0
+
+    return corrections
+
+def flush_conversation(c, first, conversation, key_writer, report_writer):
+    """Fix conversation c as `fix_conversation()` does, and then write out its
+       buffered key rows.  Returns the list of corrections."""
+    corrections = fix_conversation(c, first, conversation, report_writer)
+    key_writer.writerows(conversation)
+    return corrections
+
+def fixup(conversations, report_writer):
+    """Fix every conversation in memory, where conversations is the list that
+       `build.assemble()` returns, and return the number of corrections"""
+    corrections = 0
+    first = 1    # record 0 is the header
+    for c, conversation in enumerate(conversations, start=1):
+        k_rows = [k_row for d_row, k_row in conversation]
+        corrections += len(fix_conversation(c, first, k_rows, report_writer))
+        first += len(k_rows)
+    return corrections
+
+def read_corrections(fname):
+    """Yield the `(index, replies)` pair of each correction in report fname,
+       where index counts the key records from 0 (without the header)"""
+    with open(fname) as fin:
+        csv_reader = csv.reader(fin, delimiter=',')
+        next(csv_reader)    # skip over header
+        for row in csv_reader:
+            yield int(row[1]) - 1, int(row[4])
+
 ###
 ### Main
 ###
@@ -53,58 +113,72 @@ def starts_conversation(comment):
 # Perusall mistakenly splits conversations, and in such cases, I have to both
 # update the `Replies` count at the head of such conversations and sometimes
 # zero the `Replies` field in some replies.
-with open(FNAME_DATA) as fdata, open(FNAME_KEY) as fkey:
-    data_reader = csv.reader(fdata, delimiter=',')
-    key_reader = csv.reader(fkey, delimiter=',')
-
-    # Note: record count is 0-based and conversation count is not
-    record = 0    # an index into a CSV file
-    c = 0         # conversation number (starts at 1)
-    replies = 0   # track actual replies in a conversation
-    last_start = None
-
-    # Skip over header record
-    try:
-        d_row = next(data_reader)
-        k_row = next(key_reader)
-        new_key_data.append(k_row)
-        record += 1
-    except StopIteration:
-        raise RuntimeError('Unexpected empty CSV file')
-
-    # Process the data records
-    while True:
+#
+# We make a single streaming pass through the CSV files, holding only the
+# current conversation in memory, and write to a temporary file that we rename
+# over the key file when we're done.  An interruption therefore never truncates
+# the coded key file.  Every correction also goes into a CSV report, and if the
+# columnar cache of the key file was fresh, a second streaming pass patches the
+# corrections from the report into it.
+
+def main():
+    fresh = columnar.is_fresh(FNAME_KEY)
+    corrections = 0
+    tmp = FNAME_KEY + '.tmp'
+
+    with instrument.phase('fix replies') as phase, \
+         closing(columnar.stream(FNAME_DATA)) as data_reader, \
+         closing(columnar.stream(FNAME_KEY)) as key_reader, \
+         open(tmp, mode='w') as kout, \
+         open(FNAME_REPORT, mode='w') as rout:
+        key_writer = csv.writer(kout, delimiter=',', quotechar='"',
+                                quoting=csv.QUOTE_MINIMAL)
+        report_writer = csv.writer(rout, delimiter=',', quotechar='"',
+                                   quoting=csv.QUOTE_MINIMAL)
+        report_writer.writerow(REPORT_HEADER)
+
+        # Note: record count is 0-based and conversation count is not
+        record = 0    # an index into a CSV file
+        c = 0         # conversation number (starts at 1)
+        first = 0     # record that starts the current conversation
+        conversation = []
+
+        # Copy the header record
         try:
             d_row = next(data_reader)
             k_row = next(key_reader)
-            if starts_conversation(d_row):
-                if last_start != None and int(last_start[2]) != replies:
-                    # Fix recorded replies count in last conversation
-                    print(f'Conversation #{c}: replies {last_start[2]} => {replies}')
-                    last_start[2] = replies
+            key_writer.writerow(k_row)
+            record += 1
+        except StopIteration:
+            raise RuntimeError('Unexpected empty CSV file')
 
-                # Remember key record of the start of this new conversation
+        # Process the data records a conversation at a time
+        for d_row, k_row in zip(data_reader, key_reader):
+            if starts_conversation(d_row):
+                corrections += len(flush_conversation(
+                    c, first, conversation, key_writer, report_writer))
                 c += 1
-                replies = 0
-                last_start = k_row
-            else:
-                replies += 1
-                if k_row[2] != 0:
-                    # Perusall bug: no replies should have replies
-                    k_row[2] = 0
-            new_key_data.append(k_row)
-        except StopIteration:
-            if last_start != None and int(last_start[2]) != replies:
-                # Fix recorded replies count in absolute last conversation
-                print(f'Conversation #{c}: replies {last_start[2]} => {replies}')
-                last_start[2] = replies
-            break
-
-# Write out the updated key data
-with open(FNAME_KEY, mode='w') as kout:
-    csv_writer = csv.writer(kout, delimiter=',', quotechar='"',
-                            quoting=csv.QUOTE_MINIMAL)
-    for k_row in new_key_data:
-        csv_writer.writerow(k_row)
-
-print(f'Wrote {FNAME_KEY}')
\ No newline at end of file
+                first = record
+                conversation = []
+            conversation.append(k_row)
+            record += 1
+
+        # Fix the absolute last conversation
+        corrections += len(flush_conversation(c, first, conversation,
+                                              key_writer, report_writer))
+        kout.flush()
+        os.fsync(kout.fileno())
+        phase.rows = record
+
+    os.replace(tmp, FNAME_KEY)
+    print(f'Wrote {FNAME_KEY}')
+    print(f'Wrote {corrections} corrections to {FNAME_REPORT}')
+
+    # Keep the columnar cache of the key data in step with the CSV file
+    if fresh:
+        with instrument.phase('patch columnar', rows=corrections):
+            columnar.patch_column(FNAME_KEY, 'replies',
+                                  read_corrections(FNAME_REPORT))
+
+if __name__ == '__main__':
+    main()
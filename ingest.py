@@ -0,0 +1,141 @@
+""" ingest.py: Given two or more CSV files of Perusall annotations, read each
+    file exactly once and build both the document catalog that `overlap.py`
+    builds and the per-document buffers of rows that `build.py` splits into
+    the overlapping and unique datasets.
+Author: Mike Smith
+Date:   20261017
+"""
+
+import sys
+import csv
+from chunked import read_rows
+from overlap import add_document, common_to, unique_to, label, report
+
+"""Expected format of input Perusall-annotation CSV files
+0: Last name, 1: First name, 2: Student ID
+3: Submission -- the actual text of the annotation
+4: Type -- {comment, question}
+5: Score -- [0-2]
+6: Created, 7: Last edited at -- date time format
+8: Replies, 9: Upvoters
+10: Status -- ???
+11: Document, 12: Page number
+13: Range -- description of annotation anchor {text, rectangle} in document
+"""
+
+def ingest(files):
+    """Compute the overlap across years in documents used while buffering
+       every row of each file by the document it annotates
+
+    Input:   A list of one or more filenames
+    Output:  A tuple `(docs, headers, rows)`.  `docs` is the same dictionary
+             that `overlap()` returns: its keys are document titles and the
+             value of each is a bitmask in which bit i is set if the document
+             appears in `files[i]`.  `headers` maps each filename to its header
+             row.  `rows` maps each filename to a dictionary from document
+             title to the list of that file's rows on that document, in file
+             order.
+    Assumes: The name of a file without its `.csv` extension is a year
+             (e.g., 2021).
+    """
+    assert(len(files) > 0)
+
+    docs = {}
+    headers = {}
+    rows = {}
+
+    for i, fname in enumerate(files):
+        by_doc = {}
+
+        line = 0
+
+        for row in read_rows(f'annotations/{fname}'):
+            if line == 0:
+                headers[fname] = row
+            else:
+                doc = row[11]
+                doc_rows = by_doc.get(doc)
+                if doc_rows == None:
+                    # First time we've seen this title in this file, so
+                    # record it in the document catalog too.
+                    by_doc[doc] = doc_rows = []
+                    add_document(docs, doc, i)
+                doc_rows.append(row)
+            line += 1
+
+        print(f'Processed {line} lines in {fname}')
+
+        rows[fname] = by_doc
+
+    report(docs, [fname.split('.')[0] for fname in files])
+
+    return docs, headers, rows
+
+def stream_rows(fname):
+    """Yield every row of the CSV file fname, header included, without holding
+       the file in memory"""
+    with open(fname) as fin:
+        yield from csv.reader(fin, delimiter=',')
+
+def catalog(files):
+    """Compute the same `(docs, headers)` as `ingest()`, but stream through
+       each file rather than buffering its rows, for inputs too big for
+       memory"""
+    assert(len(files) > 0)
+
+    docs = {}
+    headers = {}
+
+    for i, fname in enumerate(files):
+        seen = set()
+
+        line = 0
+
+        for row in stream_rows(f'annotations/{fname}'):
+            if line == 0:
+                headers[fname] = row
+            elif row[11] not in seen:
+                seen.add(row[11])
+                add_document(docs, row[11], i)
+            line += 1
+
+        print(f'Processed {line} lines in {fname}')
+
+    report(docs, [fname.split('.')[0] for fname in files])
+
+    return docs, headers
+
+def split(by_doc, docs, years, i):
+    """Given the i-th file's rows buffered by document, the catalog returned by
+       `ingest()`, and the bitmask of the years being combined, return the
+       tuple `(ds_overlap, ds_unique)` of rows on documents read in every one
+       of those years and those read only in the i-th file's year.  Rows on
+       documents shared with some but not all of the other years are in
+       neither list.  Within each document, rows remain in file order.
+    """
+    ds_overlap = []
+    ds_unique = []
+    for doc, doc_rows in by_doc.items():
+        if common_to(docs[doc], years):
+            ds_overlap += doc_rows
+        elif unique_to(docs[doc], i):
+            ds_unique += doc_rows
+    return ds_overlap, ds_unique
+
+
+def main():
+    files = sys.argv[1:]
+
+    if len(files) < 2:
+        sys.exit('Usage: python3 ingest.py [year1].csv [year2].csv ...')
+
+    docs, headers, rows = ingest(files)
+    years = [fname.split('.')[0] for fname in files]
+
+    print('How many rows does each document have?')
+    for fname in files:
+        for doc, doc_rows in rows[fname].items():
+            print(f'{fname}: {label(docs[doc], years)}: {len(doc_rows)}: {doc}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+""" instrument.py: Timing and memory measurements of the phases of a script
+
+Every stage of the pipeline wraps its main phases in `phase()`:
+
+    with instrument.phase('ingest') as p:
+        ...
+        p.rows = len(rows)
+
+When the environment variable `PARTICIPATION_PROFILE` names a file, each phase
+appends one line of JSON to it when the phase ends, giving the script, the
+phase, its wall-clock and CPU time, the peak resident memory of the process so
+far, and (if the phase sets `rows`) the rows it processed per second.  Set it
+to `-` to write the lines to stderr instead.  Since every line is a whole
+record appended at once, several scripts can share one profile, e.g.
+
+    PARTICIPATION_PROFILE=profile.jsonl python3 build.py 2020.csv 2021.csv
+
+When the variable isn't set, `phase()` returns a do-nothing object that it
+creates once, so an instrumented phase costs just a function call.
+
+Author: Mike Smith
+Date:   20261017
+"""
+
+import os
+import sys
+import json
+import time
+
+try:
+    import resource
+except ImportError:    # not on Windows, where we don't report memory
+    resource = None
+
+###
+### Global variables
+###
+
+ENV_VAR = 'PARTICIPATION_PROFILE'
+
+# Where the records go: None when disabled, else the name of the file
+destination = os.environ.get(ENV_VAR) or None
+
+# The name of the script being measured, e.g., `build`
+script = os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+
+# The open profile, once we've written to it
+fout = None
+
+###
+### Some helper functions
+###
+
+def enabled():
+    """Returns True if we're recording measurements"""
+    return destination != None
+
+def peak_rss_kb():
+    """Returns the peak resident memory of this process so far, in kilobytes,
+       or None if we can't tell"""
+    if resource == None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, but macOS reports bytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def emit(record):
+    """Append record to the profile as one line of JSON"""
+    global fout
+    line = json.dumps(record) + '\n'
+    if destination == '-':
+        sys.stderr.write(line)
+        sys.stderr.flush()
+        return
+    if fout == None:
+        fout = open(destination, mode='a', buffering=1)
+    fout.write(line)
+
+###
+### Phases
+###
+
+class Phase:
+    """A context manager that measures the phase of a script called name"""
+
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.wall
+        record = {'script': script, 'phase': self.name, 'wall': wall,
+                  'cpu': time.process_time() - self.cpu,
+                  'maxrss_kb': peak_rss_kb(), 'rows': self.rows,
+                  'rows_per_sec': self.rows / wall
+                                  if self.rows != None and wall > 0 else None,
+                  'pid': os.getpid()}
+        if exc_type != None:
+            record['error'] = exc_type.__name__
+        emit(record)
+        return False
+
+class NullPhase:
+    """What `phase()` returns when we're not recording"""
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def __setattr__(self, name, value):
+        pass    # ignore `p.rows = n`, so this one object serves every phase
+
+NULL_PHASE = NullPhase()
+
+def phase(name, rows=None):
+    """Returns a context manager that measures the phase called name, which
+       processes rows rows (you can also set its `rows` attribute later)"""
+    if destination == None:
+        return NULL_PHASE
+    return Phase(name, rows)
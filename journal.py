@@ -0,0 +1,157 @@
+""" journal.py: An append-only journal of coding decisions
+
+Rather than holding a session's coding only in memory until it rewrites the
+whole key file, `code.py` appends each coding decision to a journal as the
+coder makes it.  If a session crashes or the coder hits Ctrl-C, the decisions
+are still in the journal, and the next session replays them.  Compaction folds
+the journal back into the key file (and its columnar cache) and removes the
+journal.
+
+Only whole conversations count.  `code.py` journals the authenticity of each
+comment as the coder answers, and then the richness of the conversation in an
+entry of its own, which closes the conversation.  Replaying applies the
+decisions about a conversation only once it finds that closing entry, so a
+session that dies partway through a conversation leaves that conversation
+uncoded rather than half coded.
+
+We flush every entry to the operating system, which is enough to survive a
+crash of the script, but we call `os.fsync`, which also survives a crash of the
+machine, only every `FSYNC_EVERY` entries or `FSYNC_SECONDS` seconds.
+
+Author: Mike Smith
+Date:   20261017
+"""
+
+import os
+import csv
+import time
+import datetime
+import columnar
+
+"""Format of the journal CSV file (no header)
+0: Conversation -- conversation number (starts at 1)
+1: Record -- index of the comment's record in the CSV files (header is 0)
+2: Authentic? -- coding for this comment, or empty in a closing entry
+3: Rich discussion? -- coding for the conversation in its closing entry, whose
+   record is the conversation's first; otherwise empty
+4: Time -- when the coder made this decision, in ISO format
+"""
+
+###
+### Global variables
+###
+
+# How often we force journal entries all the way to disk
+FSYNC_EVERY = 20
+FSYNC_SECONDS = 30
+
+###
+### Writing the journal
+###
+
+class Journal:
+    """An open journal to which we append coding decisions"""
+
+    def __init__(self, fname):
+        self.fout = open(fname, mode='a', newline='')
+        self.writer = csv.writer(self.fout, delimiter=',', quotechar='"',
+                                 quoting=csv.QUOTE_MINIMAL)
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def record(self, c, record, authentic):
+        """Append the authenticity coding of record in conversation c"""
+        self.write([c, record, authentic, ''])
+
+    def close_conversation(self, c, record, rich):
+        """Append the richness coding of conversation c, whose first record is
+           record, which completes the conversation"""
+        self.write([c, record, '', rich])
+
+    def write(self, entry):
+        """Append entry, stamped with the time"""
+        when = datetime.datetime.now().isoformat(timespec='seconds')
+        self.writer.writerow(entry + [when])
+        self.fout.flush()
+        self.unsynced += 1
+        if self.unsynced >= FSYNC_EVERY or \
+           time.monotonic() - self.last_sync >= FSYNC_SECONDS:
+            self.sync()
+
+    def sync(self):
+        """Force every entry so far all the way to disk"""
+        os.fsync(self.fout.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self.fout.close()
+
+###
+### Replaying and compacting the journal
+###
+
+def replay(fname, key_rows):
+    """Apply the decisions in journal fname, in order, to key_rows, which is the
+       list of rows of the key file including its header.  Returns the number
+       of decisions applied.  We apply the decisions about a conversation only
+       when we reach its closing entry, and we drop the decisions about a
+       conversation left unfinished, as well as a partial last entry, which is
+       what a crash in the middle of a write leaves behind."""
+    applied = 0
+    pending = []    # `(record, authentic)` decisions of the open conversation
+    open_conv = None
+    with open(fname, newline='') as fin:
+        for entry in csv.reader(fin, delimiter=','):
+            if len(entry) != 5 or not entry[0].isdigit() or \
+               not entry[1].isdigit():
+                continue
+            record = int(entry[1])
+            if record < 1 or record >= len(key_rows):
+                raise RuntimeError(f'Journal {fname} does not match key file')
+            if entry[0] != open_conv:
+                # A conversation the coder never finished
+                pending = []
+                open_conv = entry[0]
+
+            if entry[3] == '':
+                pending.append((record, entry[2]))
+                continue
+
+            # The closing entry: the conversation is complete.  Like
+            # `code.py`, we fill in every field, with the richness on the
+            # conversation's first comment and 0 on the rest.
+            for r, authentic in pending:
+                key_rows[r][5] = authentic
+                key_rows[r][6] = 0
+            key_rows[record][6] = entry[3]
+            applied += len(pending) + 1
+            pending = []
+            open_conv = None
+    return applied
+
+def write_key(fname, key_rows):
+    """Replace key file fname with key_rows, which includes the header, and
+       refresh its columnar cache.  We write a temporary file and rename it, so
+       an interruption never leaves a truncated key file behind."""
+    tmp = fname + '.tmp'
+    with open(tmp, mode='w') as kout:
+        csv_writer = csv.writer(kout, delimiter=',', quotechar='"',
+                                quoting=csv.QUOTE_MINIMAL)
+        csv_writer.writerows(key_rows)
+        kout.flush()
+        os.fsync(kout.fileno())
+    os.replace(tmp, fname)
+    columnar.save_key(fname, key_rows[0], key_rows[1:])
+
+def compact(fname, fname_key):
+    """Fold journal fname, if it exists, into key file fname_key and remove the
+       journal.  Returns the number of decisions folded in."""
+    if not os.path.exists(fname):
+        return 0
+    key_rows = list(columnar.read_key(fname_key))
+    applied = replay(fname, key_rows)
+    write_key(fname_key, key_rows)
+    os.remove(fname)
+    return applied
@@ -0,0 +1,113 @@
+""" metrics.py: Vectorized per-conversation metrics for `analyze.py`
+
+Rather than walking the `all-years` records one at a time, we derive an array
+that gives the conversation number of every comment from the `Reply` column and
+then compute each per-conversation metric with a segmented reduction over the
+per-comment columns.
+
+Author: Mike Smith
+Date:   20261017
+"""
+
+import numpy as np
+from columnar import UNCODED
+
+###
+### Global variables
+###
+
+# The per-conversation metrics we compute, in the order `analyze.py` reports
+# them and writes them to the `<year>-conversations.csv` files
+C_COMMENTS = 0
+C_STUDENTS = 1
+C_UPVOTES = 2
+C_WORDS = 3
+C_AUTHENTIC = 4
+C_RICH = 5
+C_SENTENCES = 6
+C_CHARACTERS = 7
+C_TTR = 8        # mean over the conversation's comments
+C_QUESTIONS = 9
+C_URLS = 10      # comments with a URL
+C_CODE = 11      # comments with a code snippet
+C_END = 12       # marks end of list of conversation characteristics
+
+# Column headers in the `<year>-conversations.csv` files
+HEADERS = ['Comments', 'Students', 'Upvotes', 'Words', 'Authenticity score',
+           'Richness score', 'Sentences', 'Characters', 'Type/token ratio',
+           'Question marks', 'URLs', 'Code snippets']
+
+###
+### Segmented reductions
+###
+
+def coded_comments(key):
+    """Returns a mask of the records in the key columns whose comment is
+       coded.  Coding needn't proceed from the top down: `build.py -add`
+       scatters uncoded conversations among the coded ones, and `serve.py`
+       hands out conversations in any order."""
+    return (key['authentic'] != UNCODED) & (key['rich'] != UNCODED)
+
+def coded_conversations(reply, key):
+    """Returns a mask of the records in the key columns that belong to a
+       conversation whose every comment is coded"""
+    conv = conversation_ids(reply)
+    num_conversations = int(conv[-1]) + 1 if len(conv) > 0 else 0
+    uncoded = np.bincount(conv[~coded_comments(key)],
+                          minlength=num_conversations)
+    return uncoded[conv] == 0
+
+def conversation_starts(reply):
+    """Returns the indices of the comments that start a conversation"""
+    if len(reply) > 0 and reply[0] != 0:
+        raise RuntimeError('First record does not start a conversation')
+    return np.flatnonzero(reply == 0)
+
+def conversation_ids(reply):
+    """Returns the 0-based conversation number of every comment"""
+    return np.cumsum(reply == 0) - 1
+
+def distinct_per_conversation(conv, values, num_conversations):
+    """Returns the number of distinct values in each conversation, given the
+       conversation number of each comment"""
+    order = np.lexsort((values, conv))
+    c = conv[order]
+    v = values[order]
+    first = np.ones(len(c), dtype=bool)
+    first[1:] = (c[1:] != c[:-1]) | (v[1:] != v[:-1])
+    return np.bincount(c[first], minlength=num_conversations)
+
+def sum_per_conversation(starts, values):
+    """Returns the sum of values over each conversation"""
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.add.reduceat(values.astype(np.int64), starts)
+
+def mean_per_conversation(starts, values, comments):
+    """Returns the mean of values over each conversation, given the number of
+       comments in each"""
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.float64)
+    return np.add.reduceat(values.astype(np.float64), starts) / comments
+
+def conversation_metrics(reply, student, upvotes, features, authentic, rich):
+    """Given per-comment columns, including the dictionary of text features
+       from `textfeatures.extract()`, returns a list indexed by the `C_*`
+       constants of arrays holding that metric for each conversation"""
+    starts = conversation_starts(reply)
+    conv = conversation_ids(reply)
+
+    m = [None] * C_END
+    m[C_COMMENTS] = np.diff(np.append(starts, len(reply)))
+    m[C_STUDENTS] = distinct_per_conversation(conv, student, len(starts))
+    m[C_UPVOTES] = sum_per_conversation(starts, upvotes)
+    m[C_WORDS] = sum_per_conversation(starts, features['words'])
+    m[C_AUTHENTIC] = sum_per_conversation(starts, authentic)
+    m[C_RICH] = sum_per_conversation(starts, rich)
+    m[C_SENTENCES] = sum_per_conversation(starts, features['sentences'])
+    m[C_CHARACTERS] = sum_per_conversation(starts, features['characters'])
+    m[C_TTR] = mean_per_conversation(starts, features['ttr'], m[C_COMMENTS])
+    m[C_QUESTIONS] = sum_per_conversation(starts, features['questions'])
+    m[C_URLS] = sum_per_conversation(starts, features['has_url'])
+    m[C_CODE] = sum_per_conversation(starts, features['has_code'])
+    return m
@@ -0,0 +1,287 @@
+""" mixed.py: Linear mixed models with crossed random intercepts for student and
+    document
+
+The same pseudonymous student writes many comments, and the same document is
+read in several years, so the comments aren't independent.  This fits
+
+    outcome ~ year + (1 | student) + (1 | document)
+
+by REML, as `lmer()` in `lme4` would, for the authenticity score (on the coded
+comments) and for upvotes (on every comment).
+
+We follow the formulation in `lme4`.  For relative standard deviations theta,
+the random effects enter as `Z Lambda u` with `u` penalized by `|u|^2`, and the
+profiled REML criterion needs the Cholesky factor of `A = Lambda' Z'Z Lambda +
+I`.  Since each comment has exactly one student and one document, `A` has two
+diagonal blocks, one per factor, and an off-diagonal block given by the sparse
+table of comments by student and document.  We order the factor with more
+levels (normally students) first, so its block of the factor is just a
+diagonal, and only the Schur complement for the other factor is dense.  We
+never form `Z` or any other matrix with a row per comment besides the small
+fixed-effects matrix, so 10^6 comments and 10^4 students fit easily in memory.
+
+Author: Mike Smith
+Date:   20261017
+"""
+
+import sys
+import math
+import numpy as np
+import columnar
+from metrics import coded_comments
+from significance import f_pvalue, t_pvalue
+
+###
+### Global variables
+###
+
+FNAME_KEY = 'annotations/all-years.key.csv'
+
+# The outcomes we model: the name we print, the key column, and whether only
+# the coded records count
+OUTCOMES = [('authentic', 'authentic', True), ('upvotes', 'upvotes', False)]
+
+# The grouping factors, each a key column
+FACTORS = ['student', 'document']
+
+# Largest number of entries in a block of dense rows of the table of comments
+# by student and document
+MAX_ELEMENTS = 1 << 22
+
+# When to stop optimizing the REML criterion
+TOLERANCE = 1e-10
+MAX_ITERATIONS = 1000
+
+###
+### Some helper functions
+###
+
+def factor(values):
+    """Returns the pair `(levels, codes)` for the values of a categorical
+       variable, where codes gives the index of each value in levels"""
+    levels, codes = np.unique(values, return_inverse=True)
+    return levels, codes.ravel()
+
+def group_sums(codes, values, num_groups):
+    """Returns the sums of the columns of the (n, k) array values within each
+       group, as a (num_groups, k) array"""
+    return np.stack([np.bincount(codes, weights=values[:, j],
+                                 minlength=num_groups)
+                     for j in range(values.shape[1])], axis=1)
+
+def nelder_mead(f, x0, step=0.5):
+    """Returns the point near x0 that minimizes function f, found with the
+       Nelder-Mead simplex method"""
+    n = len(x0)
+    simplex = [np.array(x0, dtype=np.float64)]
+    for i in range(n):
+        x = simplex[0].copy()
+        x[i] += step
+        simplex.append(x)
+    values = [f(x) for x in simplex]
+
+    for _ in range(MAX_ITERATIONS):
+        order = np.argsort(values)
+        simplex = [simplex[i] for i in order]
+        values = [values[i] for i in order]
+        if abs(values[-1] - values[0]) <= TOLERANCE * (1 + abs(values[0])):
+            break
+
+        centroid = np.mean(simplex[:-1], axis=0)
+        reflected = centroid + (centroid - simplex[-1])
+        fr = f(reflected)
+        if fr < values[0]:
+            expanded = centroid + 2 * (centroid - simplex[-1])
+            fe = f(expanded)
+            simplex[-1], values[-1] = (expanded, fe) if fe < fr \
+                                      else (reflected, fr)
+        elif fr < values[-2]:
+            simplex[-1], values[-1] = reflected, fr
+        else:
+            contracted = centroid + 0.5 * (simplex[-1] - centroid)
+            fc = f(contracted)
+            if fc < values[-1]:
+                simplex[-1], values[-1] = contracted, fc
+            else:
+                # Shrink everything toward the best point
+                for i in range(1, n + 1):
+                    simplex[i] = simplex[0] + 0.5 * (simplex[i] - simplex[0])
+                    values[i] = f(simplex[i])
+    return simplex[int(np.argmin(values))]
+
+###
+### The model
+###
+
+class MixedModel:
+    """The sufficient statistics of `y ~ X + (1 | a) + (1 | b)`, where X holds
+       the fixed effects and a and b are the grouping factors, with a the one
+       with more levels"""
+
+    def __init__(self, y, X, a_codes, num_a, b_codes, num_b):
+        self.n, self.p = X.shape
+        self.num_a, self.num_b = num_a, num_b
+        Xy = np.column_stack([X, y])
+
+        # Cross products of the fixed effects and the outcome
+        self.XyXy = Xy.T @ Xy
+        self.Za_Xy = group_sums(a_codes, Xy, num_a)
+        self.Zb_Xy = group_sums(b_codes, Xy, num_b)
+        self.Da = np.bincount(a_codes, minlength=num_a).astype(np.float64)
+        self.Db = np.bincount(b_codes, minlength=num_b).astype(np.float64)
+
+        # The table of comments by a and b, as sparse `(a, b, count)` entries
+        cells, counts = np.unique(a_codes * num_b + b_codes, return_counts=True)
+        self.na = cells // num_b
+        self.nb = cells % num_b
+        self.nc = counts.astype(np.float64)
+
+        # Where each block of block_rows levels of a starts among the entries
+        self.block_rows = max(1, MAX_ELEMENTS // max(1, num_b))
+        self.block_starts = np.searchsorted(
+            self.na, np.arange(0, num_a + self.block_rows, self.block_rows))
+
+    def NtWN(self, w):
+        """Returns the dense (num_b, num_b) matrix N' diag(w) N.  We expand N
+           into dense rows a block at a time, so memory stays bounded."""
+        result = np.zeros((self.num_b, self.num_b))
+        for k in range(len(self.block_starts) - 1):
+            lo, hi = self.block_starts[k], self.block_starts[k + 1]
+            if lo == hi:
+                continue
+            first = k * self.block_rows
+            rows = self.na[lo:hi] - first
+            block = np.zeros((int(rows[-1]) + 1, self.num_b))
+            block[rows, self.nb[lo:hi]] = self.nc[lo:hi]
+            result += block.T @ (block * w[first:first + len(block), None])
+        return result
+
+    def Nt(self, M):
+        """Returns N' M for the (num_a, k) array M"""
+        return group_sums(self.nb, self.nc[:, None] * M[self.na], self.num_b)
+
+    def N(self, M):
+        """Returns N M for the (num_b, k) array M"""
+        return group_sums(self.na, self.nc[:, None] * M[self.nb], self.num_a)
+
+    def solve(self, theta):
+        """Returns the tuple `(logdet_A, S, G)` for relative standard deviations
+           theta, where S is the Schur complement of the fixed effects and G
+           is the whole profiled cross-product matrix of `[X y]`"""
+        ta, tb = theta
+        diag_a = ta * ta * self.Da + 1
+
+        # The dense Schur complement of the a block of A
+        B = np.diag(tb * tb * self.Db + 1) - \
+            (ta * tb) ** 2 * self.NtWN(1 / diag_a)
+        L = np.linalg.cholesky(B)
+        logdet_A = np.log(diag_a).sum() + 2 * np.log(np.diag(L)).sum()
+
+        # Solve A W = V for V = Lambda Z' [X y] by block elimination
+        Va = ta * self.Za_Xy
+        Vb = tb * self.Zb_Xy
+        Wb = np.linalg.solve(B, Vb - ta * tb * self.Nt(Va / diag_a[:, None]))
+        Wa = (Va - ta * tb * self.N(Wb)) / diag_a[:, None]
+
+        G = self.XyXy - Va.T @ Wa - Vb.T @ Wb
+        return logdet_A, G[:self.p, :self.p], G
+
+    def reml(self, theta):
+        """Returns the profiled REML criterion (-2 log likelihood) at theta"""
+        theta = np.abs(theta)
+        logdet_A, S, G = self.solve(theta)
+        p = self.p
+        beta = np.linalg.solve(S, G[:p, p])
+        r2 = G[p, p] - G[p, :p] @ beta
+        df = self.n - p
+        logdet_S = np.linalg.slogdet(S)[1]
+        return logdet_A + logdet_S + df * (1 + math.log(2 * math.pi * r2 / df))
+
+    def fit(self):
+        """Returns a dictionary with the REML estimates: `theta`, `beta`, the
+           covariance `cov` of beta, the residual variance `sigma2`, and the
+           criterion `reml`"""
+        theta = np.abs(nelder_mead(self.reml, [1.0, 1.0]))
+        _, S, G = self.solve(theta)
+        p = self.p
+        beta = np.linalg.solve(S, G[:p, p])
+        sigma2 = (G[p, p] - G[p, :p] @ beta) / (self.n - p)
+        return {'theta': theta, 'beta': beta, 'sigma2': sigma2,
+                'cov': sigma2 * np.linalg.inv(S), 'reml': self.reml(theta)}
+
+###
+### Main routines
+###
+
+def fit(y, year, student, document):
+    """Fit `y ~ year + (1 | student) + (1 | document)` by REML and return a
+       dictionary of results"""
+    y = np.asarray(y, dtype=np.float64)
+    years, year_codes = factor(year)
+    X = np.ones((len(y), len(years)))
+    X[:, 1:] = year_codes[:, None] == np.arange(1, len(years))[None, :]
+    names = ['(Intercept)'] + [f'year{yr}' for yr in years[1:]]
+
+    # Eliminate the factor with more levels first
+    factors = [(name,) + factor(values)
+               for name, values in zip(FACTORS, (student, document))]
+    factors.sort(key=lambda f: -len(f[1]))
+    (a_name, a_levels, a_codes), (b_name, b_levels, b_codes) = factors
+
+    model = MixedModel(y, X, a_codes, len(a_levels), b_codes, len(b_levels))
+    r = model.fit()
+
+    se = np.sqrt(np.diag(r['cov']))
+    df = model.n - model.p
+    fixed = [(name, b, s, b / s, t_pvalue(b / s, df))
+             for name, b, s in zip(names, r['beta'], se)]
+
+    # Wald test of all the year terms together
+    if len(years) > 1:
+        b = r['beta'][1:]
+        wald = b @ np.linalg.solve(r['cov'][1:, 1:], b) / len(b)
+        year_test = (len(b), df, wald, f_pvalue(wald, len(b), df))
+    else:
+        year_test = None
+
+    variances = {a_name: r['sigma2'] * r['theta'][0] ** 2,
+                 b_name: r['sigma2'] * r['theta'][1] ** 2,
+                 'residual': r['sigma2']}
+    levels = {a_name: len(a_levels), b_name: len(b_levels)}
+    return {'n': model.n, 'fixed': fixed, 'year': year_test,
+            'variances': variances, 'levels': levels, 'reml': r['reml']}
+
+def print_fit(name, result):
+    print(f'*** {name} ~ year + (1 | student) + (1 | document) ***')
+    print(f"  REML criterion = {result['reml']:.6g}, "
+          f"n = {result['n']}, students = {result['levels']['student']}, "
+          f"documents = {result['levels']['document']}")
+    print('  Random effects (variance, std. dev.):')
+    for group in ('student', 'document', 'residual'):
+        v = result['variances'][group]
+        print(f'    {group:10}{v:>14.6g}{math.sqrt(v):>14.6g}')
+    print('  Fixed effects (estimate, std. error, t, p):')
+    for label, b, s, t, p in result['fixed']:
+        print(f'    {label:12}{b:>14.6g}{s:>14.6g}{t:>10.4g}{p:>12.4g}')
+    if result['year'] != None:
+        df1, df2, f, p = result['year']
+        print(f'  Year (Wald): F({df1}, {df2}) = {f:.4g}, p = {p:.4g}')
+    print('')
+
+def main():
+    if len(sys.argv) != 1:
+        sys.exit('Usage: python3 mixed.py')
+
+    key = columnar.load_key(FNAME_KEY)
+    coded = coded_comments(key)
+    for name, column, only_coded in OUTCOMES:
+        records = coded if only_coded else slice(None)
+        if len(key[column][records]) == 0:
+            print(f'No coded records for {name}\n')
+            continue
+        print_fit(name, fit(key[column][records], key['year'][records],
+                            key['student'][records],
+                            key['document'][records]))
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,15 @@
-""" overlap.py: Given two CSV files of Perusall annotations, build a
-    dictionary of document titles that indicates to which year a
-    document belongs. The answer is year1-only, year2-only, or
-    both years.
+""" overlap.py: Given two or more CSV files of Perusall annotations, build
+    a dictionary of document titles that indicates to which years a
+    document belongs. The answer for each document is an integer
+    bitmask in which bit i is set if the document appears in the
+    i-th file.
 Author: Mike Smith
 Date:   20210903
 """
 
 import sys
-import csv
+import instrument
+from chunked import read_rows
 
 """Expected format of input Perusall-annotation CSV files
 0: Last name, 1: First name, 2: Student ID
@@ -24,86 +26,104 @@ import csv
 # Dictionaries built for each dataset in files
 dicts = []
 
+###
+### Helper functions for querying the document catalog.  Each takes a
+### document's bitmask and answers in constant time.
+###
+
+def year_bit(i):
+    """Returns the bitmask for just the i-th input file"""
+    return 1 << i
+
+def years_mask(indices):
+    """Returns the bitmask for the set of input files with the given indices"""
+    mask = 0
+    for i in indices:
+        mask |= year_bit(i)
+    return mask
+
+def common_to(mask, years):
+    """Returns True if a document with bitmask mask appears in every year in
+       the bitmask years"""
+    return mask & years == years
+
+def unique_to(mask, i):
+    """Returns True if a document with bitmask mask appears only in the i-th
+       input file"""
+    return mask == year_bit(i)
+
+def add_document(docs, doc, i):
+    """Record that document title doc appears in the i-th input file"""
+    docs[doc] = docs.get(doc, 0) | year_bit(i)
+
+def label(mask, years):
+    """Returns a printable description of a bitmask, given the list of year
+       names corresponding to the input files"""
+    return '+'.join(yr for i, yr in enumerate(years) if mask & year_bit(i))
+
+def report(docs, years):
+    """Print how many documents appear in each year and in all years"""
+    for i, yr in enumerate(years):
+        cnt = 0
+        for doc in docs:
+            if docs[doc] & year_bit(i):
+                cnt += 1
+        print(f'{cnt} documents in {yr}')
+
+    everyone = years_mask(range(len(years)))
+    cnt_overlap = 0
+    for doc in docs:
+        if common_to(docs[doc], everyone):
+            cnt_overlap += 1
+    print(f'{cnt_overlap} documents in all years')
+
+###
+### Main routines
+###
+
 def overlap(files):
-    """Compute the overlap across two years in documents used
+    """Compute the overlap across years in documents used
 
-    Input:   A list of exactly two filenames
+    Input:   A list of one or more filenames
     Output:  A dictionary of document titles. The value of each dictionary
-             is year1, year2, or `'both'`.
+             is a bitmask in which bit i is set if the document appears in
+             `files[i]`.
     Assumes: The name of a file without its `.csv` extension is a year
              (e.g., 2021).
     """
-    assert(len(files) == 2)
+    assert(len(files) > 0)
 
     docs = {}
 
-    # Process the first input file. It's easy because every unique
-    # document is just associated by default with this first year.
-    fname = files[0]
-    yr1 = fname.split('.')[0]
-
-    with open(f'annotations/{fname}') as fin:
-        csv_reader = csv.reader(fin, delimiter=',')
+    for i, fname in enumerate(files):
         line = 0
 
-        for row in csv_reader:
-            if line != 0:    # skipping header row
-                docs[row[11]] = yr1
-            line += 1
+        with instrument.phase(f'read {fname}') as p:
+            for row in read_rows(f'annotations/{fname}'):
+                if line != 0:    # skipping header row
+                    add_document(docs, row[11], i)
+                line += 1
+            p.rows = line
 
         print(f'Processed {line} lines in {fname}')
-    print(f'{len(docs)} documents in {yr1}')
 
-    # Process the second input file. A little tricker since we have
-    # to notice actual overlaps.
-    fname = files[1]
-    yr2 = fname.split('.')[0]
-
-    with open(f'annotations/{fname}') as fin:
-        csv_reader = csv.reader(fin, delimiter=',')
-        line = 0
-
-        for row in csv_reader:
-            if line != 0:    # skipping header row
-                doc = row[11]
-                if docs.get(doc) == None:
-                    # First time we've seen this title
-                    docs[doc] = yr2
-                elif docs.get(doc) != yr2:
-                    # Might be other year or "both", but in any case, write "both"
-                    docs[doc] = 'both'
-                # else already recorded that it's just in this year
-            line += 1
-
-        print(f'Processed {line} lines in {yr2}')
-
-    cnt_yr2 = 0
-    cnt_overlap = 0
-    for doc in docs:
-        if docs.get(doc) == yr2:
-            cnt_yr2 += 1
-        if docs.get(doc) == 'both':
-            cnt_yr2 += 1
-            cnt_overlap += 1
-    print(f'{cnt_yr2} documents in {yr2}')
-    print(f'{cnt_overlap} documents in both years')
+    report(docs, [fname.split('.')[0] for fname in files])
 
     return docs
 
 
 def main():
-    files = []
+    files = sys.argv[1:]
 
-    if len(sys.argv) != 3:
-        sys.exit('Usage: python3 overlap.py [year1].csv [year2].csv')
-    files.append(sys.argv[1])
-    files.append(sys.argv[2])
+    if len(files) < 2:
+        sys.exit('Usage: python3 overlap.py [year1].csv [year2].csv ...')
 
     docs = overlap(files)
+    years = [fname.split('.')[0] for fname in files]
 
-    print('In what year does a document appear?')
+    print('In what years does a document appear?')
     for doc in docs:
-        print(f'{docs[doc]}: {doc}')
+        print(f'{label(docs[doc], years)}: {doc}')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,401 @@
+""" pipeline.py: Runs build, fixup, analyze, tenpc, and export in one process
+
+Run by hand, each script reads the `all-years` files that the one before it
+wrote.  This script runs the same stages as a small DAG in one process, handing
+the dataset from stage to stage in memory:
+
+    build --> fixup --+--> analyze
+                      +--> tenpc
+                      +--> export
+
+Each stage's output is cached in `annotations/cache`, under the hash of
+everything it depends on: the hashes of its upstream stages (or, for build, of
+the input files and the salt of the student store), its parameters (the seed,
+the years, the instructor roster, `PERCENT_GRABBED`, ...), and the source code
+of the scripts that implement it.
+A rerun loads the output of a stage whose hash hasn't changed instead of
+running it, and it never loads a stage that no later stage needs.  Without a
+seed, the shuffle changes every run, so nothing is cached.
+
+The coding done with `code.py` lives only in `all-years.key.csv`, so analyze,
+tenpc, and export take their coding from that file, and its hash is one of
+their inputs.  We write the `all-years` files only when the fixed-up dataset
+differs from what's on disk, and since that replaces the key file, we refuse if
+the key file holds any coding, unless you say `-force`.  We also record what
+we wrote (the data file's size and modification time, and a hash of the key
+file without its coding), so we notice when something else, like a manual run
+of `build.py`, replaces the files behind our back.
+
+Author: Mike Smith
+Date:   20261017
+"""
+
+import os
+import sys
+import csv
+import json
+import pickle
+import random
+import hashlib
+import columnar
+import instrument
+import build
+import export
+import fixup
+import students
+import tenpc
+from analyze import analyze, print_results, write_conversations
+from metrics import coded_comments
+
+###
+### Global variables
+###
+
+CACHE_DIR = 'annotations/cache'
+FNAME_STATE = CACHE_DIR + '/state.json'
+
+# Where the pipeline scripts live
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The stages each stage takes its input from
+DEPENDS = {'build': [], 'fixup': ['build'], 'analyze': ['fixup'],
+           'tenpc': ['fixup'], 'export': ['fixup']}
+
+# The scripts whose code determines each stage's output
+SOURCES = {
+    'build': ['build.py', 'ingest.py', 'overlap.py', 'chunked.py',
+              'students.py'],
+    'fixup': ['fixup.py'],
+    'analyze': ['analyze.py', 'metrics.py', 'textfeatures.py', 'columnar.py'],
+    'tenpc': ['tenpc.py'],
+    'export': ['export.py', 'metrics.py', 'textfeatures.py', 'columnar.py'],
+}
+
+###
+### Some helper functions
+###
+
+class Rows(list):
+    """A list that stands in for a `csv.writer`, collecting the rows written"""
+
+    def writerow(self, row):
+        self.append(row)
+
+    def writerows(self, rows):
+        self.extend(rows)
+
+def source_hash(stage):
+    """Returns the hash of the source code of the scripts behind stage"""
+    h = hashlib.sha256()
+    for fname in SOURCES[stage]:
+        with open(os.path.join(SRC_DIR, fname), mode='rb') as fin:
+            h.update(fin.read())
+    return h.hexdigest()
+
+def stage_key(stage, params, upstream):
+    """Returns the cache key of stage, given the dictionary of its parameters
+       and the keys of the stages it depends on, or None if any of those is
+       None (i.e., the stage can't be cached)"""
+    if None in upstream or None in params.values():
+        return None
+    inputs = {'stage': stage, 'params': params, 'upstream': upstream,
+              'source': source_hash(stage)}
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()) \
+                  .hexdigest()
+
+def cache_file(stage, key):
+    return f'{CACHE_DIR}/{stage}-{key}.pickle'
+
+def load_cached(stage, key):
+    """Returns the cached output of stage with key, or None"""
+    if key == None or not os.path.exists(cache_file(stage, key)):
+        return None
+    with open(cache_file(stage, key), mode='rb') as fin:
+        return pickle.load(fin)
+
+def save_cached(stage, key, output):
+    """Cache the output of stage under key, replacing older outputs of it"""
+    if key == None:
+        return
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fname = cache_file(stage, key)
+    with open(fname + '.tmp', mode='wb') as fout:
+        pickle.dump(output, fout, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(fname + '.tmp', fname)
+    for old in os.listdir(CACHE_DIR):
+        if old.startswith(stage + '-') and old.endswith('.pickle') and \
+           f'{CACHE_DIR}/{old}' != fname:
+            os.remove(f'{CACHE_DIR}/{old}')
+
+def read_state():
+    """Returns the dictionary mapping each set of output files to the key of
+       the stage that last wrote them"""
+    if not os.path.exists(FNAME_STATE):
+        return {}
+    with open(FNAME_STATE) as fin:
+        return json.load(fin)
+
+def write_state(state):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(FNAME_STATE, mode='w') as fout:
+        json.dump(state, fout, indent=1)
+
+def as_strings(conversations):
+    """Returns the conversations with every field a string, just as a reader
+       of the `all-years` CSV files would see them"""
+    return [[([str(x) for x in d_row], [str(x) for x in k_row])
+             for d_row, k_row in conversation]
+            for conversation in conversations]
+
+def on_disk():
+    """Returns what identifies the dataset in the `all-years` files on disk,
+       or None if they're missing: the size and modification time of the data
+       file, which only a build rewrites, and the hash of the key file's
+       columns other than the coding, which `code.py` and `serve.py` change"""
+    if not os.path.exists(build.FNAME_DATA) or \
+       not os.path.exists(build.FNAME_KEY):
+        return None
+    st = os.stat(build.FNAME_DATA)
+    key = columnar.load_key(build.FNAME_KEY)
+    h = hashlib.sha256()
+    for name in sorted(key):
+        if name not in ('authentic', 'rich'):
+            h.update(key[name].tobytes())
+    return [st.st_size, st.st_mtime_ns, h.hexdigest()]
+
+def read_coding():
+    """Returns the pair `(authentic, rich)` of coding columns in the key
+       file"""
+    key = columnar.load_key(build.FNAME_KEY)
+    return key['authentic'], key['rich']
+
+###
+### The DAG
+###
+
+class Pipeline:
+    """The stages of the pipeline, each run (or loaded from the cache) at
+       most once and only when a later stage needs its output"""
+
+    def __init__(self, files, selected, years, seed, percent, stratify):
+        self.files, self.selected, self.years = files, selected, years
+        self.seed, self.percent, self.stratify = seed, percent, stratify
+        self.outputs = {}
+
+        # The student ids depend on the salt of the student store, so make
+        # sure it exists
+        students.StudentStore().close()
+
+        # The keys depend only on the inputs, so we know them all up front
+        self.keys = {}
+        self.keys['build'] = stage_key('build', {
+            'inputs': {fname: build.file_hash(f'annotations/{fname}')
+                       for fname in files},
+            'selected': selected, 'seed': seed,
+            'instructors': {fname: build.instructors[fname]
+                            for fname in selected},
+            'students': build.file_hash(students.FNAME_SALT)}, [])
+        self.keys['fixup'] = stage_key('fixup', {}, self.upstream('fixup'))
+
+    def upstream(self, stage):
+        """Returns the keys of the stages that stage depends on"""
+        return [self.keys[upstream] for upstream in DEPENDS[stage]]
+
+    def output(self, stage):
+        """Returns the output of stage, from memory, the cache, or by running
+           it"""
+        if stage in self.outputs:
+            return self.outputs[stage]
+        key = self.keys[stage]
+        with instrument.phase(f'load {stage}'):
+            out = load_cached(stage, key)
+        if out == None:
+            for upstream in DEPENDS[stage]:
+                self.output(upstream)
+            print(f'--- Running {stage}')
+            out = getattr(self, 'run_' + stage)()
+            save_cached(stage, key, out)
+        else:
+            print(f'--- Using cached {stage}')
+        self.outputs[stage] = out
+        return out
+
+    def run_build(self):
+        all_years, spans, manifest = build.assemble(self.files, self.selected,
+                                                    self.seed)
+        return as_strings(build.conversation_rows(all_years, span)
+                          for span in spans), manifest
+
+    def run_fixup(self):
+        conversations, manifest = self.output('build')
+        report = Rows()
+        with instrument.phase('fixup'):
+            corrections = fixup.fixup(conversations, report)
+        print(f'{corrections} corrections')
+        return conversations, manifest, report
+
+    def run_analyze(self):
+        conversations, _, _ = self.output('fixup')
+        with instrument.phase('columns'):
+            data = columnar.data_columns(
+                build.DATA_HEADER, [d_row for conversation in conversations
+                                    for d_row, k_row in conversation])
+            key = columnar.key_columns(
+                build.KEY_HEADER, [k_row for conversation in conversations
+                                   for d_row, k_row in conversation])
+        key['authentic'], key['rich'] = self.coding
+        return analyze(self.years, data, key)
+
+    def run_tenpc(self):
+        conversations, _, _ = self.output('fixup')
+        authentic, rich = self.coding
+        rows = ((d_row, k_row[:5] + [columnar.decode_code(a),
+                                     columnar.decode_code(r)])
+                for (d_row, k_row), a, r in zip(
+                    (pair for conversation in conversations
+                          for pair in conversation),
+                    authentic.tolist(), rich.tolist()))
+        ar_rows = Rows([tenpc.NEW_HEADER])
+        random.seed(self.seed)
+        with instrument.phase('sample'):
+            chosen, seen = tenpc.sample(tenpc.read_conversations(rows,
+                                                                 ar_rows),
+                                        self.percent, self.stratify)
+        return ar_rows, chosen, seen
+
+    def write_all_years(self, force):
+        """Make sure the `all-years` files on disk hold the fixed-up dataset,
+           and then read the coding from them"""
+        state = read_state()
+        key = self.keys['fixup']
+        stamp = on_disk()
+        if key != None and state.get('all-years') == key and \
+           stamp != None and state.get('on disk') != stamp:
+            print('--- The all-years files changed since the pipeline '
+                  'wrote them')
+        if key == None or state.get('all-years') != key or \
+           stamp == None or state.get('on disk') != stamp:
+            if os.path.exists(build.FNAME_KEY) and not force:
+                authentic, _ = read_coding()
+                if (authentic != columnar.UNCODED).any():
+                    sys.exit(f'{build.FNAME_KEY} holds coding that a new '
+                             'all-years would discard (use -force)')
+            conversations, manifest, report = self.output('fixup')
+            build.write_all_years(conversations)
+            build.write_manifest(manifest)
+            with open(fixup.FNAME_REPORT, mode='w') as rout:
+                csv_writer = csv.writer(rout, delimiter=',', quotechar='"',
+                                        quoting=csv.QUOTE_MINIMAL)
+                csv_writer.writerow(fixup.REPORT_HEADER)
+                csv_writer.writerows(report)
+            print(f'Wrote {len(report)} corrections to {fixup.FNAME_REPORT}')
+            state = {'all-years': key, 'on disk': on_disk()}
+            write_state(state)
+
+        # The downstream stages also depend on the coding
+        self.coding = read_coding()
+        h = hashlib.sha256()
+        for column in self.coding:
+            h.update(column.tobytes())
+        coding = h.hexdigest()
+        self.keys['analyze'] = stage_key('analyze', {'years': self.years,
+                                                     'coding': coding},
+                                         self.upstream('analyze'))
+        self.keys['tenpc'] = stage_key('tenpc', {
+            'percent': self.percent, 'seed': self.seed,
+            'stratify': self.stratify, 'coding': coding},
+            self.upstream('tenpc'))
+        self.keys['export'] = stage_key('export', {'coding': coding},
+                                        self.upstream('export'))
+        return state
+
+    def run(self, force=False):
+        state = self.write_all_years(force)
+
+        # The analysis needs coding, but the sample doesn't
+        authentic, rich = self.coding
+        if not coded_comments({'authentic': authentic, 'rich': rich}).any():
+            print('--- Skipping analyze: no coded records')
+        else:
+            m, num_comments, num_conversations, record = \
+                self.output('analyze')
+            print(f'Processed {record} data records\n')
+            print_results(self.years, m, num_comments, num_conversations)
+            if state.get('analyze') != self.keys['analyze'] or \
+               self.keys['analyze'] == None:
+                write_conversations(self.years, m)
+                state['analyze'] = self.keys['analyze']
+
+        ar_rows, chosen, seen = self.output('tenpc')
+        if state.get('tenpc') != self.keys['tenpc'] or \
+           self.keys['tenpc'] == None:
+            with open(tenpc.FNAME_ARNEW, mode='w') as fout:
+                csv.writer(fout, delimiter=',', quotechar='"',
+                           quoting=csv.QUOTE_MINIMAL).writerows(ar_rows)
+            print(f'Wrote {tenpc.FNAME_ARNEW}')
+            tenpc.write_tbcoded(chosen)
+            grabbed = sum(len(comments) for c, comments in chosen)
+            print(f'Wrote {tenpc.FNAME_TBNEW} with {len(chosen)} '
+                  f'conversations ({grabbed} of {seen} comments)')
+            state['tenpc'] = self.keys['tenpc']
+
+        # The export reads the all-years files on disk, so there's nothing
+        # to cache but the fact that its files are up to date
+        if export.pa is None:
+            print('--- Skipping export: PyArrow is not installed')
+        elif state.get('export') != self.keys['export'] or \
+             self.keys['export'] == None:
+            print('--- Running export')
+            export.export_all_years()
+            state['export'] = self.keys['export']
+        write_state(state)
+
+###
+### Main routines
+###
+
+def main():
+    usage = ('Usage: python3 pipeline.py yr1.csv yr2.csv ... [-seed N] '
+             '[-years Y1,Y2,...]\n'
+             '       [-percent P] [-stratify] [-force]')
+    files = []
+    selected = []
+    seed = None
+    percent = tenpc.PERCENT_GRABBED
+    stratify = False
+    force = False
+    args = sys.argv[1:]
+    try:
+        while args:
+            arg = args.pop(0)
+            if arg == '-seed':
+                seed = int(args.pop(0))
+            elif arg == '-years':
+                selected = [f'{yr}.csv' for yr in args.pop(0).split(',')]
+            elif arg == '-percent':
+                percent = float(args.pop(0))
+            elif arg == '-stratify':
+                stratify = True
+            elif arg == '-force':
+                force = True
+            elif arg.startswith('-'):
+                sys.exit(usage)
+            else:
+                files.append(arg)
+    except (IndexError, ValueError):
+        sys.exit(usage)
+
+    if len(files) < 2 or percent <= 0 or percent > 100:
+        sys.exit(usage)
+    if selected == []:
+        selected = files
+    elif len(selected) < 2 or any(fname not in files for fname in selected):
+        sys.exit(usage)
+    if seed == None:
+        print('Without -seed, nothing is cached')
+
+    years = [fname.split('.')[0] for fname in selected]
+    Pipeline(files, selected, years, seed, percent, stratify).run(force)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,463 @@
+""" prescore.py: Predicts the coding of uncoded conversations to prioritize the
+    coding queue
+
+Hand-coding is the slow step of our pipeline.  This script learns from the
+comments coded so far to predict the codes of the rest, so the coders' time
+goes where it tells us the most.  It runs offline and needs only NumPy.
+
+We represent each comment by the hashed TF-IDF weights of its words and word
+pairs, and each conversation by the sum of its comments' vectors.  A softmax
+(multinomial logistic) regression with an L2 penalty, fit by L-BFGS,
+predicts the authenticity of each comment and the richness
+of each conversation.  A conversation's uncertainty is the mean of the
+normalized entropy of its richness prediction and the average normalized
+entropy of its comments' authenticity predictions, so 0 means the model is
+sure and 1 means it has no idea.
+
+We write the predictions to `all-years.predictions.csv`.  For the coded
+comments, the predictions are out of fold: we split the coded conversations
+into `FOLDS` folds and predict each fold from a model fit to the others, so
+comparing them to the codes is an honest calibration study.  The uncoded
+comments get the predictions of a model fit to every coded comment.  We fit
+only the coded rows and stop once the gradient is within `TOLERANCE` of zero.
+
+Coding grows a little between runs, so each run saves the weights of its
+models in `all-years.prescore.npz` and the next run starts each model from
+where the same model left off, which takes far fewer steps than starting from
+zero.  The seed fixes the fold of every conversation, coded or not, so a fold's
+model never starts from weights that saw the comments it predicts.  A new
+dataset or seed starts from zero.
+
+We also print the most uncertain uncoded conversations, and `serve.py` hands
+out the uncoded conversations in decreasing order of uncertainty.
+
+Coders must never see the predictions.  Keep the predictions file with the key
+file; neither `code.py` nor `serve.py` ever shows it to a coder.
+
+Author: Mike Smith
+Date:   20261017
+"""
+
+import os
+import sys
+import csv
+import zlib
+import hashlib
+import numpy as np
+import columnar
+import instrument
+from agreement import CATEGORIES
+from metrics import conversation_ids, conversation_starts
+from textfeatures import PUNCTUATION
+
+"""Format of the `all-years.predictions` CSV file
+--- One row per comment, in the order of the all-years files ---
+0: Record -- index of the comment's record in the CSV files (header is 0)
+1: Conversation -- conversation number (starts at 1)
+2: Coded? -- 1 if the comment was coded, so its predictions are out of fold
+3-5: P(authentic = 0), P(authentic = 1), P(authentic = 2)
+6-8: P(rich = 0), P(rich = 1), P(rich = 2) -- first comment only
+9: Uncertainty -- of the conversation, first comment only
+"""
+
+###
+### Global variables
+###
+
+FNAME_DATA = 'annotations/all-years.csv'
+FNAME_KEY = 'annotations/all-years.key.csv'
+FNAME_PREDICTIONS = 'annotations/all-years.predictions.csv'
+FNAME_WEIGHTS = 'annotations/all-years.prescore.npz'
+
+HEADER = (['Record', 'Conversation', 'Coded?']
+          + [f'P(authentic = {k})' for k in CATEGORIES]
+          + [f'P(rich = {k})' for k in CATEGORIES] + ['Uncertainty'])
+
+# The number of hashed features, plus one for the bias
+DIMENSIONS = 1 << 18
+
+# The L2 penalty, the most steps of L-BFGS we take, how close to zero every
+# entry of the gradient must be for us to stop sooner, and how many steps
+# L-BFGS remembers
+PENALTY = 1e-4
+ITERATIONS = 300
+TOLERANCE = 1e-4
+MEMORY = 10
+
+# Folds for the out-of-fold predictions of the coded comments
+FOLDS = 5
+
+# We need at least this many coded conversations to fit anything
+MIN_CODED = 20
+
+# How many of the most uncertain conversations we print
+FLAGGED = 20
+
+###
+### Features
+###
+
+# A sparse matrix is the tuple `(rows, cols, vals, n)`: the row, column, and
+# value of each nonzero entry, and the number of rows.  The last column,
+# `DIMENSIONS`, is the bias, which every row has.
+
+def tokens(s):
+    """Returns the list of hashed features of the words and word pairs in the
+       string s, split as `textfeatures.words_in()` splits words"""
+    words = PUNCTUATION.sub('', s).lower().split()
+    grams = words + [a + ' ' + b for a, b in zip(words, words[1:])]
+    return [zlib.crc32(g.encode('utf-8')) % DIMENSIONS for g in grams]
+
+def combine(rows, cols, vals, n):
+    """Returns the sparse matrix with n rows whose entries are the given
+       ones, summing any that share a row and column"""
+    if len(rows) == 0:
+        return rows, cols, vals, n
+    cells, inverse = np.unique(rows.astype(np.int64) * DIMENSIONS + cols,
+                               return_inverse=True)
+    return (cells // DIMENSIONS, cells % DIMENSIONS,
+            np.bincount(inverse, weights=vals), n)
+
+def normalize(X):
+    """Returns X with each row scaled to unit length and the bias added"""
+    rows, cols, vals, n = X
+    norms = np.sqrt(np.bincount(rows, weights=vals * vals, minlength=n))
+    vals = vals / np.where(norms > 0, norms, 1)[rows]
+    return (np.concatenate([rows, np.arange(n)]),
+            np.concatenate([cols, np.full(n, DIMENSIONS)]),
+            np.concatenate([vals, np.ones(n)]), n)
+
+def comment_features(texts):
+    """Returns the raw TF-IDF matrix of the list of comment texts, without
+       normalization or bias"""
+    hashed = [tokens(s) for s in texts]
+    lengths = np.array([len(h) for h in hashed], dtype=np.int64)
+    rows, cols, tf, n = combine(
+        np.repeat(np.arange(len(texts)), lengths),
+        np.fromiter((t for h in hashed for t in h), dtype=np.int64,
+                    count=int(lengths.sum())),
+        np.ones(int(lengths.sum())), len(texts))
+    df = np.bincount(cols, minlength=DIMENSIONS)
+    idf = np.log((1 + n) / (1 + df[cols])) + 1
+    return rows, cols, (1 + np.log(tf)) * idf, n
+
+def conversation_features(X, conv, num_conversations):
+    """Returns the matrix whose rows sum the rows of the raw comment matrix
+       X in each conversation, given each comment's conversation number"""
+    rows, cols, vals, n = X
+    return combine(conv[rows], cols, vals, num_conversations)
+
+def take(X, selected):
+    """Returns the rows of X with the indices in the array selected"""
+    rows, cols, vals, n = X
+    renumber = np.full(n, -1, dtype=np.int64)
+    renumber[selected] = np.arange(len(selected))
+    keep = renumber[rows] >= 0
+    return renumber[rows[keep]], cols[keep], vals[keep], len(selected)
+
+###
+### Softmax regression
+###
+
+def scores(X, W):
+    """Returns the matrix X W"""
+    rows, cols, vals, n = X
+    return np.stack([np.bincount(rows, weights=W[cols, k] * vals,
+                                 minlength=n) for k in range(W.shape[1])],
+                    axis=1)
+
+def softmax(Z):
+    """Returns the row-wise softmax of Z"""
+    E = np.exp(Z - Z.max(axis=1, keepdims=True))
+    return E / E.sum(axis=1, keepdims=True)
+
+def objective(X, Y, W, penalty):
+    """Returns the pair `(loss, gradient)` of the penalized mean log loss of
+       the softmax regression with weights W on the rows of X, whose labels
+       are the rows of the indicator matrix Y"""
+    rows, cols, vals, n = X
+    Z = scores(X, W)
+    Z -= Z.max(axis=1, keepdims=True)
+    logs = Z - np.log(np.exp(Z).sum(axis=1, keepdims=True))
+    R = (np.exp(logs) - Y) / n
+    G = np.stack([np.bincount(cols, weights=vals * R[rows, k],
+                              minlength=len(W))
+                  for k in range(W.shape[1])], axis=1)
+
+    # We don't penalize the bias, which is the last row of W
+    G[:-1] += penalty * W[:-1]
+    loss = -(logs * Y).sum() / n + penalty / 2 * (W[:-1] ** 2).sum()
+    return loss, G
+
+def fit(X, y, start=None, classes=len(CATEGORIES), penalty=PENALTY,
+        iterations=ITERATIONS, tolerance=TOLERANCE):
+    """Returns the weights of a softmax regression of the labels y (integers
+       below classes) on the rows of the normalized matrix X, starting from
+       the weights start, if any"""
+    rows, cols, vals, n = X
+    Y = np.zeros((n, classes))
+    Y[np.arange(n), y] = 1
+
+    # Columns that no row uses keep a weight of 0, so we fit just the columns
+    # used, renumbered from 0.  The bias is the last of them.
+    used, cols = np.unique(cols, return_inverse=True)
+    X = (rows, cols, vals, n)
+    if start is None:
+        W = np.zeros((len(used), classes))
+    else:
+        W = start[used]
+
+    # Rare words make the loss far flatter in some directions than others,
+    # which slows plain gradient descent to a crawl, so we use L-BFGS: each
+    # step scales the gradient by an estimate of the inverse Hessian built
+    # from the last `MEMORY` steps, and backtracks until the loss drops enough
+    loss, G = objective(X, Y, W, penalty)
+    steps = []    # the pairs `(s, g)` of changes in W and in the gradient
+    for t in range(iterations):
+        if np.abs(G).max() < tolerance:
+            break
+
+        # The two-loop recursion for the direction D
+        D = -G
+        alphas = []
+        for s, g in reversed(steps):
+            alpha = (s * D).sum() / (g * s).sum()
+            D = D - alpha * g
+            alphas.append(alpha)
+        if steps:
+            s, g = steps[-1]
+            D = D * ((s * g).sum() / (g * g).sum())
+        for (s, g), alpha in zip(steps, reversed(alphas)):
+            beta = (g * D).sum() / (g * s).sum()
+            D = D + (alpha - beta) * s
+
+        slope = (G * D).sum()
+        if slope >= 0:
+            # Not a descent direction, so start the estimate over
+            D = -G
+            slope = -(G * G).sum()
+            steps = []
+        a = 1.0
+        for halving in range(30):
+            loss_next, G_next = objective(X, Y, W + a * D, penalty)
+            if loss_next <= loss + 1e-4 * a * slope:
+                break
+            a /= 2
+        else:
+            # No step lowers the loss enough.  Along the estimate, we start
+            # it over and try the gradient; along the gradient, we're as
+            # close to the minimum as rounding lets us get.
+            if not steps:
+                break
+            steps = []
+            continue
+        s = a * D
+        g = G_next - G
+        if (s * g).sum() > 1e-12:
+            steps = steps[-(MEMORY - 1):] + [(s, g)]
+        W, loss, G = W + s, loss_next, G_next
+
+    weights = np.zeros((DIMENSIONS + 1, classes))
+    weights[used] = W
+    return weights
+
+def entropy(P):
+    """Returns the entropy of each row of probabilities P, normalized so the
+       uniform distribution has entropy 1"""
+    logs = np.log(np.where(P > 0, P, 1))
+    return -(P * logs).sum(axis=1) / np.log(P.shape[1])
+
+def log_loss(P, y):
+    """Returns the mean negative log-likelihood of labels y under P"""
+    return float(-np.mean(np.log(np.maximum(P[np.arange(len(y)), y], 1e-15))))
+
+###
+### Main routines
+###
+
+def identity(data, seed):
+    """Returns the hash of the dataset in the columns of the `all-years` file
+       and the seed, which the saved weights must match"""
+    h = hashlib.sha256(str(seed).encode())
+    h.update(data['reply'].tobytes())
+    h.update(data['submission_bytes'].tobytes())
+    return h.hexdigest()
+
+def load_weights(ident):
+    """Returns the dictionary mapping the name of each model to the pair
+       `(columns, weights)` of its nonzero rows of weights, as the last run
+       with the same identity saved them, or an empty dictionary"""
+    if not os.path.exists(FNAME_WEIGHTS):
+        return {}
+    with np.load(FNAME_WEIGHTS) as saved:
+        if str(saved['identity']) != ident:
+            return {}
+        return {name[:-len('-cols')]: (saved[name],
+                                       saved[name[:-len('-cols')] + '-rows'])
+                for name in saved.files if name.endswith('-cols')}
+
+def save_weights(ident, weights):
+    """Save the dictionary weights, which maps the name of each model to its
+       weights, keeping just their nonzero rows"""
+    arrays = {'identity': np.array(ident)}
+    for name, W in weights.items():
+        cols = np.flatnonzero(np.any(W != 0, axis=1))
+        arrays[name + '-cols'] = cols
+        arrays[name + '-rows'] = W[cols]
+    with open(FNAME_WEIGHTS, mode='wb') as fout:
+        np.savez(fout, **arrays)
+
+def starting_point(saved, name):
+    """Returns the full weights of model name from the saved weights, or None
+       if we have none"""
+    if name not in saved:
+        return None
+    cols, rows = saved[name]
+    W = np.zeros((DIMENSIONS + 1, len(CATEGORIES)))
+    W[cols] = rows
+    return W
+
+def predict(name, X, y, coded, folds, saved, fitted):
+    """Returns the probabilities for every row of X, given the labels y of
+       the rows where coded is True and the fold of every row: out of fold
+       for the coded rows, and from a model fit to all of them for the rest.
+       We start each model from its weights in saved, if any, and add its
+       fitted weights to fitted."""
+    P = np.zeros((X[3], len(CATEGORIES)))
+    for k in range(FOLDS):
+        train = np.flatnonzero(coded & (folds != k))
+        test = np.flatnonzero(coded & (folds == k))
+        if len(test) == 0:
+            continue
+        model = f'{name}-{k}'
+        fitted[model] = fit(take(X, train), y[train],
+                            starting_point(saved, model))
+        P[test] = softmax(scores(take(X, test), fitted[model]))
+
+    labeled = np.flatnonzero(coded)
+    unlabeled = np.flatnonzero(~coded)
+    if len(unlabeled) > 0:
+        fitted[name] = fit(take(X, labeled), y[labeled],
+                           starting_point(saved, name))
+        P[unlabeled] = softmax(scores(take(X, unlabeled), fitted[name]))
+    return P
+
+def report(name, P, y):
+    """Print how well the out-of-fold probabilities P predict labels y,
+       next to always guessing the most common label"""
+    counts = np.bincount(y, minlength=len(CATEGORIES))
+    base = np.tile(counts / len(y), (len(y), 1))
+    accuracy = np.mean(P.argmax(axis=1) == y)
+    print(f'{name}: accuracy {accuracy:.3f} (vs {counts.max() / len(y):.3f}), '
+          f'log loss {log_loss(P, y):.3f} (vs {log_loss(base, y):.3f})')
+
+def prescore(data, key, seed=0):
+    """Predict the codes of every comment and conversation
+
+    Input:   The columns of the `all-years` and `all-years.key` files, as
+             returned by `columnar.load_data()` and `columnar.load_key()`,
+             and the seed for assigning folds
+    Output:  A tuple `(P_auth, P_rich, uncertainty, coded)`: the probabilities
+             of each authenticity code for every comment, of each richness
+             code for every conversation, the uncertainty of every
+             conversation, and whether each comment was coded
+    """
+    reply = data['reply']
+    starts = conversation_starts(reply)
+    conv = conversation_ids(reply)
+
+    # The fold of every conversation, which depends only on the seed and the
+    # number of conversations
+    folds = np.random.default_rng(seed).permutation(len(starts)) % FOLDS
+    ident = identity(data, seed)
+    saved = load_weights(ident)
+    fitted = {}
+
+    # Only codes on our scale count as labels
+    authentic = key['authentic'].astype(np.int64)
+    rich = key['rich'][starts].astype(np.int64)
+    coded = np.isin(authentic, CATEGORIES)
+    conv_coded = coded[starts] & np.isin(rich, CATEGORIES)
+    if np.count_nonzero(conv_coded) < MIN_CODED:
+        sys.exit(f'Need at least {MIN_CODED} coded conversations')
+
+    with instrument.phase('features', rows=len(reply)) as p:
+        raw = comment_features(columnar.decode_strings(
+            data['submission_offsets'], data['submission_bytes']))
+        X_comments = normalize(raw)
+        X_conversations = normalize(conversation_features(raw, conv,
+                                                          len(starts)))
+        p.rows = len(reply)
+
+    with instrument.phase('authenticity', rows=len(reply)):
+        labels = np.searchsorted(CATEGORIES, np.where(coded, authentic,
+                                                      CATEGORIES[0]))
+        P_auth = predict('authentic', X_comments, labels, coded, folds[conv],
+                         saved, fitted)
+        report('Authenticity', P_auth[coded], labels[coded])
+
+    with instrument.phase('richness', rows=len(starts)):
+        labels = np.searchsorted(CATEGORIES, np.where(conv_coded, rich,
+                                                      CATEGORIES[0]))
+        P_rich = predict('rich', X_conversations, labels, conv_coded, folds,
+                         saved, fitted)
+        report('Richness', P_rich[conv_coded], labels[conv_coded])
+
+    # Average the authenticity entropy over each conversation's comments
+    comments = np.diff(np.append(starts, len(reply)))
+    auth_entropy = np.add.reduceat(entropy(P_auth), starts) / comments
+    uncertainty = (auth_entropy + entropy(P_rich)) / 2
+    save_weights(ident, fitted)
+    return P_auth, P_rich, uncertainty, coded
+
+def write_predictions(P_auth, P_rich, uncertainty, coded, starts):
+    """Write the predictions file, given the outputs of `prescore()` and the
+       indices of the comments that start each conversation"""
+    is_start = np.zeros(len(coded), dtype=bool)
+    is_start[starts] = True
+    conv = np.cumsum(is_start)
+    with open(FNAME_PREDICTIONS, mode='w') as fout:
+        csv_writer = csv.writer(fout, delimiter=',', quotechar='"',
+                                quoting=csv.QUOTE_MINIMAL)
+        csv_writer.writerow(HEADER)
+        for i in range(len(coded)):
+            row = [i + 1, conv[i], int(coded[i])]
+            row += [f'{p:.4f}' for p in P_auth[i]]
+            if is_start[i]:
+                c = conv[i] - 1
+                row += [f'{p:.4f}' for p in P_rich[c]]
+                row.append(f'{uncertainty[c]:.4f}')
+            else:
+                row += [''] * (len(CATEGORIES) + 1)
+            csv_writer.writerow(row)
+    print(f'Wrote {FNAME_PREDICTIONS}')
+
+
+def main():
+    usage = 'Usage: python3 prescore.py [-seed N]'
+    seed = 0
+    if len(sys.argv) == 3 and sys.argv[1] == '-seed':
+        try:
+            seed = int(sys.argv[2])
+        except ValueError:
+            sys.exit(usage)
+    elif len(sys.argv) != 1:
+        sys.exit(usage)
+
+    with instrument.phase('load') as p:
+        data = columnar.load_data(FNAME_DATA)
+        key = columnar.load_key(FNAME_KEY)
+        p.rows = len(data['reply'])
+    P_auth, P_rich, uncertainty, coded = prescore(data, key, seed)
+    starts = conversation_starts(data['reply'])
+    write_predictions(P_auth, P_rich, uncertainty, coded, starts)
+
+    # Flag the uncoded conversations the model is least sure of
+    uncoded = np.flatnonzero(~coded[starts])
+    flagged = uncoded[np.argsort(-uncertainty[uncoded], kind='stable')]
+    print(f'{len(uncoded)} uncoded conversations; the most uncertain are:')
+    for c in flagged[:FLAGGED].tolist():
+        print(f'  #{c + 1}: uncertainty {uncertainty[c]:.3f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,614 @@
+""" serve.py: A local web service for coding with several coders at once
+
+`code.py` is a one-coder loop over the key file.  This script lets any number
+of coders work at the same time, each in a web browser.  It hands out one
+conversation at a time from `all-years.csv`, under a lease: the conversation is
+that coder's until they code it, skip it, or let the lease run out without
+renewing it (their page renews it every minute while it's open).  A coder who
+comes back while their lease is still good gets the same conversation again,
+and a coder who skips a conversation never gets it again, though the other
+coders still can.
+
+Every code goes into a SQLite database (`annotations/coding.sqlite`) in one
+transaction per conversation, so a crash loses at most the conversations being
+coded at that moment, and two coders never code the same conversation.  When
+you stop the server with Ctrl-C, or run `python3 serve.py -merge`, we write the
+new codes into `all-years.key.csv`, just as `code.py` would have, so the
+scripts that follow see them.  Don't run `code.py` while the server runs.
+
+The service keeps the blinding of `all-years.csv`.  We read only that file to
+show conversations, and a coder sees just the text of each comment and
+whether it's a reply, never the year, student, or document.  We read the key
+file only to skip conversations coded before the database existed and to merge
+the codes.
+
+The server has no passwords.  By default it listens only on this machine; if
+you use `-host` to let coders on other machines connect, do it only on a
+network you trust.
+
+Author: Mike Smith
+Date:   20261017
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import secrets
+import sqlite3
+import datetime
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import columnar
+import journal
+from build import file_hash
+
+"""Tables of the coding database
+--- meta ---
+name, value -- `data` holds the hash of the all-years file we serve
+
+--- conversations ---
+conv -- conversation number (starts at 1)
+first -- record of its first comment in the CSV files (header is 0)
+comments -- number of comments
+status -- OPEN, CODED here, or coded BEFORE the database existed
+priority -- the uncertainty from `prescore.py`, if any; higher goes first
+coder, token, expires -- the current lease, if any
+
+--- codes ---
+record -- the comment's record in the CSV files
+conv -- its conversation
+authentic, rich -- coding fields, as `code.py` fills them in
+coder, time -- who coded it, and when
+merged -- 1 once we've written the codes into the key file
+
+--- skips ---
+conv, coder -- the coder skipped the conversation, so we don't offer it to
+               them again
+"""
+
+###
+### Global variables
+###
+
+FNAME_DATA = 'annotations/all-years.csv'
+FNAME_KEY = 'annotations/all-years.key.csv'
+FNAME_DB = 'annotations/coding.sqlite'
+FNAME_PREDICTIONS = 'annotations/all-years.predictions.csv'
+
+HOST = '127.0.0.1'
+PORT = 8000
+
+# How long a coder holds a conversation without renewing the lease
+LEASE_SECONDS = 15 * 60
+
+# The codes a coder may give, as in `agreement.py`
+CODES = ['0', '1', '2']
+
+# Values of the status column
+OPEN = 0
+CODED = 1
+BEFORE = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    conv INTEGER PRIMARY KEY,
+    first INTEGER NOT NULL,
+    comments INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    priority REAL NOT NULL DEFAULT 0,
+    coder TEXT,
+    token TEXT,
+    expires REAL
+);
+CREATE INDEX IF NOT EXISTS by_priority ON conversations
+    (status, priority DESC, conv);
+CREATE TABLE IF NOT EXISTS codes (
+    record INTEGER PRIMARY KEY,
+    conv INTEGER NOT NULL,
+    authentic TEXT NOT NULL,
+    rich TEXT NOT NULL,
+    coder TEXT NOT NULL,
+    time TEXT NOT NULL,
+    merged INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS skips (
+    conv INTEGER NOT NULL,
+    coder TEXT NOT NULL,
+    PRIMARY KEY (conv, coder)
+);
+'''
+
+###
+### Some helper functions
+###
+
+def read_conversations(fname_data):
+    """Returns the list of conversations in the all-years file fname_data,
+       each the pair `(first record, comments)`, where comments is the list of
+       `(reply, text)` pairs"""
+    conversations = []
+    data_reader = columnar.read_data(fname_data)
+    next(data_reader)    # skip over header
+    for record, d_row in enumerate(data_reader, 1):
+        if d_row[0] == '0':
+            conversations.append((record, []))
+        conversations[-1][1].append((int(d_row[0]), d_row[1]))
+    if not conversations:
+        raise RuntimeError('Nothing but a header in CSV file')
+    return conversations
+
+def coded_before(fname_key, conversations):
+    """Returns the set of the numbers of the conversations whose every comment
+       is already coded in key file fname_key"""
+    firsts = {first: c for c, (first, _) in enumerate(conversations, 1)}
+    uncoded = set()
+    key_reader = columnar.read_key(fname_key)
+    next(key_reader)    # skip over header
+    for record, k_row in enumerate(key_reader, 1):
+        if record in firsts:
+            c = firsts[record]
+        if k_row[5] == '' or k_row[6] == '':
+            uncoded.add(c)
+    return set(range(1, len(conversations) + 1)) - uncoded
+
+###
+### The database
+###
+
+class CodingStore:
+    """The coding database fname_db for the conversations read from all-years
+       file fname_data.  A new database skips the conversations already coded
+       in key file fname_key.  Each thread gets its own connection."""
+
+    def __init__(self, conversations, fname_db=FNAME_DB,
+                 fname_data=FNAME_DATA, fname_key=FNAME_KEY,
+                 lease_seconds=LEASE_SECONDS):
+        self.conversations = conversations
+        self.fname_db = fname_db
+        self.fname_data = fname_data
+        self.lease_seconds = lease_seconds
+        self.local = threading.local()
+
+        db = self.db()
+        columns = [row[1] for row in
+                   db.execute('PRAGMA table_info(conversations)')]
+        if columns and 'priority' not in columns:
+            # A database from before we ordered the queue, whose index on
+            # `(status, conv)` the index `by_priority` replaces
+            db.execute('ALTER TABLE conversations ADD COLUMN '
+                       'priority REAL NOT NULL DEFAULT 0')
+            db.execute('DROP INDEX IF EXISTS by_status')
+        columns = [row[1] for row in db.execute('PRAGMA table_info(codes)')]
+        if columns and 'merged' not in columns:
+            # A database from before we kept track of what we merged, so we
+            # merge its codes once more
+            db.execute('ALTER TABLE codes ADD COLUMN '
+                       'merged INTEGER NOT NULL DEFAULT 0')
+        db.executescript(SCHEMA)
+        data = file_hash(fname_data)
+        row = db.execute("SELECT value FROM meta WHERE name = 'data'") \
+                .fetchone()
+        if row == None:
+            coded = coded_before(fname_key, conversations)
+            db.execute('BEGIN IMMEDIATE')
+            db.execute("INSERT INTO meta VALUES ('data', ?)", (data,))
+            db.executemany(
+                'INSERT INTO conversations (conv, first, comments, status) '
+                'VALUES (?, ?, ?, ?)',
+                ((c, first, len(comments), BEFORE if c in coded else OPEN)
+                 for c, (first, comments) in enumerate(conversations, 1)))
+            db.execute('COMMIT')
+        elif row[0] != data:
+            raise RuntimeError(f'{fname_data} changed since {fname_db} was '
+                               'created; merge its codes and remove it')
+
+    def prioritize(self, fname=FNAME_PREDICTIONS):
+        """Order the open conversations by the uncertainty in the predictions
+           file fname that `prescore.py` writes, if it's newer than the
+           all-years file, and return the number of conversations
+           prioritized"""
+        if not os.path.exists(fname) or \
+           os.path.getmtime(fname) < os.path.getmtime(self.fname_data):
+            return 0
+
+        # The conversation number and its uncertainty, which is only on the
+        # row of its first comment
+        priorities = []
+        with open(fname) as fin:
+            csv_reader = csv.reader(fin, delimiter=',')
+            next(csv_reader)    # skip over header
+            for row in csv_reader:
+                if row[9] != '':
+                    priorities.append((float(row[9]), int(row[1])))
+        self.transaction(lambda db: db.executemany(
+            'UPDATE conversations SET priority = ? WHERE conv = ?',
+            priorities))
+        return len(priorities)
+
+    def db(self):
+        """Returns this thread's connection to the database"""
+        if not hasattr(self.local, 'db'):
+            db = sqlite3.connect(self.fname_db, isolation_level=None,
+                                 timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            self.local.db = db
+        return self.local.db
+
+    def transaction(self, f, *args):
+        """Returns f(db, *args), run in a transaction that holds the write
+           lock from the start"""
+        db = self.db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            result = f(db, *args)
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return result
+
+    def lease(self, coder):
+        """Returns the triple `(conv, token, expires)` of the conversation
+           leased to coder, leasing them the open one with the highest
+           priority (and then the lowest number) that they haven't skipped if
+           they don't hold one, or None if every conversation is coded,
+           leased, or skipped by coder"""
+        def grab(db, now):
+            row = db.execute(
+                'SELECT conv, token FROM conversations WHERE status = ? '
+                'AND coder = ? AND expires > ? ORDER BY conv LIMIT 1',
+                (OPEN, coder, now)).fetchone()
+            if row == None:
+                row = db.execute(
+                    'SELECT conv, NULL FROM conversations WHERE status = ? '
+                    'AND (expires IS NULL OR expires <= ?) '
+                    'AND NOT EXISTS (SELECT 1 FROM skips WHERE '
+                    'skips.conv = conversations.conv AND skips.coder = ?) '
+                    'ORDER BY priority DESC, conv LIMIT 1',
+                    (OPEN, now, coder)).fetchone()
+                if row == None:
+                    return None
+            conv, token = row
+            token = token or secrets.token_hex(16)
+            expires = now + self.lease_seconds
+            db.execute('UPDATE conversations SET coder = ?, token = ?, '
+                       'expires = ? WHERE conv = ?',
+                       (coder, token, expires, conv))
+            return conv, token, expires
+        return self.transaction(grab, time.time())
+
+    def renew(self, conv, token):
+        """Extends the lease on conv, returning False if it's no longer held
+           with token"""
+        cur = self.db().execute(
+            'UPDATE conversations SET expires = ? WHERE conv = ? AND '
+            'token = ? AND status = ?',
+            (time.time() + self.lease_seconds, conv, token, OPEN))
+        return cur.rowcount == 1
+
+    def release(self, conv, token):
+        """Gives up the lease on conv, so another coder can take it, and
+           remembers that the coder holding it skipped it"""
+        def skip(db):
+            row = db.execute(
+                'SELECT coder FROM conversations WHERE conv = ? AND '
+                'token = ? AND status = ?', (conv, token, OPEN)).fetchone()
+            if row == None:
+                return
+            db.execute('INSERT OR IGNORE INTO skips VALUES (?, ?)',
+                       (conv, row[0]))
+            db.execute('UPDATE conversations SET coder = NULL, token = NULL, '
+                       'expires = NULL WHERE conv = ?', (conv,))
+        self.transaction(skip)
+
+    def submit(self, conv, token, authentic, rich):
+        """Records the codes for conv, whose lease is held with token, given
+           the list of authenticity codes of its comments and its richness
+           code.  Returns False if the lease is no longer held.  Raises
+           ValueError if the codes aren't valid."""
+        if not 1 <= conv <= len(self.conversations):
+            raise ValueError(f'No conversation #{conv}')
+        first, comments = self.conversations[conv - 1]
+        if len(authentic) != len(comments) or \
+           any(a not in CODES for a in authentic) or rich not in CODES:
+            raise ValueError('Expected a code from '
+                             f'{", ".join(CODES)} for every field')
+
+        def record(db, now):
+            row = db.execute(
+                'SELECT coder FROM conversations WHERE conv = ? AND '
+                'token = ? AND status = ?', (conv, token, OPEN)).fetchone()
+            if row == None:
+                return False
+            # Like `code.py`, the richness of the conversation goes with its
+            # first comment, and every reply gets 0
+            db.executemany(
+                'INSERT OR REPLACE INTO codes (record, conv, authentic, '
+                'rich, coder, time) VALUES (?, ?, ?, ?, ?, ?)',
+                ((first + i, conv, a, rich if i == 0 else '0', row[0], now)
+                 for i, a in enumerate(authentic)))
+            db.execute('UPDATE conversations SET status = ?, token = NULL, '
+                       'expires = NULL WHERE conv = ?', (CODED, conv))
+            return True
+        return self.transaction(record, datetime.datetime.now().isoformat())
+
+    def progress(self):
+        """Returns a dictionary of how many conversations are coded, open,
+           and leased right now"""
+        counts = dict(self.db().execute(
+            'SELECT status, COUNT(*) FROM conversations GROUP BY status'))
+        (leased,) = self.db().execute(
+            'SELECT COUNT(*) FROM conversations WHERE status = ? AND '
+            'expires > ?', (OPEN, time.time())).fetchone()
+        return {'coded': counts.get(CODED, 0) + counts.get(BEFORE, 0),
+                'open': counts.get(OPEN, 0), 'leased': leased,
+                'total': len(self.conversations)}
+
+    def merge(self, fname_key=FNAME_KEY):
+        """Write the codes in the database that we haven't merged before into
+           key file fname_key, and return how many comments we wrote.  Codes
+           we merged once stay out of it, so we never undo a later recoding
+           with `code.py`."""
+        def write(db):
+            key_rows = list(columnar.read_key(fname_key))
+            merged = 0
+            for record, authentic, rich in db.execute(
+                    'SELECT record, authentic, rich FROM codes '
+                    'WHERE merged = 0'):
+                if record >= len(key_rows):
+                    raise RuntimeError(f'{self.fname_db} does not match '
+                                       f'{fname_key}')
+                key_rows[record][5] = authentic
+                key_rows[record][6] = rich
+                merged += 1
+            if merged > 0:
+                journal.write_key(fname_key, key_rows)
+                db.execute('UPDATE codes SET merged = 1 WHERE merged = 0')
+            return merged
+        return self.transaction(write)
+
+###
+### The web service
+###
+
+PAGE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Coding</title>
+<style>
+body { font-family: sans-serif; max-width: 50em; margin: 2em auto; }
+.comment { border-left: 3px solid #888; margin: 1em 0; padding: 0 1em; }
+.reply { margin-left: 3em; }
+.text { white-space: pre-wrap; }
+label { margin-right: 1em; }
+#status { color: #555; }
+</style>
+</head>
+<body>
+<p>Coder: <input id="coder" size="20">
+<button onclick="start()">Start</button>
+<span id="status"></span></p>
+<div id="conversation"></div>
+<script>
+const CODES = %(codes)s;
+let current = null;
+
+function radios(name) {
+  return CODES.map(c => `<label><input type="radio" name="${name}"
+    value="${c}">${c}</label>`).join('');
+}
+
+function escape(s) {
+  const div = document.createElement('div');
+  div.textContent = s;
+  return div.innerHTML;
+}
+
+async function post(path, body) {
+  const response = await fetch(path, {method: 'POST',
+    headers: {'Content-Type': 'application/json'},
+    body: JSON.stringify(body)});
+  return [response.status, await response.json()];
+}
+
+async function progress() {
+  const p = await (await fetch('/api/progress')).json();
+  document.getElementById('status').textContent =
+    `${p.coded} of ${p.total} conversations coded, ${p.leased} in progress`;
+}
+
+async function start() {
+  const coder = document.getElementById('coder').value.trim();
+  if (!coder) return;
+  localStorage.setItem('coder', coder);
+  const [status, c] = await post('/api/next', {coder: coder});
+  const div = document.getElementById('conversation');
+  current = null;
+  progress();
+  if (status != 200) { div.textContent = c.error; return; }
+  if (c.done) {
+    div.textContent = 'Nothing left to code, except what you skipped.';
+    return;
+  }
+  current = c;
+  div.innerHTML = `<h3>Conversation #${c.conversation}</h3>` +
+    c.comments.map((comment, i) => `<div class="comment
+      ${comment.reply ? 'reply' : ''}"><p>${comment.reply ? 'REPLY, ' : ''}
+      comment #${comment.record}</p><p class="text">${escape(comment.text)}</p>
+      <p>Authentic? ${radios('a' + i)}</p></div>`).join('') +
+    `<p>Rich discussion? ${radios('rich')}</p>
+    <button onclick="submit()">Submit</button>
+    <button onclick="skip()">Skip</button>`;
+}
+
+function chosen(name) {
+  const input = document.querySelector(`input[name="${name}"]:checked`);
+  return input ? input.value : null;
+}
+
+async function submit() {
+  const authentic = current.comments.map((_, i) => chosen('a' + i));
+  const rich = chosen('rich');
+  if (authentic.includes(null) || rich == null) {
+    alert('Please code every field.');
+    return;
+  }
+  const [status, r] = await post('/api/code', {conversation:
+    current.conversation, token: current.token, authentic: authentic,
+    rich: rich});
+  if (status != 200) alert(r.error);
+  start();
+}
+
+async function skip() {
+  await post('/api/release', {conversation: current.conversation,
+                              token: current.token});
+  start();
+}
+
+setInterval(async () => {
+  if (current == null) return;
+  const [status, r] = await post('/api/renew', {conversation:
+    current.conversation, token: current.token});
+  if (status != 200) { alert(r.error); start(); }
+}, 60000);
+
+document.getElementById('coder').value = localStorage.getItem('coder') || '';
+progress();
+</script>
+</body>
+</html>
+'''
+
+class Handler(BaseHTTPRequestHandler):
+    """Serves the coding page and its JSON API from the `CodingStore` in
+       the server's store attribute"""
+
+    def send(self, status, body, content_type='application/json'):
+        if content_type == 'application/json':
+            body = json.dumps(body)
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        store = self.server.store
+        if self.path == '/':
+            self.send(200, PAGE % {'codes': json.dumps(CODES)}, 'text/html')
+        elif self.path == '/api/progress':
+            self.send(200, store.progress())
+        else:
+            self.send(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        store = self.server.store
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            if self.path == '/api/next':
+                coder = str(body['coder']).strip()
+                if coder == '':
+                    raise ValueError('Who is coding?')
+                lease = store.lease(coder)
+                if lease == None:
+                    self.send(200, {'done': True})
+                    return
+                conv, token, expires = lease
+
+                # Only what `all-years.csv` holds, to keep the blinding
+                first, comments = store.conversations[conv - 1]
+                self.send(200, {'conversation': conv, 'token': token,
+                                'expires': expires,
+                                'comments': [{'record': first + i,
+                                              'reply': reply, 'text': text}
+                                             for i, (reply, text)
+                                             in enumerate(comments)]})
+            elif self.path == '/api/renew':
+                if store.renew(int(body['conversation']), body['token']):
+                    self.send(200, {'ok': True})
+                else:
+                    self.send(409, {'error': 'Your lease on this '
+                                             'conversation ran out'})
+            elif self.path == '/api/release':
+                store.release(int(body['conversation']), body['token'])
+                self.send(200, {'ok': True})
+            elif self.path == '/api/code':
+                if store.submit(int(body['conversation']), body['token'],
+                                [str(a) for a in body['authentic']],
+                                str(body['rich'])):
+                    self.send(200, {'ok': True})
+                else:
+                    self.send(409, {'error': 'Your lease on this '
+                                             'conversation ran out, so '
+                                             'your codes were not saved'})
+            else:
+                self.send(404, {'error': 'Not found'})
+        except (KeyError, TypeError, ValueError) as e:
+            self.send(400, {'error': str(e) or 'Bad request'})
+
+    def log_message(self, format, *args):
+        pass    # one line per request is just noise
+
+###
+### Main
+###
+
+def main():
+    usage = ('Usage: python3 serve.py [-host H] [-port N] [-lease MINUTES]\n'
+             '       python3 serve.py -merge')
+    host = HOST
+    port = PORT
+    lease_seconds = LEASE_SECONDS
+    merge_only = False
+    args = sys.argv[1:]
+    try:
+        while args:
+            opt = args.pop(0)
+            if opt == '-host':
+                host = args.pop(0)
+            elif opt == '-port':
+                port = int(args.pop(0))
+            elif opt == '-lease':
+                lease_seconds = float(args.pop(0)) * 60
+            elif opt == '-merge':
+                merge_only = True
+            else:
+                sys.exit(usage)
+    except (IndexError, ValueError):
+        sys.exit(usage)
+
+    conversations = read_conversations(FNAME_DATA)
+    store = CodingStore(conversations, lease_seconds=lease_seconds)
+    if not merge_only:
+        prioritized = store.prioritize()
+        if prioritized > 0:
+            print(f'Ordering {prioritized} conversations by the uncertainty '
+                  f'in {FNAME_PREDICTIONS}')
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        server.store = store
+        p = store.progress()
+        print(f'Serving {p["open"]} uncoded conversations at '
+              f'http://{host}:{port}/ (Ctrl-C to stop)')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print('')
+        server.server_close()
+
+    merged = store.merge()
+    print(f'Wrote {merged} coded comments from {FNAME_DB} to {FNAME_KEY}')
+
+if __name__ == '__main__':
+    main()
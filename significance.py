@@ -0,0 +1,346 @@
+""" significance.py: Year-versus-year hypothesis tests on the per-conversation
+    metrics of `analyze.py`
+
+For each pair of years and every per-conversation metric, we run a Welch
+t-test, a permutation test of the difference in means, and a bootstrap
+confidence interval for the effect size (the difference in means and Hedges'
+g).  Besides the metrics in `metrics.py`, we test the binary indicators used in
+the paper: whether a conversation is a discussion (has a reply), and whether a
+discussion has any quality (a nonzero richness score).
+
+All the resampling is vectorized.  Each test draws a matrix with one row per
+replicate and one column per observation: for a permutation, it marks which
+pooled observations go to the first year, and for a bootstrap, it counts how
+many times each observation was drawn.  A single matrix product then applies
+it to every metric with the same observations.  We draw the replicates in
+chunks sized to keep that matrix under `MAX_ELEMENTS` entries, so memory stays
+bounded however many replicates you ask for.  When the two samples are small
+enough, the permutation test enumerates every split of the pooled sample and is
+exact; otherwise, it samples `REPLICATES` permutations.
+
+Author: Mike Smith
+Date:   20261017
+"""
+
+import sys
+import math
+import warnings
+import itertools
+import numpy as np
+import columnar
+from metrics import C_COMMENTS, C_RICH, C_END, HEADERS
+
+###
+### Global variables
+###
+
+FNAME_DATA = 'annotations/all-years.csv'
+FNAME_KEY = 'annotations/all-years.key.csv'
+
+# Resampling defaults
+REPLICATES = 10000
+CONFIDENCE = 95
+
+# Largest number of splits of the pooled sample we enumerate exactly
+EXACT_LIMIT = 100000
+
+# Largest number of entries in a chunk of resampled values
+MAX_ELEMENTS = 1 << 22
+
+###
+### Distributions
+###
+
+def incomplete_beta(a, b, x):
+    """Returns the regularized incomplete beta function I_x(a, b), evaluated
+       with the continued fraction in Numerical Recipes (modified Lentz)"""
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    if x > (a + 1) / (a + b + 2):
+        return 1 - incomplete_beta(b, a, 1 - x)
+
+    tiny = 1e-300
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b)
+                     + a * math.log(x) + b * math.log1p(-x)) / a
+    c = 1.0
+    d = 1 - (a + b) * x / (a + 1)
+    d = 1 / (d if abs(d) > tiny else tiny)
+    f = d
+    for m in range(1, 1000):
+        for numerator in (m * (b - m) * x / ((a + 2*m - 1) * (a + 2*m)),
+                          -(a + m) * (a + b + m) * x / ((a + 2*m) * (a + 2*m + 1))):
+            d = 1 + numerator * d
+            d = 1 / (d if abs(d) > tiny else tiny)
+            c = 1 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            f *= c * d
+        if abs(c * d - 1) < 1e-15:
+            break
+    return front * f
+
+def t_pvalue(t, df):
+    """Returns the two-sided p-value of Student's t statistic t with df
+       degrees of freedom"""
+    if math.isnan(t) or math.isnan(df):
+        return math.nan
+    return incomplete_beta(df / 2, 0.5, df / (df + t * t))
+
+def f_pvalue(f, df1, df2):
+    """Returns the upper-tail p-value of the F statistic f with df1 and df2
+       degrees of freedom"""
+    if math.isnan(f) or df1 <= 0 or df2 <= 0:
+        return math.nan
+    if f <= 0:
+        return 1.0
+    return incomplete_beta(df2 / 2, df1 / 2, df2 / (df2 + df1 * f))
+
+###
+### Some helper functions
+###
+
+def metrics_of(m_year):
+    """Returns a dictionary mapping each metric name to its per-conversation
+       array for one year, given that year's list from `analyze.analyze()`"""
+    named = {HEADERS[k]: m_year[k].astype(np.float64) for k in range(C_END)}
+
+    # The binary indicators in the paper
+    discussion = m_year[C_COMMENTS] > 1
+    named['Discussion?'] = discussion.astype(np.float64)
+    named['Quality discussion?'] = \
+        (m_year[C_RICH][discussion] > 0).astype(np.float64)
+    return named
+
+def chunk_size(replicates, width, metrics):
+    """Returns how many replicates to draw at a time when each replicate has
+       width observations for each of metrics metrics"""
+    return max(1, min(replicates, MAX_ELEMENTS // max(1, width * (metrics + 1))))
+
+def welch(x, y):
+    """Returns the tuple `(t, df, p)` of Welch's t-test for 1-D arrays x and
+       y"""
+    nx, ny = len(x), len(y)
+    if nx < 2 or ny < 2:
+        return math.nan, math.nan, math.nan
+    vx = x.var(ddof=1) / nx
+    vy = y.var(ddof=1) / ny
+    if vx + vy == 0:
+        return math.nan, math.nan, math.nan
+    t = (x.mean() - y.mean()) / math.sqrt(vx + vy)
+    df = (vx + vy) ** 2 / (vx * vx / (nx - 1) + vy * vy / (ny - 1))
+    return t, df, t_pvalue(t, df)
+
+def hedges_g(mx, my, vx, vy, nx, ny):
+    """Returns Hedges' g, elementwise, from group means, sample variances, and
+       sizes"""
+    pooled = ((nx - 1) * vx + (ny - 1) * vy) / (nx + ny - 2)
+    correction = 1 - 3 / (4 * (nx + ny) - 9)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return correction * (mx - my) / np.sqrt(pooled)
+
+###
+### Batched resampling
+###
+### Each routine takes X, an (M, nx) array, and Y, an (M, ny) array, holding M
+### metrics with the same observations, and returns results for all M at once.
+
+def permutation_test(X, Y, replicates=REPLICATES, rng=None):
+    """Returns the pair `(p, exact)`, where p is the array of two-sided
+       permutation p-values for the difference in means of each metric and
+       exact says whether we enumerated every split"""
+    M, nx = X.shape
+    ny = Y.shape[1]
+    n = nx + ny
+    pooled = np.concatenate([X, Y], axis=1)
+    total = pooled.sum(axis=1, keepdims=True)
+    observed = np.abs(X.mean(axis=1) - Y.mean(axis=1))
+    # Guard against rounding making an identical split look more extreme
+    observed = observed * (1 - 1e-12)
+
+    def extreme(member):
+        """Count the splits at least as extreme, where member is a matrix with
+           a row per split that marks the pooled observations in the first
+           year with a 1"""
+        sx = pooled @ member.T
+        diff = np.abs(sx / nx - (total - sx) / ny)
+        return (diff >= observed[:, None]).sum(axis=1)
+
+    splits = math.comb(n, nx)
+    step = chunk_size(replicates, n, M)
+    count = np.zeros(M, dtype=np.int64)
+    if splits <= EXACT_LIMIT:
+        combos = itertools.combinations(range(n), nx)
+        while True:
+            idx = np.array(list(itertools.islice(combos, step)),
+                           dtype=np.intp).reshape(-1, nx)
+            if len(idx) == 0:
+                break
+            member = np.zeros((len(idx), n))
+            np.put_along_axis(member, idx, 1, axis=1)
+            count += extreme(member)
+        return count / splits, True
+
+    # A random split puts the nx observations with the smallest random keys in
+    # the first year, which a partial sort finds in linear time
+    rng = np.random.default_rng(rng)
+    for start in range(0, replicates, step):
+        size = min(step, replicates - start)
+        keys = rng.random((size, n))
+        kth = np.partition(keys, nx - 1, axis=1)[:, nx-1:nx]
+        count += extreme((keys <= kth).astype(np.float64))
+    return (count + 1) / (replicates + 1), False
+
+def draw_counts(rng, size, n):
+    """Returns a (size, n) matrix whose rows count how many times each of n
+       observations was drawn in a bootstrap replicate"""
+    draws = rng.integers(0, n, size=(size, n)) + n * np.arange(size)[:, None]
+    return np.bincount(draws.ravel(), minlength=size * n) \
+             .reshape(size, n).astype(np.float64)
+
+def resampled_moments(X, counts):
+    """Returns the means and sample variances of each metric in X for each
+       bootstrap replicate, where counts has a row per replicate giving how
+       many times it drew each observation"""
+    n = X.shape[1]
+    sums = X @ counts.T
+    squares = (X * X) @ counts.T
+    means = sums / n
+    variances = np.maximum(squares - sums * means, 0) / (n - 1)
+    return means, variances
+
+def bootstrap_effect(X, Y, replicates=REPLICATES, rng=None,
+                     confidence=CONFIDENCE):
+    """Returns a dictionary of percentile bootstrap intervals, each a pair of
+       arrays `(low, high)`, for the difference in means (`diff`) and Hedges' g
+       (`g`) of each metric, resampling each year's conversations"""
+    M, nx = X.shape
+    ny = Y.shape[1]
+    rng = np.random.default_rng(rng)
+    step = chunk_size(replicates, nx + ny, M)
+
+    diffs = []
+    gs = []
+    for start in range(0, replicates, step):
+        size = min(step, replicates - start)
+        mx, vx = resampled_moments(X, draw_counts(rng, size, nx))
+        my, vy = resampled_moments(Y, draw_counts(rng, size, ny))
+        diffs.append(mx - my)
+        gs.append(hedges_g(mx, my, vx, vy, nx, ny))
+
+    tail = (100 - confidence) / 2
+    intervals = {}
+    for name, reps in (('diff', diffs), ('g', gs)):
+        reps = np.concatenate(reps, axis=1)
+        reps[~np.isfinite(reps)] = np.nan
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            lo, hi = np.nanpercentile(reps, [tail, 100 - tail], axis=1)
+        intervals[name] = (lo, hi)
+    return intervals
+
+###
+### Main routines
+###
+
+def compare(x_metrics, y_metrics, replicates=REPLICATES, seed=None,
+            confidence=CONFIDENCE):
+    """Compare two years, given the dictionaries of `metrics_of()`, and return
+       a dictionary mapping each metric name to a dictionary of results"""
+    rng = np.random.default_rng(seed)
+    results = {}
+
+    # Batch the metrics that share the same observations
+    batches = {}
+    for name in x_metrics:
+        shape = (len(x_metrics[name]), len(y_metrics[name]))
+        batches.setdefault(shape, []).append(name)
+
+    for (nx, ny), names in batches.items():
+        for name in names:
+            x, y = x_metrics[name], y_metrics[name]
+            t, df, p = welch(x, y)
+            results[name] = {'n1': nx, 'n2': ny,
+                             'mean1': x.mean() if nx else math.nan,
+                             'mean2': y.mean() if ny else math.nan,
+                             't': t, 'df': df, 'p_welch': p}
+        if nx < 2 or ny < 2:
+            for name in names:
+                results[name].update(p_perm=math.nan, exact=False,
+                                     diff_ci=(math.nan, math.nan),
+                                     g=math.nan, g_ci=(math.nan, math.nan))
+            continue
+
+        X = np.stack([x_metrics[name] for name in names])
+        Y = np.stack([y_metrics[name] for name in names])
+        p_perm, exact = permutation_test(X, Y, replicates, rng)
+        intervals = bootstrap_effect(X, Y, replicates, rng, confidence)
+        g = hedges_g(X.mean(axis=1), Y.mean(axis=1), X.var(axis=1, ddof=1),
+                     Y.var(axis=1, ddof=1), nx, ny)
+        for j, name in enumerate(names):
+            results[name].update(
+                p_perm=p_perm[j], exact=exact, g=g[j],
+                diff_ci=(intervals['diff'][0][j], intervals['diff'][1][j]),
+                g_ci=(intervals['g'][0][j], intervals['g'][1][j]))
+    return results
+
+def compare_years(years, m, replicates=REPLICATES, seed=None,
+                  confidence=CONFIDENCE):
+    """Compare every pair of years, given the metrics from `analyze.analyze()`,
+       and return a dictionary mapping each pair of years to the results of
+       `compare()`"""
+    named = [metrics_of(m_year) for m_year in m]
+    seeds = np.random.SeedSequence(seed).spawn(len(years) * len(years))
+    return {(years[i], years[j]):
+                compare(named[i], named[j], replicates,
+                        seeds[i * len(years) + j], confidence)
+            for i in range(len(years)) for j in range(i + 1, len(years))}
+
+def print_results(comparisons, confidence=CONFIDENCE):
+    for (yr1, yr2), results in comparisons.items():
+        print(f'*** {yr1} vs. {yr2} ***')
+        for name, r in results.items():
+            kind = 'exact' if r['exact'] else 'Monte Carlo'
+            print(f"  {name}: {r['mean1']:.4g} vs. {r['mean2']:.4g} "
+                  f"(n = {r['n1']}, {r['n2']})")
+            print(f"    Welch t = {r['t']:.4g}, df = {r['df']:.4g}, "
+                  f"p = {r['p_welch']:.4g}")
+            print(f"    permutation p = {r['p_perm']:.4g} ({kind})")
+            print(f"    difference {confidence}% CI = "
+                  f"[{r['diff_ci'][0]:.4g}, {r['diff_ci'][1]:.4g}]")
+            print(f"    Hedges' g = {r['g']:.4g}, {confidence}% CI = "
+                  f"[{r['g_ci'][0]:.4g}, {r['g_ci'][1]:.4g}]")
+        print('')
+
+def main():
+    from analyze import analyze
+
+    usage = "Usage: python3 significance.py year1 year2 ... [-reps N] [-seed N]"
+    years = []
+    replicates = REPLICATES
+    seed = None
+    args = sys.argv[1:]
+    try:
+        while args:
+            opt = args.pop(0)
+            if opt == '-reps':
+                replicates = int(args.pop(0))
+            elif opt == '-seed':
+                seed = int(args.pop(0))
+            elif opt.startswith('-'):
+                sys.exit(usage)
+            else:
+                years.append(opt)
+    except (IndexError, ValueError):
+        sys.exit(usage)
+    if len(years) < 2 or replicates < 1:
+        sys.exit(usage)
+
+    data = columnar.load_data(FNAME_DATA)
+    key = columnar.load_key(FNAME_KEY)
+    m, num_comments, num_conversations, record = analyze(years, data, key)
+    print(f'Processed {record} data records\n')
+    print_results(compare_years(years, m, replicates, seed))
+
+if __name__ == '__main__':
+    main()
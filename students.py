@@ -0,0 +1,135 @@
+""" students.py: A persistent store of pseudonymous student ids
+
+`build.py` replaces each student's name with an id of our own.  We keep the
+ids in a SQLite table, so a student gets the same id in every build, however
+the input files or their order change, and analyses across semesters can join
+on it.  The table never holds a name.  Its key is an HMAC of the student's
+name and year, salted with a random secret that we keep in a separate file, so
+the table alone can't be used to check a guess of who's in it.  Only the
+owner may read the salt file.
+
+Our ids have the form `YYYYnnnnnn`, where `YYYY` is the year the student took
+the class and `nnnnnn` counts the students of that year in the order we first
+saw them, so there's room for a million students a year.  We look up and
+insert a whole batch of students in one transaction.
+
+Author: Mike Smith
+Date:   20261017
+"""
+
+import os
+import hmac
+import hashlib
+import secrets
+import sqlite3
+
+###
+### Global variables
+###
+
+FNAME_DB = 'annotations/students.sqlite'
+FNAME_SALT = 'annotations/students.salt'
+
+# An id is `year * ID_BASE + n`
+ID_BASE = 1000000
+
+# The number of digests we look up in one query, to stay below SQLite's limit
+# on parameters
+BATCH = 500
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS students (
+    digest BLOB PRIMARY KEY,
+    id INTEGER NOT NULL UNIQUE
+) WITHOUT ROWID
+'''
+
+###
+### The store
+###
+
+class StudentStore:
+    """The pseudonymous ids in database fname_db, whose salt is in file
+       fname_salt.  We create both if neither exists."""
+
+    def __init__(self, fname_db=FNAME_DB, fname_salt=FNAME_SALT):
+        if not os.path.exists(fname_salt):
+            if os.path.exists(fname_db):
+                raise RuntimeError(f'{fname_db} exists but its salt '
+                                   f'{fname_salt} does not')
+            # Only the owner may read the salt, and if two first runs race,
+            # just one of them writes it
+            try:
+                fd = os.open(fname_salt, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                             0o600)
+            except FileExistsError:
+                pass
+            else:
+                with os.fdopen(fd, mode='w') as fout:
+                    fout.write(secrets.token_hex(32) + '\n')
+        with open(fname_salt) as fin:
+            self.salt = bytes.fromhex(fin.read().strip())
+
+        self.db = sqlite3.connect(fname_db, isolation_level=None)
+        self.db.execute(SCHEMA)
+
+    def digest(self, last, first, year):
+        """Returns the key of the student with the given name and year"""
+        name = '\x1f'.join([last, first, str(year)])
+        return hmac.new(self.salt, name.encode('utf-8'),
+                        hashlib.sha256).digest()[:16]
+
+    def ids(self, students):
+        """Returns a dictionary mapping each `(last, first, year)` tuple in
+           the iterable students to its id, giving new ids to the students we
+           haven't seen before, in the order they first appear"""
+        digests = {}
+        for student in students:
+            if student not in digests:
+                digests[student] = self.digest(*student)
+
+        # Lock the database while we add students, so two builds can't give
+        # out the same id
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            known = {}
+            values = list(digests.values())
+            for i in range(0, len(values), BATCH):
+                batch = values[i:i + BATCH]
+                known.update(self.db.execute(
+                    'SELECT digest, id FROM students WHERE digest IN '
+                    f'({",".join("?" * len(batch))})', batch))
+
+            next_id = {}
+            new = []
+            for (last, first, year), d in digests.items():
+                if d in known:
+                    continue
+                year = int(year)
+                if year not in next_id:
+                    next_id[year] = self.next_id(year)
+                known[d] = next_id[year]
+                next_id[year] += 1
+                new.append((d, known[d]))
+            self.db.executemany('INSERT INTO students VALUES (?, ?)', new)
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        return {student: known[d] for student, d in digests.items()}
+
+    def next_id(self, year):
+        """Returns the next unused id for year"""
+        if year < 0 or year >= (1 << 63) // ID_BASE:
+            raise ValueError(f'Year {year} out of range')
+        (last,) = self.db.execute(
+            'SELECT MAX(id) FROM students WHERE id >= ? AND id < ?',
+            (year * ID_BASE, (year + 1) * ID_BASE)).fetchone()
+        if last == None:
+            return year * ID_BASE
+        if last + 1 >= (year + 1) * ID_BASE:
+            raise RuntimeError(f'More than {ID_BASE} students in {year}')
+        return last + 1
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,229 @@
+""" synth.py: Generates synthetic Perusall annotation exports
+
+The only real inputs we can share are the two tiny files in `annotations`, so
+this script writes realistic exports of any size for testing and benchmarking
+the pipeline.  Each output file has the 14 fields of Perusall's export, in the
+same order, with the same byte-order mark on the header, quoting, and CRLF line
+endings.  We write one conversation at a time, so even exports far larger than
+memory stream straight to disk.
+
+You can configure the mean conversation size (conversation sizes follow a
+geometric distribution), the number of documents per year, the fraction of
+those documents read in every year, the share of comments made by the
+instructor, the mean length of a submission in words, and the share of
+submissions with embedded newlines (and with embedded double quotes, which
+need escaping in CSV).
+
+The instructor is `Michael Smith`, who is listed in `build.py`'s instructor
+roster for every year we know about, so `build.py` strips their comments just
+as it would in a real export.
+
+Author: Mike Smith
+Date:   20261017
+"""
+
+import sys
+import json
+import random
+import datetime
+
+"""Format of the original annotation file from Perusall
+0: Last name, 1: First name, 2: Student ID
+3: Submission -- the actual text of the annotation
+4: Type -- {comment, question}
+5: Score -- [0-2]
+6: Created, 7: Last edited at -- date time format
+8: Replies, 9: Upvoters
+10: Status -- ???
+11: Document, 12: Page number
+13: Range -- description of annotation anchor {text, rectangle} in document
+"""
+
+###
+### Global variables
+###
+
+HEADER = ['Last name', 'First name', 'Student ID', 'Submission', 'Type',
+          'Score', 'Created', 'Last edited at', 'Replies', 'Upvoters',
+          'Status', 'Document', 'Page number', 'Range']
+
+INSTRUCTOR = ('Smith', 'Michael')
+
+# Defaults for the command-line options
+DEFAULTS = {
+    'annotations': 1000,       # total over every year
+    'years': '2020,2021',
+    'documents': 20,           # per year
+    'overlap': 0.75,           # fraction of each year's documents read every year
+    'conversation': 2.0,       # mean comments per conversation
+    'instructor': 0.05,        # share of comments made by the instructor
+    'words': 40,               # mean words per submission
+    'newlines': 0.1,           # share of submissions with embedded newlines
+    'quotes': 0.05,            # share of submissions with embedded quotes
+    'students': 40,            # comments per student, on average
+    'seed': None,
+}
+
+# Words we draw submissions from
+VOCABULARY = ('the data model student learn think because question why how '
+              'science reading author example result analysis interesting '
+              'agree disagree point argument evidence class week bias sample '
+              'measure predict causal effect variable regression think '
+              'surprising important would could should really also maybe '
+              'python code https://example.com/paper see figure table').split()
+
+FIRST_NAMES = ['Alex', 'Avery', 'Blake', 'Casey', 'Dana', 'Emerson', 'Finley',
+               'Harper', 'Jordan', 'Kai', 'Logan', 'Morgan', 'Parker', 'Quinn',
+               'Reese', 'Riley', 'Rowan', 'Sage', 'Skyler', 'Taylor']
+
+###
+### Some helper functions
+###
+
+def quote(s):
+    """Returns s as a quoted CSV field, as Perusall writes text fields"""
+    return '"' + s.replace('"', '""') + '"'
+
+def format_row(row):
+    """Returns the CSV line for row, quoting the Submission and Range fields
+       always and the others only when needed"""
+    fields = []
+    for i, field in enumerate(row):
+        field = str(field)
+        if i in (3, 13) or any(c in field for c in ',"\r\n'):
+            field = quote(field)
+        fields.append(field)
+    return ','.join(fields) + '\r\n'
+
+def geometric(rng, mean):
+    """Returns a draw from the geometric distribution on 1, 2, ... with the
+       given mean"""
+    if mean <= 1:
+        return 1
+    p = 1 / mean
+    k = 1
+    while rng.random() > p:
+        k += 1
+    return k
+
+def submission(rng, words, newlines, quotes):
+    """Returns the text of a random submission"""
+    n = geometric(rng, words)
+    text = [rng.choice(VOCABULARY) for _ in range(n)]
+    if rng.random() < quotes and n > 2:
+        i = rng.randrange(n - 1)
+        text[i] = '"' + text[i]
+        text[i + 1] = text[i + 1] + '"'
+    s = ' '.join(text).capitalize() + rng.choice(['.', '.', '?', '!'])
+    if rng.random() < newlines and n > 4:
+        i = rng.randrange(1, n)
+        s = ' '.join(text[:i]).capitalize() + '.\n\n' + \
+            ' '.join(text[i:]).capitalize() + '.'
+    return s
+
+def document_names(years, documents, overlap):
+    """Returns a dictionary mapping each year to its list of documents, where
+       the first `overlap` fraction of each list is read in every year"""
+    common = round(documents * overlap)
+    return {yr: [f'Common Reading {k}' for k in range(common)] +
+                [f'{yr} Reading {k}' for k in range(documents - common)]
+            for yr in years}
+
+###
+### Main routines
+###
+
+def generate(fname, year, annotations, documents, rng, params):
+    """Write a synthetic export for year to file fname, with about annotations
+       comments on the list of documents"""
+    num_students = max(1, round(annotations / params['students']))
+    students = [(f'Student{k}', rng.choice(FIRST_NAMES),
+                 rng.randrange(10000000, 100000000))
+                for k in range(num_students)]
+    when = datetime.datetime(int(year), 1, 20, 8, 0, 0)
+    anchors = {doc: 0 for doc in documents}
+
+    with open(fname, mode='w', encoding='utf-8-sig', newline='') as fout:
+        fout.write(','.join(HEADER) + '\r\n')
+        written = 0
+        while written < annotations:
+            size = min(geometric(rng, params['conversation']),
+                       annotations - written)
+            doc = rng.choice(documents)
+            start = anchors[doc] * 300 + rng.randrange(100)
+            anchors[doc] += 1
+            anchor = json.dumps({'type': 'text', 'start': start,
+                                 'end': start + rng.randrange(20, 250)},
+                                separators=(',', ':'))
+            page = rng.choice(['', '', str(rng.randrange(1, 30))])
+
+            for i in range(size):
+                if rng.random() < params['instructor']:
+                    last, first, sid = INSTRUCTOR + (10000000,)
+                else:
+                    last, first, sid = rng.choice(students)
+                when += datetime.timedelta(seconds=rng.randrange(1, 600))
+                created = when.strftime('%Y-%m-%d %H:%M:%S')
+                fout.write(format_row([
+                    last, first, sid,
+                    submission(rng, params['words'], params['newlines'],
+                               params['quotes']),
+                    'question' if rng.random() < 0.2 else 'comment',
+                    rng.randrange(3), created, created,
+                    size - 1 if i == 0 else 0,
+                    min(geometric(rng, 1.5) - 1, 10),
+                    '', doc, page, anchor]))
+            written += size
+
+def synthesize(directory='annotations', **options):
+    """Write a synthetic export for every year into directory, and return the
+       list of filenames written (relative to directory)"""
+    params = dict(DEFAULTS)
+    params.update(options)
+    rng = random.Random(params['seed'])
+    years = str(params['years']).split(',')
+    names = document_names(years, int(params['documents']),
+                           float(params['overlap']))
+
+    files = []
+    per_year = int(params['annotations']) // len(years)
+    for k, yr in enumerate(years):
+        count = per_year + (1 if k < int(params['annotations']) % len(years)
+                            else 0)
+        fname = f'{yr}.csv'
+        generate(f'{directory}/{fname}', yr, count, names[yr], rng, params)
+        files.append(fname)
+    return files
+
+def main():
+    usage = ('Usage: python3 synth.py [-annotations N] [-years Y1,Y2,...] '
+             '[-documents N]\n'
+             '       [-overlap F] [-conversation F] [-instructor F] '
+             '[-words N] [-newlines F]\n'
+             '       [-quotes F] [-students N] [-seed N] [-dir DIR]')
+    options = {}
+    directory = 'annotations'
+    args = sys.argv[1:]
+    try:
+        while args:
+            opt = args.pop(0)
+            name = opt[1:]
+            if opt == '-dir':
+                directory = args.pop(0)
+            elif name in ('annotations', 'documents', 'words', 'seed'):
+                options[name] = int(args.pop(0))
+            elif name in ('overlap', 'conversation', 'instructor', 'newlines',
+                          'quotes', 'students'):
+                options[name] = float(args.pop(0))
+            elif name == 'years':
+                options[name] = args.pop(0)
+            else:
+                sys.exit(usage)
+    except (IndexError, ValueError):
+        sys.exit(usage)
+
+    for fname in synthesize(directory, **options):
+        print(f'Wrote {directory}/{fname}')
+
+if __name__ == '__main__':
+    main()
@@ -5,11 +5,26 @@ randomized dataset of Perusall annotations.  This routine simultaneously creates
 an already-coded version (arcoded) of the all-years files in the same format as
 the tbcoded file.
 
+We pick whole conversations in a single pass with seeded reservoir sampling,
+so we never split a conversation and never need to know the size of the
+dataset in advance.  Each conversation gets a random priority, and the
+reservoir holds the conversations with the smallest priorities that together
+contain at least `PERCENT_GRABBED` percent of the comments seen so far.  With
+`-stratify`, we keep a separate reservoir for each year and document, so every
+one of them is represented in proportion to its comments.  We read the CSV
+files with `columnar.stream()`, since loading a columnar cache would hold the
+whole dataset in memory.
+
 Author: Mike Smith Date:   20211123
 """
 
 import sys
 import csv
+import heapq
+import random
+from contextlib import closing
+import columnar
+import instrument
 
 """Format of the randomized Perusall-annotation CSV files
 --- Fields in `all-years` CSV file ---
@@ -43,9 +58,13 @@ FNAME_ARNEW = 'annotations/arcoded.csv'
 
 PERCENT_GRABBED = 10
 
-# Where we collect the new file data
-new_tbdata = []
-new_ardata = []
+# Header of the to-be-coded and already-coded files
+NEW_HEADER = ['Conversation', 'Authentic?', 'Rich?', 'Comment']
+
+# Because the target grows as we read, the reservoir holds on to any
+# conversation whose priority is within this multiple of the sampled fraction,
+# even if the target doesn't need it yet
+SLACK = 1.25
 
 ###
 ### Some helper functions
@@ -55,84 +74,153 @@ def starts_conversation(comment):
     """Returns True if this comment starts a conversation"""
     return comment[0] == '0'
 
+class Reservoir:
+    """A reservoir of whole conversations holding at least percent
+       percent of the comments added to it"""
+
+    def __init__(self, percent):
+        self.fraction = percent / 100
+        self.heap = []    # (-priority, c, comments), so the top is the largest
+        self.seen = 0     # comments added so far
+        self.kept = 0     # comments in the reservoir
+
+    def target(self):
+        """Returns the number of comments the sample must hold right now"""
+        return self.seen * self.fraction
+
+    def add(self, priority, c, comments):
+        """Offer conversation c, whose comments are listed, with priority"""
+        self.seen += len(comments)
+        self.kept += len(comments)
+        heapq.heappush(self.heap, (-priority, c, comments))
+
+        # Evict the largest priorities that the target doesn't need
+        bound = SLACK * self.fraction
+        while -self.heap[0][0] > bound and \
+              self.kept - len(self.heap[0][2]) >= self.target():
+            _, _, evicted = heapq.heappop(self.heap)
+            self.kept -= len(evicted)
+
+    def sample(self):
+        """Returns the list of `(c, comments)` conversations with the smallest
+           priorities that together hold at least the target"""
+        chosen = []
+        total = 0
+        for _, c, comments in sorted(self.heap, reverse=True):
+            if total >= self.target():
+                break
+            chosen.append((c, comments))
+            total += len(comments)
+        return chosen
+
+def read_conversations(rows, ar_writer):
+    """Yield the triple `(c, k_row, comments)` for each conversation in rows,
+       an iterable of the `(d_row, k_row)` pairs of the all-years files without
+       their headers, where k_row is the key row of the conversation's first
+       comment.  We write every comment to the already-coded file as we go."""
+    # Note: conversation count starts at 1
+    c = 0         # conversation number
+    comments = [] # text of the comments in conversation c
+    head = None
+
+    for d_row, k_row in rows:
+        if starts_conversation(d_row):
+            if comments:
+                yield c, head, comments
+            c += 1
+            comments = []
+            head = k_row
+        comments.append(d_row[1])
+        ar_writer.writerow([c, k_row[5], k_row[6], d_row[1]])
+
+    if not comments:
+        raise RuntimeError('Nothing but a header in CSV file')
+    yield c, head, comments
+
+def sample(conversations, percent=PERCENT_GRABBED, stratify=False):
+    """Pick whole conversations from the triples that `read_conversations()`
+       yields, using the `random` module's current state.  Returns the pair
+       `(chosen, seen)`, where chosen is the list of `(c, comments)` picked, in
+       their original order, and seen is the number of comments offered."""
+    # One reservoir per stratum, which is the year and document of a
+    # conversation when we stratify, and None otherwise
+    reservoirs = {}
+    for c, head, comments in conversations:
+        stratum = (head[0], head[4]) if stratify else None
+        reservoirs.setdefault(stratum, Reservoir(percent)).add(
+            random.random(), c, comments)
+
+    chosen = sorted(s for reservoir in reservoirs.values()
+                    for s in reservoir.sample())
+    return chosen, sum(reservoir.seen for reservoir in reservoirs.values())
+
+def write_tbcoded(chosen):
+    """Write the to-be-coded file holding the chosen conversations"""
+    with open(FNAME_TBNEW, mode='w') as fout:
+        csv_writer = csv.writer(fout, delimiter=',', quotechar='"',
+                                quoting=csv.QUOTE_MINIMAL)
+        csv_writer.writerow(NEW_HEADER)
+        for c, comments in chosen:
+            for comment in comments:
+                csv_writer.writerow([c, 0, 0, comment])
+
 ###
 ### Main
 ###
 
-# Grab total number of lines in all-years.csv from command line
-if len(sys.argv) != 3:
-    sys.exit("Usage: python3 tenpc.py `wc -l annotations/all-years.csv`")
-tot_records = int(sys.argv[1])
-num_grabbed = int(tot_records * PERCENT_GRABBED / 100) 
-
-# We grab all the records in the all-years files for both output
-# files in the following code because it is easier to deal with 
-# the loop bound when we write out the tbcoded file.
-with open(FNAME_DATA) as fdata, \
-     open(FNAME_KEY) as fkey:
-    data_reader = csv.reader(fdata, delimiter=',')
-    key_reader = csv.reader(fkey, delimiter=',')
-
-    # Note: record count is 0-based and conversation count is not
-    record = 0    # an index into a CSV file
-    c = 0         # conversation number (starts at 1)
-
-    # Handle header record
-    try:
-        # Throw away existing headers
-        d_row = next(data_reader)
-        k_row = next(key_reader)
-
-        # Create new header
-        new_header = ['Conversation', 'Authentic?', 'Rich?', 'Comment']
-        new_tbdata.append(new_header)
-        new_ardata.append(new_header)
-        record += 1
-
-    except StopIteration:
-        raise RuntimeError('Unexpected empty CSV file')
-
-    # Prepare to begin translation
+def main():
+    # Grab any options on command line
+    usage = "Usage: python3 tenpc.py [-percent P] [-seed N] [-stratify]"
+    percent = PERCENT_GRABBED
+    testing_seed = None
+    stratify = False
+    args = sys.argv[1:]
     try:
-        d_row = next(data_reader)
-        k_row = next(key_reader)
-        assert(starts_conversation(d_row))
-    except StopIteration:
-        raise RuntimeError('Nothing but a header in CSV file')
+        while args:
+            opt = args.pop(0)
+            if opt == '-percent':
+                percent = float(args.pop(0))
+            elif opt == '-seed':
+                testing_seed = int(args.pop(0))
+            elif opt == '-stratify':
+                stratify = True
+            else:
+                sys.exit(usage)
+    except (IndexError, ValueError):
+        sys.exit(usage)
+    if percent <= 0 or percent > 100:
+        sys.exit(usage)
+    random.seed(testing_seed)
+
+    # We write the already-coded file as we read, and hold only the sampled
+    # conversations for the to-be-coded file
+    with instrument.phase('sample') as phase, \
+         closing(columnar.stream(FNAME_DATA)) as data_reader, \
+         closing(columnar.stream(FNAME_KEY)) as key_reader, \
+         open(FNAME_ARNEW, mode='w') as fout:
+        ar_writer = csv.writer(fout, delimiter=',', quotechar='"',
+                               quoting=csv.QUOTE_MINIMAL)
 
-    # Translate
-    while True:
-        if starts_conversation(d_row):
-            c += 1
-
-        new_row = [c, 0, 0, d_row[1]]
-        new_tbdata.append(new_row)
-        new_row = [c, k_row[5], k_row[6], d_row[1]]
-        new_ardata.append(new_row)
-        record += 1
-
-        # Try to grab the next record and loop back
+        # Throw away existing headers
         try:
-            d_row = next(data_reader)
-            k_row = next(key_reader)
+            next(data_reader)
+            next(key_reader)
         except StopIteration:
-            break    # all records have been coded
-
-# Write out the to-be-coded data
-with open(FNAME_TBNEW, mode='w') as fout:
-    csv_writer = csv.writer(fout, delimiter=',', quotechar='"',
-                            quoting=csv.QUOTE_MINIMAL)
-    for i, new_row in enumerate(new_tbdata):
-        if i > num_grabbed:  # use > to deal with header line
-            # We only write out the PERCENT_GRABBED in this file
-            break
-        csv_writer.writerow(new_row)
-print(f'Wrote {FNAME_TBNEW}')
-
-# Write out the already-coded data
-with open(FNAME_ARNEW, mode='w') as fout:
-    csv_writer = csv.writer(fout, delimiter=',', quotechar='"',
-                            quoting=csv.QUOTE_MINIMAL)
-    for new_row in new_ardata:
-        csv_writer.writerow(new_row)
-print(f'Wrote {FNAME_ARNEW}')
+            raise RuntimeError('Unexpected empty CSV file')
+        ar_writer.writerow(NEW_HEADER)
+
+        chosen, seen = sample(read_conversations(zip(data_reader, key_reader),
+                                                 ar_writer), percent, stratify)
+        phase.rows = seen
+    print(f'Wrote {FNAME_ARNEW}')
+
+    # Write out the to-be-coded data, with conversations in their original
+    # order
+    grabbed = sum(len(comments) for c, comments in chosen)
+    with instrument.phase('write tbcoded', rows=grabbed):
+        write_tbcoded(chosen)
+    print(f'Wrote {FNAME_TBNEW} with {len(chosen)} conversations '
+          f'({grabbed} of {seen} comments)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+""" textfeatures.py: Per-comment text features of Perusall annotations
+
+We compile the tokenizer and the other patterns once and then process the
+comment texts in batches, optionally spreading the batches across a pool of
+processes for big corpora.  The result is a dictionary of per-comment columns
+(NumPy arrays) that `metrics.py` aggregates per conversation.
+
+Author: Mike Smith
+Date:   20261017
+"""
+
+import os
+import re
+import string
+from multiprocessing import Pool
+import numpy as np
+
+"""Per-comment columns returned by `extract()`
+words: int32 -- count of words, as computed by `words_in()`
+sentences: int32 -- count of sentences
+characters: int32 -- count of characters
+ttr: float64 -- type/token ratio of the lowercased words (0 if no words)
+questions: int32 -- count of question marks
+has_url: int8 -- 1 if the comment contains a URL
+has_code: int8 -- 1 if the comment appears to contain a code snippet
+"""
+
+###
+### Global variables
+###
+
+# Column names in the order `features_of()` returns them, and their types
+FEATURES = ['words', 'sentences', 'characters', 'ttr', 'questions', 'has_url',
+            'has_code']
+TYPES = [np.int32, np.int32, np.int32, np.float64, np.int32, np.int8, np.int8]
+
+# Number of comments handed to a worker process at a time
+BATCH_SIZE = 10000
+
+# Use a process pool only when there are at least this many comments
+PARALLEL_THRESHOLD = 100000
+
+# Precompiled patterns
+PUNCTUATION = re.compile('[' + string.punctuation + ']')
+SENTENCE = re.compile(r'[^.!?]*[^.!?\s][^.!?]*(?:[.!?]+|$)')
+URL = re.compile(r'https?://|www\.', re.IGNORECASE)
+CODE = re.compile(r'`[^`]+`|\b[A-Za-z_]\w*\([^()]*\)|^(?: {4}|\t)\S',
+                  re.MULTILINE)
+
+###
+### Feature extraction
+###
+
+def words_in(s):
+    """Returns a count of the words in the string s
+
+    It should surprise no one that the taken approach is not perfect.  In
+    general, it removes punctuation marks, which means that any words separated
+    by a hypen get run together and counted as one word (e.g., 'out-of-the-box
+    testing' becomes the two words 'outofthebox testing').  Words like 'e.g.'
+    become 'eg' and missed spaces at the end of a sentence or after a comma
+    mistakenly run words together.  But it is good enough for our purposes,
+    since the same thing is done to each year.
+    """
+    return len(PUNCTUATION.sub('', s).split())
+
+def features_of(s):
+    """Returns the tuple of features of the string s, in `FEATURES` order.  The
+       sentence count has the same flavor of imperfection as `words_in()`: an
+       abbreviation like 'e.g.' ends a sentence."""
+    stripped = PUNCTUATION.sub('', s)
+    words = stripped.split()
+    ttr = len(set(stripped.lower().split())) / len(words) if words else 0.0
+
+    # Cheap substring tests let us skip the regular expressions for most
+    # comments
+    has_url = ('://' in s or 'ww.' in s.lower()) and URL.search(s) is not None
+    has_code = (('`' in s or '(' in s or '    ' in s or '\t' in s)
+                and CODE.search(s) is not None)
+
+    return (len(words), len(SENTENCE.findall(s)), len(s), ttr, s.count('?'),
+            int(has_url), int(has_code))
+
+def features_of_batch(texts):
+    """Returns the list of feature tuples for a batch of strings"""
+    return [features_of(s) for s in texts]
+
+def extract(texts, processes=None):
+    """Returns a dictionary of per-comment feature columns for the list of
+       strings texts.  If processes is None, we use a pool with one process
+       per CPU for big corpora and no pool otherwise; processes=1 never uses a
+       pool."""
+    if processes is None:
+        processes = os.cpu_count() if len(texts) >= PARALLEL_THRESHOLD else 1
+
+    batches = [texts[i:i+BATCH_SIZE] for i in range(0, len(texts), BATCH_SIZE)]
+    if processes > 1 and len(batches) > 1:
+        with Pool(processes) as pool:
+            results = pool.map(features_of_batch, batches)
+    else:
+        results = [features_of_batch(batch) for batch in batches]
+
+    rows = np.array([row for result in results for row in result],
+                    dtype=np.float64).reshape(-1, len(FEATURES))
+    return {name: rows[:, j].astype(typ)
+            for j, (name, typ) in enumerate(zip(FEATURES, TYPES))}